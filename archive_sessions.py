@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+会話ログのコールドアーカイブを一括操作する（lib/session_archive.py）。
+アプリと同じ .env（SESSION_STORE_BACKEND / LOG_FILE_PATH / SESSION_ARCHIVE_DIR など）を読む。
+プロジェクトルートで実行すること:
+
+    python archive_sessions.py status
+    python archive_sessions.py archive --days 30      # 30 日以上更新のない終了・削除済みセッション
+    python archive_sessions.py archive --days 0       # 終了・削除済みセッションをすべて
+    python archive_sessions.py rehydrate --all        # すべてホットストアへ戻す
+    python archive_sessions.py rehydrate <session_id> [...]
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+from dotenv import load_dotenv
+
+load_dotenv(ROOT / ".env")
+
+from lib.session_store import get_session_store
+
+
+def open_store():
+    backend = os.getenv("SESSION_STORE_BACKEND", "json").lower()
+    path = {
+        "sqlite": ROOT / os.getenv("SESSION_DB_PATH", "data/chat_log.sqlite3"),
+        "sharded": ROOT / os.getenv("SESSION_SHARD_DIR", "data/sessions"),
+    }.get(backend, ROOT / os.getenv("LOG_FILE_PATH", "data/chat_log.json"))
+    # 自動アーカイブ（バックグラウンド）は使わず、このスクリプトから明示的に実行する
+    return get_session_store(backend, path, archive_dir=ROOT / os.getenv("SESSION_ARCHIVE_DIR", "data/archive"))
+
+
+def cmd_status(store, args):
+    summaries = store.list_session_summaries()
+    live = [s for s in summaries.values() if not s.get("purged_from_trash")]
+    archived = [s for s in live if s.get("archived")]
+    blobs = [p for p in store.archive.path.iterdir() if p.is_file() and not p.name.endswith(".tmp")]
+    print(f"backend      : {store.backend} ({store.path})")
+    print(f"archive      : {store.archive.path} (codec={store.archive.codec})")
+    print(f"sessions     : {len(live)}")
+    print(f"archived     : {len(archived)}")
+    print(f"blob files   : {len(blobs)} ({sum(p.stat().st_size for p in blobs):,} bytes)")
+    return 0
+
+
+def cmd_archive(store, args):
+    count = store.archive_idle_sessions(args.days)
+    print(f"archived {count} session(s)")
+    return 0
+
+
+def cmd_rehydrate(store, args):
+    if args.all:
+        targets = [sid for sid, s in store.list_session_summaries().items() if s.get("archived")]
+    else:
+        targets = args.session_ids
+    if not targets:
+        print("対象のセッションがありません（session_id か --all を指定）")
+        return 1
+    count = 0
+    for session_id in targets:
+        if store.rehydrate_session(session_id):
+            count += 1
+        else:
+            print(f"skip: {session_id}（アーカイブされていません）")
+    store.remove_orphan_blobs()
+    print(f"rehydrated {count} session(s)")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話ログのコールドアーカイブ一括操作")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="アーカイブ状況を表示")
+    p_archive = sub.add_parser("archive", help="終了・削除済みセッションをアーカイブ")
+    p_archive.add_argument(
+        "--days", type=float, default=float(os.getenv("SESSION_ARCHIVE_AFTER_DAYS", "30")),
+        help="この日数以上更新のないセッションが対象（0 ですべて）",
+    )
+    p_rehydrate = sub.add_parser("rehydrate", help="アーカイブ済みセッションをホットストアへ戻す")
+    p_rehydrate.add_argument("session_ids", nargs="*")
+    p_rehydrate.add_argument("--all", action="store_true", help="すべてのアーカイブ済みセッション")
+    args = parser.parse_args()
+
+    store = open_store()
+    handlers = {"status": cmd_status, "archive": cmd_archive, "rehydrate": cmd_rehydrate}
+    return handlers[args.command](store, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
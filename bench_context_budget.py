@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+保存済みの会話ログを使って、コンテキスト予算（lib/context_budget.py）によるプロンプトトークンの削減量を
+オフラインで見積もる（LLM は呼ばない）。各セッションの会話をターンごとに再生し、
+「履歴をすべて送る場合」と「予算を超えた分を要約に置き換える場合」の送信トークン数を比べる。
+要約は実際には生成せず、要約対象のトークン数 × --summary-ratio（上限 CONTEXT_SUMMARY_MAX_TOKENS / 2）
+の長さとみなす。要約の生成に使うトークン（入力 + 出力）も差し引いた正味の削減量を表示する。
+アプリと同じ .env（SESSION_STORE_BACKEND / LOG_FILE_PATH など）を読む。プロジェクトルートで実行すること:
+
+    python bench_context_budget.py --budget 8000
+    python bench_context_budget.py --budget 4000 --keep-recent 2 --top 20
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+from dotenv import load_dotenv
+
+load_dotenv(ROOT / ".env")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from lib import context_budget
+from lib.context_budget import build_context
+from lib.rate_limiter import estimate_tokens
+from lib.session_store import get_session_store
+
+
+def open_store():
+    backend = os.getenv("SESSION_STORE_BACKEND", "json").lower()
+    path = {
+        "sqlite": ROOT / os.getenv("SESSION_DB_PATH", "data/chat_log.sqlite3"),
+        "sharded": ROOT / os.getenv("SESSION_SHARD_DIR", "data/sessions"),
+    }.get(backend, ROOT / os.getenv("LOG_FILE_PATH", "data/chat_log.json"))
+    return get_session_store(backend, path, archive_dir=ROOT / os.getenv("SESSION_ARCHIVE_DIR", "data/archive"))
+
+
+def replay_session(history: list, budget: int, summary_ratio: float) -> dict:
+    """会話履歴をターンごとに再生し、送信トークン数（推定）を集計する"""
+    totals = {"turns": 0, "full_tokens": 0, "sent_tokens": 0, "summary_calls": 0, "summary_tokens": 0}
+    summary = None
+    summary_cap = context_budget.SUMMARY_MAX_TOKENS // 2
+
+    def summarize(request_messages):
+        request_tokens = estimate_tokens(request_messages)
+        length = min(summary_cap, max(1, int(request_tokens * summary_ratio)))
+        # 日本語 1 文字 ≒ 1 トークンとして、推定トークン数が length になる文字列を要約の代わりにする
+        return "要" * length, {"prompt_tokens": request_tokens, "completion_tokens": length}
+
+    for index, message in enumerate(history):
+        if message.get("role") != "user":
+            continue
+        prefix = history[:index + 1]
+        messages, new_summary, record = build_context(prefix, budget, summary, summarize)
+        if new_summary is not None:
+            summary = new_summary
+        totals["turns"] += 1
+        totals["full_tokens"] += record["stored_tokens_estimate"]
+        totals["sent_tokens"] += record["sent_tokens_estimate"]
+        if record["summary_usage"]:
+            totals["summary_calls"] += 1
+            totals["summary_tokens"] += record["summary_usage"]["prompt_tokens"] + record["summary_usage"]["completion_tokens"]
+    return totals
+
+
+def logged_prompt_tokens(session: dict) -> int:
+    return sum(m.get("metrics", {}).get("prompt_tokens", 0) for m in session.get("messages", []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="コンテキスト予算によるプロンプトトークン削減のオフライン見積もり")
+    parser.add_argument("--budget", type=int, default=context_budget.CONTEXT_BUDGET_TOKENS or 8000,
+                        help="トークン予算（既定: CONTEXT_BUDGET_TOKENS、未設定なら 8000）")
+    parser.add_argument("--keep-recent", type=int, default=context_budget.KEEP_RECENT_TURNS,
+                        help="そのまま送る直近の往復数")
+    parser.add_argument("--summary-ratio", type=float, default=0.2,
+                        help="要約の長さ（要約対象のトークン数に対する比率）")
+    parser.add_argument("--top", type=int, default=10, help="削減量の多いセッションを何件表示するか")
+    args = parser.parse_args()
+    context_budget.KEEP_RECENT_TURNS = args.keep_recent
+
+    store = open_store()
+    summaries = store.list_session_summaries()
+    print(f"store  : {store.backend} ({store.path}), sessions={len(summaries)}")
+    print(f"budget : {args.budget:,} tokens, keep_recent={args.keep_recent}, summary_ratio={args.summary_ratio}")
+
+    rows = []
+    logged_total = 0
+    for session_id, summary in summaries.items():
+        if summary.get("purged_from_trash"):
+            continue
+        session = store.get_session(session_id)
+        history = (session or {}).get("conversation_history") or []
+        if not history:
+            continue
+        totals = replay_session(history, args.budget, args.summary_ratio)
+        if not totals["turns"]:
+            continue
+        logged_total += logged_prompt_tokens(session)
+        rows.append((session_id, totals))
+
+    if not rows:
+        print("対象のセッションがありません")
+        return 1
+
+    grand = {key: sum(t[key] for _, t in rows) for key in rows[0][1]}
+    saved = grand["full_tokens"] - grand["sent_tokens"] - grand["summary_tokens"]
+    print()
+    print(f"{'session_id':<32} {'turns':>6} {'full':>12} {'sent':>12} {'summary':>10} {'saved':>8}")
+    for session_id, t in sorted(rows, key=lambda r: r[1]["sent_tokens"] - r[1]["full_tokens"])[:args.top]:
+        net = t["full_tokens"] - t["sent_tokens"] - t["summary_tokens"]
+        print(f"{session_id:<32} {t['turns']:>6} {t['full_tokens']:>12,} {t['sent_tokens']:>12,} "
+              f"{t['summary_tokens']:>10,} {net / t['full_tokens']:>8.1%}")
+    print()
+    print(f"sessions          : {len(rows):,} ({grand['turns']:,} turns)")
+    print(f"full history      : {grand['full_tokens']:,} prompt tokens (推定)")
+    print(f"with budget       : {grand['sent_tokens']:,} prompt tokens + 要約 {grand['summary_tokens']:,} tokens "
+          f"({grand['summary_calls']:,} 回)")
+    print(f"net saving        : {saved:,} tokens ({saved / grand['full_tokens']:.1%})")
+    if logged_total:
+        # 推定値と実際の usage の比（推定の精度の目安）
+        print(f"logged usage      : {logged_total:,} prompt tokens (推定 / 実測 = {grand['full_tokens'] / logged_total:.2f})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
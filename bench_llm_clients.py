@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+LLM クライアントの使い回し（lib/llm_clients.py）による 1 ターンあたりの短縮時間を計測する。
+ローカルのモックサーバー（Azure OpenAI / Anthropic 互換の最小実装）に対して、
+「ターンごとにクライアントを生成する従来の方法」と「レジストリの共有クライアント」で
+同じリクエストを繰り返し、クライアント生成 + 接続確立 + TLS ハンドシェイクを含む所要時間を比べる。
+外部の API には接続しない。プロジェクトルートで実行すること:
+
+    python bench_llm_clients.py --turns 50
+    python bench_llm_clients.py --turns 50 --no-tls --latency-ms 20
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import anthropic
+import certifi
+import httpx
+from openai import AzureOpenAI
+
+API_VERSION = "2024-12-01-preview"
+
+
+# ========================================
+# モックサーバー
+# ========================================
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # ヘッダーと本文を別々に書くため、Nagle + 遅延 ACK の待ち（約 40 ms）が計測に混ざらないようにする
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+        if self.latency:
+            time.sleep(self.latency)
+        if "/v1/messages" in self.path:
+            payload = {
+                "id": "msg_bench", "type": "message", "role": "assistant", "model": body.get("model"),
+                "content": [{"type": "text", "text": "ok"}], "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": 5, "output_tokens": 1},
+            }
+        else:
+            payload = {
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "bench",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6},
+            }
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_mock_server(latency: float, tls_dir: Path | None) -> str:
+    """モックサーバーを起動してベース URL を返す。tls_dir を渡すと自己署名証明書で HTTPS にする。"""
+    _MockHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _MockHandler)
+    scheme = "http"
+    if tls_dir is not None:
+        cert, key = tls_dir / "cert.pem", tls_dir / "key.pem"
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-keyout", str(key), "-out", str(cert), "-subj", "/CN=127.0.0.1",
+             "-addext", "subjectAltName=IP:127.0.0.1"],
+            check=True, capture_output=True,
+        )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        # 実運用と同じく certifi の CA バンドル全体を読み込ませる（自己署名証明書を追加）
+        bundle = tls_dir / "ca-bundle.pem"
+        bundle.write_bytes(Path(certifi.where()).read_bytes() + cert.read_bytes())
+        os.environ["SSL_CERT_FILE"] = str(bundle)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"{scheme}://127.0.0.1:{server.server_address[1]}/"
+
+
+# ========================================
+# 計測
+# ========================================
+def call_openai(client) -> None:
+    client.chat.completions.create(
+        model="bench", messages=[{"role": "user", "content": "hi"}], max_completion_tokens=16,
+    )
+
+
+def call_anthropic(client) -> None:
+    client.messages.create(model="bench", max_tokens=16, messages=[{"role": "user", "content": "hi"}])
+
+
+def fresh_client(provider: str, base: str):
+    """従来の方法: ターンごとに新しいクライアントを作る"""
+    if provider == "anthropic":
+        return anthropic.Anthropic(api_key="bench", base_url=base)
+    return AzureOpenAI(
+        api_key="bench", api_version=API_VERSION, azure_endpoint=base, timeout=httpx.Timeout(120.0, connect=10.0),
+    )
+
+
+def pooled_client(provider: str, base: str):
+    from lib.llm_clients import get_anthropic_client, get_openai_client
+    if provider == "anthropic":
+        return get_anthropic_client(base, "bench")
+    return get_openai_client(base, "bench", API_VERSION)
+
+
+def run(provider: str, base: str, turns: int, make_client) -> list[float]:
+    call = call_anthropic if provider == "anthropic" else call_openai
+    timings = []
+    for _ in range(turns):
+        started = time.perf_counter()
+        call(make_client(provider, base))
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def summarize(timings: list[float]) -> dict:
+    ordered = sorted(timings)
+    return {
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM クライアント使い回しのベンチマーク（ローカルモック）")
+    parser.add_argument("--turns", type=int, default=50, help="計測するターン数")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="モックサーバーの応答待ち時間")
+    parser.add_argument("--no-tls", action="store_true", help="HTTP で計測する（TLS ハンドシェイクを含めない）")
+    args = parser.parse_args()
+
+    use_tls = not args.no_tls and shutil.which("openssl") is not None
+    with tempfile.TemporaryDirectory() as tmp:
+        base = start_mock_server(args.latency_ms / 1000, Path(tmp) if use_tls else None)
+        from lib.llm_clients import client_stats
+        print(f"mock server: {base} (tls={use_tls}, latency={args.latency_ms:.0f} ms, turns={args.turns})")
+        print(f"{'provider':<10} {'mode':<8} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+        for provider in ("openai", "anthropic"):
+            run(provider, base, 2, pooled_client)  # 共有クライアントの生成と最初の接続は計測から除く
+            results = {
+                "fresh": summarize(run(provider, base, args.turns, fresh_client)),
+                "pooled": summarize(run(provider, base, args.turns, pooled_client)),
+            }
+            for mode, s in results.items():
+                print(f"{provider:<10} {mode:<8} {s['mean']:>9.2f} {s['p50']:>9.2f} {s['p95']:>9.2f}")
+            saved = results["fresh"]["mean"] - results["pooled"]["mean"]
+            print(f"{provider:<10} {'saved':<8} {saved:>9.2f} ms/turn ({saved / results['fresh']['mean']:.0%})")
+        print(f"pool stats: {client_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+lib/circuit_breaker.py - エンドポイント・デプロイ単位のサーキットブレーカー
+
+REGIONS のエンドポイントが落ちていると、毎ターン httpx のタイムアウト（最大 120 秒）まで待ってから
+失敗していた。(エンドポイント, デプロイ名) ごとに次の 3 状態を持ち、
+落ちているエンドポイントへは送らずにすぐ失敗させる。
+
+- closed（通常）: 接続エラー・タイムアウト・5xx が CIRCUIT_BREAKER_FAILURES 回続いたら open にする
+  （429 などレート制限や 4xx はエンドポイントが応答しているので数えない）
+- open（遮断）: CIRCUIT_BREAKER_OPEN_SECONDS 秒の間は送信せずに CircuitOpenError を送出する。
+  lib/llm_retry.py は送信前に止めたもの（local）として再試行せず次のリージョンへ切り替える
+- half_open（回復確認）: open の期間が過ぎたら 1 件だけ送信（probe）を通し、成功すれば closed、
+  失敗すれば再び open にする。probe の応答を待つ間、他の送信はすぐ失敗させる
+
+取り消した送信（⏹ 停止・ヘッジで打ち切った側。finish_reason="cancelled"）は回復の根拠にならないため、
+成功にも失敗にも数えない。probe だった場合は次の送信を改めて probe にする。
+
+- call_with_breaker(): 状態を確認してから call() を呼び、結果（成功・失敗）を状態に反映する
+- breaker_state() / breaker_stats(): 状態と件数（モデル選択・フッター表示用）
+
+使い方:
+    result = call_with_breaker(model_info["endpoint"], model_info["deployment_name"], lambda: provider.complete(...))
+"""
+
+import os
+import threading
+import time
+
+from lib.llm_retry import classify_error, status_code
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "1") not in ("0", "false", "False")
+# 連続してこの回数失敗したら open にする
+FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURES", "3"))
+# open にしてから回復確認（half_open）に移るまでの秒数
+OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))
+# 回復確認の送信がこの秒数を過ぎても終わらなければ、次の送信を新しい probe にする（タイムアウトより長く）
+PROBE_TIMEOUT = float(os.getenv("CIRCUIT_BREAKER_PROBE_TIMEOUT", "150"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# エンドポイントは応答しているもの（レート制限・混雑）。失敗として数えない
+_ALIVE_STATUS = {409, 429}
+
+_breakers: dict[tuple, dict] = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが open（または回復確認中）のため送信しなかった"""
+
+    # 送信前に止めたもの（サーバーのエラーではない）。lib/llm_retry.py は再試行せず別リージョンへ切り替える
+    local = True
+
+    def __init__(self, endpoint: str, deployment_name: str, state: str, retry_after: float):
+        self.endpoint = endpoint
+        self.deployment_name = deployment_name
+        self.state = state
+        self.retry_after = retry_after
+        reason = "回復を確認中" if state == HALF_OPEN else f"約 {retry_after:.0f} 秒後に回復を確認"
+        super().__init__(f"{deployment_name} ({endpoint}) は応答が無いため送信を止めています（{reason}）")
+
+
+def is_endpoint_failure(exc: Exception) -> bool:
+    """エンドポイントの障害とみなす失敗か（接続エラー・タイムアウト・5xx・ストリーム中のサーバーエラー）"""
+    if getattr(exc, "local", False):
+        return False
+    if classify_error(exc) != "retry" or status_code(exc) in _ALIVE_STATUS:
+        return False
+    body = getattr(exc, "body", None)
+    error = body.get("error", body) if isinstance(body, dict) else None
+    return not (isinstance(error, dict) and error.get("type") == "rate_limit_error")
+
+
+def _breaker(endpoint: str, deployment_name: str) -> dict:
+    """(エンドポイント, デプロイ名) の状態を返す（無ければ作る）。_breakers_lock を保持して呼ぶこと"""
+    key = (endpoint, deployment_name)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = _breakers[key] = {
+            "state": CLOSED,
+            "consecutive_failures": 0,
+            "opened_at": None,
+            "probe_started_at": None,
+            "opened": 0,
+            "fast_failed": 0,
+            "probes": 0,
+            "successes": 0,
+            "failures": 0,
+            "cancelled": 0,
+            "last_error": None,
+        }
+    return breaker
+
+
+def _open(breaker: dict, key: tuple, now: float) -> None:
+    """open にする。_breakers_lock を保持して呼ぶこと"""
+    breaker.update(state=OPEN, opened_at=now, probe_started_at=None)
+    breaker["opened"] += 1
+    logger.warning(
+        "circuit_breaker: open endpoint=%s, deployment=%s（連続失敗 %d 回, last_error=%s）。%g 秒間送信を止めます",
+        key[0], key[1], breaker["consecutive_failures"], breaker["last_error"], OPEN_SECONDS,
+    )
+
+
+# ========================================
+# 状態遷移
+# ========================================
+def before_call(endpoint: str, deployment_name: str) -> dict:
+    """送信してよいか確認し、チケット（dict）を返す。送信しない場合は CircuitOpenError を送出する"""
+    key = (endpoint, deployment_name)
+    ticket = {"key": key, "probe": False}
+    if not BREAKER_ENABLED:
+        return ticket
+    with _breakers_lock:
+        breaker = _breaker(endpoint, deployment_name)
+        now = time.monotonic()
+        if breaker["state"] == OPEN:
+            remaining = breaker["opened_at"] + OPEN_SECONDS - now
+            if remaining > 0:
+                breaker["fast_failed"] += 1
+                raise CircuitOpenError(endpoint, deployment_name, OPEN, remaining)
+            breaker["state"] = HALF_OPEN
+        if breaker["state"] == HALF_OPEN:
+            probe_started = breaker["probe_started_at"]
+            if probe_started is not None and now - probe_started < PROBE_TIMEOUT:
+                breaker["fast_failed"] += 1
+                raise CircuitOpenError(endpoint, deployment_name, HALF_OPEN, 0.0)
+            breaker["probe_started_at"] = now
+            breaker["probes"] += 1
+            ticket["probe"] = True
+    if ticket["probe"]:
+        logger.info("circuit_breaker: 回復確認の送信 endpoint=%s, deployment=%s", endpoint, deployment_name)
+    return ticket
+
+
+def after_call(ticket: dict, error: Exception | None = None) -> None:
+    """before_call() で通した送信の結果を状態に反映する（error は失敗時の例外）"""
+    if not BREAKER_ENABLED:
+        return
+    key = ticket["key"]
+    failed = error is not None and is_endpoint_failure(error)
+    with _breakers_lock:
+        breaker = _breaker(*key)
+        now = time.monotonic()
+        if failed:
+            breaker["failures"] += 1
+            breaker["consecutive_failures"] += 1
+            breaker["last_error"] = f"{type(error).__name__}: {str(error)[:200]}"
+            if ticket["probe"] or (breaker["state"] == CLOSED and breaker["consecutive_failures"] >= FAILURE_THRESHOLD):
+                _open(breaker, key, now)
+            return
+        if error is None:
+            breaker["successes"] += 1
+        # エンドポイントが応答した（4xx・レート制限を含む）: 連続失敗を数え直し、回復確認なら closed に戻す
+        breaker["consecutive_failures"] = 0
+        if ticket["probe"] and breaker["state"] == HALF_OPEN:
+            breaker.update(state=CLOSED, opened_at=None, probe_started_at=None)
+            logger.info("circuit_breaker: closed endpoint=%s, deployment=%s（回復を確認）", key[0], key[1])
+
+
+def release(ticket: dict) -> None:
+    """before_call() で通した送信を、結果を状態に反映せずに終える（取り消した送信）。probe なら次の送信を probe にする"""
+    if not BREAKER_ENABLED:
+        return
+    key = ticket["key"]
+    with _breakers_lock:
+        breaker = _breaker(*key)
+        breaker["cancelled"] += 1
+        if ticket["probe"] and breaker["state"] == HALF_OPEN:
+            breaker["probe_started_at"] = None
+    if ticket["probe"]:
+        logger.info("circuit_breaker: 回復確認の送信が取り消されました endpoint=%s, deployment=%s", key[0], key[1])
+
+
+def call_with_breaker(endpoint: str, deployment_name: str, call):
+    """サーキットブレーカーを通して call() を呼ぶ（open なら呼ばずに CircuitOpenError）"""
+    ticket = before_call(endpoint, deployment_name)
+    try:
+        result = call()
+    except Exception as e:
+        after_call(ticket, e)
+        raise
+    if isinstance(result, dict) and result.get("finish_reason") == "cancelled":
+        release(ticket)
+    else:
+        after_call(ticket)
+    return result
+
+
+# ========================================
+# 表示用
+# ========================================
+def breaker_state(endpoint: str, deployment_name: str) -> str:
+    """closed / open / half_open（open の期間が過ぎて次の送信が回復確認になるものは half_open）"""
+    with _breakers_lock:
+        breaker = _breakers.get((endpoint, deployment_name))
+        if breaker is None:
+            return CLOSED
+        if breaker["state"] == OPEN and time.monotonic() - breaker["opened_at"] >= OPEN_SECONDS:
+            return HALF_OPEN
+        return breaker["state"]
+
+
+def breaker_stats() -> list[dict]:
+    """(エンドポイント, デプロイ名) ごとの状態・連続失敗数・open 回数・すぐ失敗させた数・回復確認の数"""
+    now = time.monotonic()
+    with _breakers_lock:
+        items = sorted((key, dict(breaker)) for key, breaker in _breakers.items())
+    stats = []
+    for (endpoint, deployment_name), breaker in items:
+        remaining = 0.0
+        if breaker["state"] == OPEN:
+            remaining = max(0.0, breaker["opened_at"] + OPEN_SECONDS - now)
+        stats.append({
+            "endpoint": endpoint,
+            "deployment_name": deployment_name,
+            "state": breaker["state"] if breaker["state"] != OPEN or remaining > 0 else HALF_OPEN,
+            "open_remaining_seconds": round(remaining, 1),
+            **{k: breaker[k] for k in ("consecutive_failures", "opened", "fast_failed", "probes",
+                                       "successes", "failures", "cancelled", "last_error")},
+        })
+    return stats
+
+
+def reset() -> None:
+    """すべての状態を消す（検証スクリプト用）"""
+    with _breakers_lock:
+        _breakers.clear()
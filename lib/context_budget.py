@@ -0,0 +1,185 @@
+"""
+lib/context_budget.py - コンテキストのトークン予算と会話履歴の要約による圧縮
+
+毎ターン会話履歴をすべて送ると、長いセッションではプロンプトトークン（とコスト・レイテンシ）が
+ターン数の 2 乗で増える。モデルごとのトークン予算（config/deployment_models.json の
+"context_budget"、無ければ CONTEXT_BUDGET_TOKENS。0 で無効）を超える場合は、
+
+- system プロンプトと直近のやり取り（CONTEXT_KEEP_RECENT_TURNS 往復、予算に収まらなければ減らす）はそのまま送り、
+- それより古いやり取りは「これまでの会話の要約」に置き換えて system プロンプトに添える。
+
+要約はセッションに保存（session["context_summary"]）して使い回す。要約 + それ以降のやり取りが
+予算に収まる間はそのまま使い、超えたら新たに要約対象になったメッセージの分だけ前回の要約に
+統合して更新する（毎ターン全体を要約し直さない）。
+要約の生成自体は呼び出し側が渡す summarize(request_messages) -> (text, usage) で行う。
+
+使い方:
+    messages, summary, record = build_context(history, budget, session.get("context_summary"), summarize)
+"""
+
+import json
+import os
+import zlib
+from datetime import datetime
+
+from lib.logger import get_logger
+from lib.rate_limiter import estimate_tokens
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+CONTEXT_BUDGET_TOKENS = int(os.getenv("CONTEXT_BUDGET_TOKENS", "0"))
+KEEP_RECENT_TURNS = int(os.getenv("CONTEXT_KEEP_RECENT_TURNS", "4"))
+SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "1024"))
+
+SUMMARY_HEADER = "## これまでの会話の要約（古いやり取りは要約のみを渡しています）"
+SUMMARY_INSTRUCTION = (
+    "あなたは会話の要約担当です。これまでの要約と、その後の会話の抜粋を受け取ります。"
+    "両方を統合した新しい要約を日本語で作成してください。"
+    "ユーザーの目的・前提条件・決定事項・固有名詞・数値・未解決の質問は省略せずに残し、"
+    f"挨拶や重複は省いて、{SUMMARY_MAX_TOKENS // 2} トークン程度以内の箇条書きにしてください。"
+    "要約本文のみを出力してください。"
+)
+
+
+def _checksum(messages: list) -> str:
+    """要約済みメッセージ列のチェックサム（履歴が変わっていないかの確認用）"""
+    data = json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return f"{zlib.crc32(data):08x}"
+
+
+def split_history(history: list) -> tuple[str, list]:
+    """会話履歴を (system プロンプト, system 以外のメッセージ列) に分ける"""
+    system = "\n\n".join(m["content"] for m in history if m.get("role") == "system")
+    dialogue = [m for m in history if m.get("role") != "system"]
+    return system, dialogue
+
+
+def summary_request(previous: str | None, messages: list) -> list:
+    """要約を更新するための API リクエスト（メッセージ列）を組み立てる"""
+    transcript = "\n\n".join(
+        f"[{'ユーザー' if m['role'] == 'user' else 'アシスタント'}]\n{m['content']}" for m in messages
+    )
+    body = f"# これまでの要約\n{previous or '（なし）'}\n\n# その後の会話\n{transcript}"
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTION},
+        {"role": "user", "content": body},
+    ]
+
+
+def _system_message(system: str, summary_text: str | None) -> dict | None:
+    if summary_text:
+        content = f"{system}\n\n{SUMMARY_HEADER}\n{summary_text}" if system else f"{SUMMARY_HEADER}\n{summary_text}"
+        return {"role": "system", "content": content}
+    return {"role": "system", "content": system} if system else None
+
+
+def plan_keep_from(system: str, dialogue: list, budget: int, keep_recent: int = KEEP_RECENT_TURNS,
+                   summary_tokens: int = SUMMARY_MAX_TOKENS) -> int:
+    """そのまま送る直近メッセージの開始位置（dialogue の添字）を決める。
+
+    直近 keep_recent 往復 + 最新のユーザー入力から始め、要約の分（summary_tokens）を見込んでも
+    予算を超えるなら 1 往復ずつ減らす（最新のユーザー入力だけは必ず残す）。
+    開始位置はユーザーのメッセージに揃える（Anthropic は先頭が user である必要がある）。
+    """
+    keep_from = max(0, len(dialogue) - (2 * keep_recent + 1))
+    fixed = estimate_tokens([{"content": system}]) + summary_tokens
+    while keep_from < len(dialogue) - 1 and fixed + estimate_tokens(dialogue[keep_from:]) > budget:
+        keep_from += 2
+    keep_from = min(keep_from, len(dialogue) - 1)
+    while keep_from < len(dialogue) - 1 and dialogue[keep_from].get("role") != "user":
+        keep_from += 1
+    return keep_from
+
+
+def build_context(history: list, budget: int, summary: dict | None, summarize=None) -> tuple[list, dict | None, dict]:
+    """予算内に収まるように送信するメッセージ列を組み立てる。
+
+    Args:
+        history: 保存している会話履歴（最新のユーザー入力を含む）
+        budget: トークン予算（0 以下なら圧縮しない）
+        summary: セッションに保存している要約（無ければ None）
+        summarize: summarize(request_messages) -> (text, usage)。要約の更新が必要なときに呼ばれる
+
+    Returns:
+        (送信するメッセージ列, 更新した要約（更新しなければ None）, 記録)。
+        記録は budget_tokens / stored_messages / sent_messages / stored_tokens_estimate /
+        sent_tokens_estimate / summarized_messages（要約に含めたメッセージ数）/
+        dropped_messages（要約できずに送らなかったメッセージ数）/ summary_tokens_estimate / summary_updated /
+        summary_usage（要約 API の usage）/ summary_error の dict。
+    """
+    stored_tokens = estimate_tokens(history)
+    record = {
+        "budget_tokens": budget,
+        "stored_messages": len(history),
+        "sent_messages": len(history),
+        "stored_tokens_estimate": stored_tokens,
+        "sent_tokens_estimate": stored_tokens,
+        "summarized_messages": 0,
+        "dropped_messages": 0,
+        "summary_tokens_estimate": 0,
+        "summary_updated": False,
+        "summary_usage": None,
+        "summary_error": None,
+    }
+    if budget <= 0 or stored_tokens <= budget:
+        return history, None, record
+
+    system, dialogue = split_history(history)
+
+    # 保存済みの要約が使えるか（要約した範囲の履歴が変わっていないか）
+    covered = 0
+    summary_text = None
+    if summary and 0 < summary.get("covered_messages", 0) <= len(dialogue) - 1:
+        if summary.get("checksum") == _checksum(dialogue[:summary["covered_messages"]]):
+            covered = summary["covered_messages"]
+            summary_text = summary.get("text")
+        else:
+            logger.warning("build_context: 要約済みの履歴が変わっているため要約を作り直します")
+
+    if covered and estimate_tokens([_system_message(system, summary_text)] + dialogue[covered:]) <= budget:
+        # 保存済みの要約 + それ以降のやり取りで予算に収まる間は要約を更新しない（毎ターン要約し直さない）
+        keep_from = covered
+    else:
+        # 要約の範囲が予定より先まで進んでいれば、その位置から送る（要約の方が短い）
+        keep_from = max(plan_keep_from(system, dialogue, budget), covered)
+
+    new_summary = None
+    summarized = covered
+    if keep_from > covered and summarize is not None:
+        try:
+            text, usage = summarize(summary_request(summary_text, dialogue[covered:keep_from]))
+            summary_text = text.strip()
+            new_summary = {
+                "text": summary_text,
+                "covered_messages": keep_from,
+                "checksum": _checksum(dialogue[:keep_from]),
+                "updated_at": datetime.now().isoformat(),
+            }
+            summarized = keep_from
+            record["summary_updated"] = True
+            record["summary_usage"] = usage
+            logger.info(
+                "build_context: 要約を更新 messages=%d->%d, summary_chars=%d",
+                covered, keep_from, len(summary_text),
+            )
+        except Exception as e:
+            # 要約できなければ、前回の要約（あれば）と直近のやり取りだけを送る（予算は守る）。
+            # 要約していない範囲は dropped_messages として記録する
+            logger.exception("build_context: 要約の生成に失敗。%d 件のメッセージを要約せずに省きます", keep_from - covered)
+            record["summary_error"] = f"{type(e).__name__}: {e}"
+    elif keep_from > covered:
+        record["summary_error"] = "summarize が指定されていません"
+
+    system_message = _system_message(system, summary_text)
+    messages = ([system_message] if system_message else []) + dialogue[keep_from:]
+    record.update(
+        sent_messages=len(messages),
+        sent_tokens_estimate=estimate_tokens(messages),
+        summarized_messages=summarized,
+        dropped_messages=keep_from - summarized,
+        summary_tokens_estimate=estimate_tokens([{"content": summary_text}]) if summary_text else 0,
+    )
+    return messages, new_summary, record
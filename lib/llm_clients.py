@@ -0,0 +1,168 @@
+"""
+lib/llm_clients.py - プロセス全体で共有する LLM クライアントのレジストリ
+
+anthropic.Anthropic / openai.AzureOpenAI を (provider, endpoint, api_key, api_version) ごとに
+1 つだけ生成し、Streamlit の再実行・ブラウザセッションをまたいで使い回す。
+
+- 各クライアントは専用の httpx 接続プールを持ち、keep-alive で TCP / TLS 接続を再利用する。
+  h2 パッケージがインストールされていれば HTTP/2 を有効にする
+- ターンごとのクライアント生成（SSL コンテキストの構築）と接続確立・TLS ハンドシェイクが不要になる
+- client_stats() でヒット数・生成数・プール内の接続数（使用中 / アイドル）を返す
+- 終了時（atexit）にすべての接続プールを閉じる
+
+非同期クライアント（anthropic.AsyncAnthropic / openai.AsyncAzureOpenAI）は接続プールがイベントループに
+結び付くため、実行中のイベントループごとに生成する（ループが閉じたものは次の生成時に片付ける）。
+
+使い方:
+    client = get_openai_client(endpoint, api_key, api_version)
+    client.chat.completions.create(...)
+    async_client = get_async_openai_client(endpoint, api_key, api_version)  # async 関数の中で
+"""
+
+import asyncio
+import atexit
+import importlib.util
+import os
+import threading
+
+import anthropic
+import httpx
+import openai
+
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_SECONDS", "60"))
+_HTTP2 = importlib.util.find_spec("h2") is not None  # 任意依存
+# Azure OpenAI の既定タイムアウト（従来のターンごとのクライアントと同じ）
+OPENAI_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+_clients: dict[tuple, dict] = {}
+_clients_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=_MAX_CONNECTIONS,
+        max_keepalive_connections=_MAX_CONNECTIONS,
+        keepalive_expiry=_KEEPALIVE_EXPIRY,
+    )
+
+
+def _get_or_create(key: tuple, factory, loop=None):
+    """key に対応するクライアントを返す（無ければ factory() で生成して登録する）。
+
+    非同期クライアントは loop（実行中のイベントループ）を渡し、key にループを含める。
+    """
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is not None:
+            _stats["hits"] += 1
+            entry["hits"] += 1
+            return entry["client"]
+        _stats["misses"] += 1
+        # 閉じたイベントループに結び付いた非同期クライアントは使えないので捨てる
+        for old_key in [k for k, e in _clients.items() if e["loop"] is not None and e["loop"].is_closed()]:
+            del _clients[old_key]
+        client, http_client = factory()
+        _clients[key] = {"client": client, "http_client": http_client, "hits": 0, "loop": loop}
+    logger.info(
+        "llm_clients: クライアント生成 provider=%s, endpoint=%s, http2=%s, max_connections=%d",
+        key[0], key[1], _HTTP2, _MAX_CONNECTIONS,
+    )
+    return client
+
+
+def get_anthropic_client(endpoint: str, api_key: str) -> anthropic.Anthropic:
+    """Anthropic クライアントを返す（同じエンドポイント・キーなら同じインスタンス）"""
+    def factory():
+        http_client = anthropic.DefaultHttpxClient(limits=_limits(), http2=_HTTP2)
+        return anthropic.Anthropic(api_key=api_key, base_url=endpoint, http_client=http_client), http_client
+
+    return _get_or_create(("anthropic", endpoint, api_key, None), factory)
+
+
+def get_openai_client(endpoint: str, api_key: str, api_version: str) -> openai.AzureOpenAI:
+    """Azure OpenAI クライアントを返す（同じエンドポイント・キー・API バージョンなら同じインスタンス）"""
+    def factory():
+        http_client = openai.DefaultHttpxClient(limits=_limits(), http2=_HTTP2, timeout=OPENAI_TIMEOUT)
+        client = openai.AzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            timeout=OPENAI_TIMEOUT,
+            http_client=http_client,
+        )
+        return client, http_client
+
+    return _get_or_create(("openai", endpoint, api_key, api_version), factory)
+
+
+def get_async_anthropic_client(endpoint: str, api_key: str) -> anthropic.AsyncAnthropic:
+    """非同期の Anthropic クライアントを返す（実行中のイベントループごとに 1 つ。async 関数の中で呼ぶこと）"""
+    loop = asyncio.get_running_loop()
+
+    def factory():
+        http_client = anthropic.DefaultAsyncHttpxClient(limits=_limits(), http2=_HTTP2)
+        return anthropic.AsyncAnthropic(api_key=api_key, base_url=endpoint, http_client=http_client), http_client
+
+    return _get_or_create(("anthropic-async", endpoint, api_key, None, loop), factory, loop)
+
+
+def get_async_openai_client(endpoint: str, api_key: str, api_version: str) -> openai.AsyncAzureOpenAI:
+    """非同期の Azure OpenAI クライアントを返す（実行中のイベントループごとに 1 つ。async 関数の中で呼ぶこと）"""
+    loop = asyncio.get_running_loop()
+
+    def factory():
+        http_client = openai.DefaultAsyncHttpxClient(limits=_limits(), http2=_HTTP2, timeout=OPENAI_TIMEOUT)
+        client = openai.AsyncAzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            timeout=OPENAI_TIMEOUT,
+            http_client=http_client,
+        )
+        return client, http_client
+
+    return _get_or_create(("openai-async", endpoint, api_key, api_version, loop), factory, loop)
+
+
+def _pool_connections(http_client) -> list:
+    """httpx クライアントの既定トランスポートが持つ接続の一覧（取得できなければ空）"""
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    return list(getattr(pool, "connections", []) or [])
+
+
+def client_stats() -> dict:
+    """clients / hits / misses / connections（プール内の接続数）/ active（使用中）/ idle / http2 を返す"""
+    with _clients_lock:
+        entries = list(_clients.values())
+        stats = {"clients": len(entries), **_stats, "http2": _HTTP2}
+    connections = [conn for entry in entries for conn in _pool_connections(entry["http_client"])]
+    idle = sum(1 for conn in connections if conn.is_idle())
+    stats.update(connections=len(connections), idle=idle, active=len(connections) - idle)
+    return stats
+
+
+def close_all() -> None:
+    """すべてのクライアントの接続プールを閉じる（atexit から呼ばれる）"""
+    with _clients_lock:
+        entries = list(_clients.values())
+        _clients.clear()
+    for entry in entries:
+        # 非同期クライアントはイベントループの外では閉じられない（ループの終了とともに破棄される）
+        if entry["loop"] is not None:
+            continue
+        try:
+            entry["http_client"].close()
+        except Exception:
+            logger.exception("llm_clients: 接続プールのクローズに失敗")
+
+
+atexit.register(close_all)
@@ -0,0 +1,99 @@
+"""
+lib/llm_compare.py - 同じプロンプトを複数のモデルへ並行して送る（比較モード）
+
+セッションはモデル固定のため、GPT と Claude などを比べるには同じプロンプトを複数のセッションに
+貼り付けて 1 つずつ待つ必要があった。run_parallel() は候補ごとの呼び出しをスレッドプールで
+同時に実行し、全体の所要時間を「最も遅いモデル」程度に抑える。
+
+ワーカーから Streamlit の要素は更新できないため、ストリーミングの差分と完了はキューに積み、
+呼び出し元のスレッド（スクリプトスレッド）で on_delta / on_done を呼ぶ。比較の記録は
+append_compare_log() で JSON Lines に 1 行ずつ追記する。
+
+使い方:
+    outcome = run_parallel(models, lambda model, on_text: stream_llm(model, ..., on_text=on_text),
+                           on_delta=render, on_done=finish)
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+# 一度に比較できるモデル数の上限
+COMPARE_MAX_MODELS = int(os.getenv("COMPARE_MAX_MODELS", "4"))
+
+_log_lock = threading.Lock()
+
+
+def run_parallel(targets: list, call, *, on_delta=None, on_done=None) -> dict:
+    """targets のそれぞれについて call(target, on_text) を並行して実行する。
+
+    Args:
+        targets: 呼び出し先（model_info の dict）
+        call: call(target, on_text) -> 結果。on_text(delta) で受信途中のテキストを渡す
+        on_delta: on_delta(index, delta)。呼び出し元のスレッドで呼ばれる
+        on_done: on_done(index, result, error, elapsed_seconds)。呼び出し元のスレッドで呼ばれる
+
+    Returns:
+        outcomes（候補ごとの {"result", "error", "elapsed_seconds"}）/ wall_clock_seconds /
+        branch_seconds_total（各候補の所要時間の合計 = 順番に送った場合の目安）の dict
+    """
+    events = queue.Queue()
+    started = time.perf_counter()
+
+    def run(index, target):
+        branch_started = time.perf_counter()
+        try:
+            result = call(target, lambda delta: events.put(("delta", index, delta)))
+            events.put(("done", index, (result, None, time.perf_counter() - branch_started)))
+        except Exception as e:
+            logger.warning("run_parallel: 失敗 deployment=%s, region=%s, error=%s: %s",
+                           target.get("deployment_name"), target.get("region"), type(e).__name__, e)
+            events.put(("done", index, (None, e, time.perf_counter() - branch_started)))
+
+    outcomes = [None] * len(targets)
+    with ThreadPoolExecutor(max_workers=max(1, len(targets)), thread_name_prefix="llm-compare") as pool:
+        for index, target in enumerate(targets):
+            pool.submit(run, index, target)
+        pending = len(targets)
+        while pending:
+            kind, index, payload = events.get()
+            if kind == "delta":
+                if on_delta is not None:
+                    on_delta(index, payload)
+                continue
+            pending -= 1
+            result, error, elapsed = payload
+            outcomes[index] = {"result": result, "error": error, "elapsed_seconds": round(elapsed, 3)}
+            if on_done is not None:
+                on_done(index, result, error, elapsed)
+
+    wall_clock = time.perf_counter() - started
+    branch_total = sum(o["elapsed_seconds"] for o in outcomes)
+    logger.info("run_parallel: %d モデル wall_clock=%.3fs, branch_total=%.3fs", len(targets), wall_clock, branch_total)
+    return {
+        "outcomes": outcomes,
+        "wall_clock_seconds": round(wall_clock, 3),
+        "branch_seconds_total": round(branch_total, 3),
+    }
+
+
+def append_compare_log(path: Path, record: dict) -> None:
+    """比較の記録を JSON Lines ファイルに 1 行追記する"""
+    path = Path(path)
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _log_lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
@@ -0,0 +1,293 @@
+"""
+lib/llm_hedge.py - ヘッジリクエスト（遅い応答に備えて別リージョンへ同じリクエストを重ねて送る）
+
+一部のリージョンがときどき遅くなると、チャットの p99 レイテンシはその遅い応答で決まる。
+LLM_HEDGE_ENABLED=1 のとき、call_hedged() は本来のデプロイ（primary）へのリクエストが、そのデプロイの
+直近の TTFT の LLM_HEDGE_PERCENTILE 分位点（下限 LLM_HEDGE_MIN_DELAY 秒）を過ぎても最初のトークンを
+返さなければ、同じモデルを提供する別リージョンのデプロイへ同じリクエスト（hedge）を送る。
+先に最初のトークンを返した方を採用して画面に流し、もう一方は CancelToken で打ち切る。
+
+- TTFT の計測が LLM_HEDGE_MIN_SAMPLES 件に満たないデプロイ・別リージョンの候補が無い場合はヘッジしない
+- 打ち切った側が消費したトークン（追加コスト）は記録に残し、呼び出し側が料金に換算して charge() で計上する。
+  セッションごと（LLM_HEDGE_SESSION_BUDGET_USD）と全体の 1 日あたり（LLM_HEDGE_DAILY_BUDGET_USD）の
+  予算を超える見込みなら budget_allows() が False を返し、ヘッジしない
+- ヘッジした割合・ヘッジ側が勝った回数・追加コストは hedge_stats() で返す（フッター表示用）
+
+ストリーミングの差分はキューに積み、呼び出し元のスレッドで on_text を呼ぶ（lib/llm_compare.py と同じ）。
+
+使い方:
+    result = call_hedged(primary, alternate, lambda target, on_text, cancel: ..., on_text=render,
+                         allow=lambda: budget_allows(session_spent_usd, estimate_usd))
+    result["hedge"]  # 待ち時間・ヘッジしたか・勝った側・打ち切った側の usage
+"""
+
+import os
+import queue
+import threading
+import time
+from datetime import date
+
+from lib.llm_router import ttft_percentile
+from lib.llm_stream import CancelToken
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") not in ("0", "false", "False")
+# 直近の TTFT のこの分位点を過ぎても最初のトークンが来なければヘッジを送る
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "10"))
+# 追加コストの予算（USD）。0 ならその予算では制限しない
+SESSION_BUDGET_USD = float(os.getenv("LLM_HEDGE_SESSION_BUDGET_USD", "0.5"))
+DAILY_BUDGET_USD = float(os.getenv("LLM_HEDGE_DAILY_BUDGET_USD", "5"))
+# 勝った側の受信が終わってから、打ち切った側の usage を待つ最大秒数
+LOSER_GRACE_SECONDS = float(os.getenv("LLM_HEDGE_LOSER_GRACE", "0.3"))
+
+_lock = threading.Lock()
+_counters = {
+    "calls": 0,
+    "hedged": 0,
+    "hedge_wins": 0,
+    "skipped_budget": 0,
+    "skipped_no_samples": 0,
+    "skipped_no_alternate": 0,
+    "extra_tokens": 0,
+    "extra_cost_usd": 0.0,
+}
+_daily = {"date": None, "usd": 0.0}
+
+
+def _count(name: str, amount=1) -> None:
+    with _lock:
+        _counters[name] += amount
+
+
+def hedge_delay(deployment_name: str, region: str) -> tuple[float | None, str | None]:
+    """ヘッジを送るまでの待ち時間（秒）。決められなければ (None, 理由)"""
+    value, samples = ttft_percentile(deployment_name, region, HEDGE_PERCENTILE)
+    if value is None or samples < HEDGE_MIN_SAMPLES:
+        return None, "no_samples"
+    return max(HEDGE_MIN_DELAY, value), None
+
+
+def _daily_spent() -> float:
+    """今日の追加コスト（USD）。_lock を保持して呼ぶこと"""
+    today = date.today().isoformat()
+    if _daily["date"] != today:
+        _daily.update(date=today, usd=0.0)
+    return _daily["usd"]
+
+
+def budget_allows(session_spent_usd: float, estimate_usd: float) -> bool:
+    """ヘッジの追加コスト estimate_usd を足してもセッション・1 日の予算に収まるか"""
+    with _lock:
+        daily = _daily_spent()
+    if SESSION_BUDGET_USD and session_spent_usd + estimate_usd > SESSION_BUDGET_USD:
+        return False
+    if DAILY_BUDGET_USD and daily + estimate_usd > DAILY_BUDGET_USD:
+        return False
+    return True
+
+
+def charge(extra_tokens: int, extra_cost_usd: float) -> None:
+    """ヘッジで追加に消費したトークン・コストを計上する"""
+    with _lock:
+        _daily_spent()
+        _daily["usd"] += extra_cost_usd
+        _counters["extra_tokens"] += extra_tokens
+        _counters["extra_cost_usd"] += extra_cost_usd
+
+
+def hedge_stats() -> dict:
+    """ヘッジの回数・割合・勝ち数・追加コストと予算"""
+    with _lock:
+        daily = _daily_spent()
+        calls = _counters["calls"]
+        return {
+            **_counters,
+            "extra_cost_usd": round(_counters["extra_cost_usd"], 6),
+            "hedge_rate": round(_counters["hedged"] / calls, 4) if calls else 0.0,
+            "daily_spent_usd": round(daily, 6),
+            "daily_budget_usd": DAILY_BUDGET_USD,
+            "session_budget_usd": SESSION_BUDGET_USD,
+        }
+
+
+def _loser_record(name: str, branch: dict, prompt_tokens_estimate: int) -> dict:
+    """打ち切った側の記録（usage を受け取れなかった場合は送信したプロンプト分を概算する）"""
+    target = branch["target"]
+    record = {"branch": name, "region": target.get("region", ""), "deployment_name": target.get("deployment_name", "")}
+    result, error = branch["result"], branch["error"]
+    if result is not None:
+        record.update(
+            finish_reason=result["finish_reason"],
+            prompt_tokens=result["prompt_tokens"],
+            completion_tokens=result["completion_tokens"],
+            usage_estimated=result.get("usage_estimated", False),
+        )
+    elif error is not None:
+        # 送信に失敗したリクエストは課金されない
+        record.update(finish_reason="error", prompt_tokens=0, completion_tokens=0, usage_estimated=False,
+                      error=f"{type(error).__name__}: {str(error)[:200]}")
+    else:
+        record.update(finish_reason="cancelled", prompt_tokens=prompt_tokens_estimate, completion_tokens=0,
+                      usage_estimated=True, pending=True)
+    return record
+
+
+def call_hedged(primary: dict, alternate: dict | None, call, *, on_text=None, allow=None,
+                prompt_tokens_estimate: int = 0, cancel: CancelToken | None = None) -> dict:
+    """primary へ call し、最初のトークンが遅ければ alternate へも call して先に応答した方の結果を返す。
+
+    Args:
+        primary / alternate: 呼び出し先（model_info の dict）。alternate が None ならヘッジしない
+        call: call(target, on_text, cancel) -> 結果（lib/llm_providers.py の形式）。cancel は CancelToken
+        on_text: 採用した側のテキスト差分で呼ばれる（呼び出し元のスレッド）
+        allow: ヘッジを送る直前に呼ばれ、False なら送らない（予算の確認）
+        prompt_tokens_estimate: 打ち切った側の usage を受け取れなかったときのプロンプトトークン数
+        cancel: 呼び出し元の CancelToken。取り消すと両方の呼び出しを打ち切る（ヘッジもそれ以降は送らない）
+
+    Returns:
+        採用した結果。result["hedge"] に delay_seconds / hedged / hedge_after_seconds / winner（primary / hedge）/
+        served_region / served_deployment / hedge_region / hedge_deployment / skipped_reason / loser を入れる。
+        いずれも失敗したら primary の例外（primary が成功して後から失敗した hedge の例外は無視する）を送出する。
+    """
+    _count("calls")
+    record = {
+        "delay_seconds": None,
+        "hedged": False,
+        "hedge_after_seconds": None,
+        "winner": "primary",
+        "served_region": primary.get("region", ""),
+        "served_deployment": primary.get("deployment_name", ""),
+        "hedge_region": None,
+        "hedge_deployment": None,
+        "skipped_reason": None,
+        "loser": None,
+    }
+    delay, reason = hedge_delay(primary.get("deployment_name", ""), primary.get("region", ""))
+    if alternate is None:
+        delay, reason = None, "no_alternate"
+    if delay is None:
+        # ヘッジしないときはスレッドを使わずにそのまま呼ぶ
+        _count(f"skipped_{reason}")
+        record["skipped_reason"] = reason
+        result = call(primary, on_text, cancel)
+        result["hedge"] = record
+        return result
+    record["delay_seconds"] = round(delay, 3)
+
+    events = queue.Queue()
+    branches = {}
+    unregister = []
+    started = time.perf_counter()
+
+    def start(name, target):
+        branch_cancel = CancelToken()
+        branches[name] = {"target": target, "cancel": branch_cancel, "done": False, "result": None, "error": None}
+        if cancel is not None:
+            unregister.append(cancel.on_cancel(branch_cancel.cancel))
+
+        def run():
+            try:
+                result = call(target, lambda delta: events.put(("delta", name, delta)), branch_cancel)
+                events.put(("done", name, result, None))
+            except Exception as e:
+                events.put(("done", name, None, e))
+
+        threading.Thread(target=run, name=f"llm-hedge-{name}", daemon=True).start()
+
+    def choose(name):
+        for other, branch in branches.items():
+            if other != name:
+                branch["cancel"].cancel()
+        return name
+
+    try:
+        start("primary", primary)
+        deadline = started + delay
+        winner = None
+        while True:
+            timeout = max(0.0, deadline - time.perf_counter()) if deadline is not None else None
+            try:
+                event = events.get(timeout=timeout)
+            except queue.Empty:
+                deadline = None
+                if cancel is not None and cancel.cancelled:
+                    continue
+                if allow is not None and not allow():
+                    _count("skipped_budget")
+                    record["skipped_reason"] = "budget"
+                    logger.info("call_hedged: 予算を超えるためヘッジしません deployment=%s", primary.get("deployment_name"))
+                    continue
+                _count("hedged")
+                record.update(
+                    hedged=True,
+                    hedge_after_seconds=round(time.perf_counter() - started, 3),
+                    hedge_region=alternate.get("region", ""),
+                    hedge_deployment=alternate.get("deployment_name", ""),
+                )
+                logger.info(
+                    "call_hedged: %s が %.2fs 以内に応答しないため %s へヘッジ deployment=%s",
+                    primary.get("region"), delay, alternate.get("region"), alternate.get("deployment_name"),
+                )
+                start("hedge", alternate)
+                continue
+            kind, name = event[0], event[1]
+            if kind == "delta":
+                if winner is None:
+                    winner = choose(name)
+                    deadline = None
+                if name == winner and on_text is not None:
+                    on_text(event[2])
+                continue
+            branch = branches[name]
+            branch.update(done=True, result=event[2], error=event[3])
+            if winner is None and branch["error"] is None:
+                # テキストを返さずに終わった（空の応答）
+                winner = choose(name)
+                deadline = None
+            if name == winner:
+                break
+            if winner is None and all(b["done"] for b in branches.values()):
+                # 最初のトークンの前にすべて失敗した（ヘッジを送る前の失敗はそのまま再試行・フェイルオーバーへ）
+                raise branches["primary"]["error"]
+
+        result, error = branches[winner]["result"], branches[winner]["error"]
+        if error is not None:
+            raise error
+
+        if record["hedged"]:
+            loser_name = "hedge" if winner == "primary" else "primary"
+            loser = branches[loser_name]
+            grace_deadline = time.perf_counter() + LOSER_GRACE_SECONDS
+            while not loser["done"]:
+                remaining = grace_deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    event = events.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event[0] == "done" and event[1] == loser_name:
+                    loser.update(done=True, result=event[2], error=event[3])
+            record["loser"] = _loser_record(loser_name, loser, prompt_tokens_estimate)
+            if winner == "hedge":
+                _count("hedge_wins")
+                record.update(winner="hedge", served_region=alternate.get("region", ""),
+                              served_deployment=alternate.get("deployment_name", ""))
+            logger.info(
+                "call_hedged: winner=%s (%s), loser=%s finish_reason=%s, extra_tokens=%d",
+                winner, record["served_region"], loser_name, record["loser"]["finish_reason"],
+                record["loser"]["prompt_tokens"] + record["loser"]["completion_tokens"],
+            )
+        result["hedge"] = record
+        return result
+    finally:
+        # 呼び出し元の取り消しに登録した分を外す（この呼び出しの後に取り消しても影響しない）
+        for remove in unregister:
+            remove()
@@ -0,0 +1,237 @@
+"""
+lib/llm_providers.py - LLM プロバイダー（api_type）ごとの呼び出しを 1 つのインターフェースにまとめる
+
+config/deployment_models.json の providers[].api_type ごとに LLMProvider のサブクラスを登録し、
+チャット・モデル比較・会話履歴の要約・セッション名の生成はすべて get_provider(model_info, api_key) 経由で呼ぶ。
+クライアントの取得（lib/llm_clients.py）、メッセージ列の変換（Anthropic は system を分離して
+プロンプトキャッシュのブレークポイントを付ける）、ストリーミングの受信と usage・finish_reason の
+取り出し（lib/llm_stream.py）はプロバイダー側で行い、結果はどのプロバイダーでも同じ形式の dict で返す:
+
+- text / finish_reason / model / response_id
+- prompt_tokens / completion_tokens / total_tokens / cache_read_tokens / cache_creation_tokens
+- elapsed_seconds / ttft_seconds / decode_seconds / decode_tokens_per_second
+- usage_estimated（取り消して usage を受け取れなかった場合に True）/ api_type / deployment_name
+
+complete() は同期版、acomplete() は非同期版（AsyncAnthropic / AsyncAzureOpenAI）で、引数と結果は同じ。
+新しい api_type は LLMProvider を継承したクラスを @register_provider で登録すれば画面側の変更なしで使える
+（表示名は label、リージョンのどのエンドポイントを使うかは endpoint_field、temperature を送るかは
+uses_temperature、プロンプトキャッシュの単価の倍率は cache_price_ratios で指定する）。
+
+使い方:
+    provider = get_provider(model_info, api_key)
+    result = provider.complete(messages, max_tokens=1024, temperature=0.7, on_text=render)
+    result = await provider.acomplete(messages, max_tokens=64)
+"""
+
+import os
+
+from lib.llm_clients import (
+    get_anthropic_client,
+    get_async_anthropic_client,
+    get_async_openai_client,
+    get_openai_client,
+)
+from lib.llm_stream import (
+    add_cache_breakpoints,
+    astream_anthropic_message,
+    astream_openai_chat,
+    stream_anthropic_message,
+    stream_openai_chat,
+)
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+# model_info に api_version が無いときの Azure OpenAI の API バージョン
+DEFAULT_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-12-01-preview")
+
+_providers: dict[str, type["LLMProvider"]] = {}
+
+
+def register_provider(cls: type["LLMProvider"]) -> type["LLMProvider"]:
+    """api_type に対応するプロバイダーを登録する（クラスデコレーター）"""
+    _providers[cls.api_type] = cls
+    return cls
+
+
+def provider_class(api_type: str) -> type["LLMProvider"]:
+    """api_type に対応するプロバイダーのクラス。登録されていなければ ValueError"""
+    cls = _providers.get(api_type)
+    if cls is None:
+        raise ValueError(f"api_type '{api_type}' のプロバイダーは登録されていません（登録済み: {', '.join(_providers)}）")
+    return cls
+
+
+def registered_api_types() -> list[str]:
+    return list(_providers)
+
+
+def get_provider(target: dict, api_key: str) -> "LLMProvider":
+    """model_info（target）の model_type に対応するプロバイダーを返す"""
+    return provider_class(target.get("model_type", "openai"))(target, api_key)
+
+
+class LLMProvider:
+    """プロバイダーの共通インターフェース。サブクラスは client / async_client / _stream / _astream を実装する"""
+
+    api_type = ""
+    label = ""
+    # リージョン情報（REGIONS の値）のどのエンドポイントを使うか（無ければ "endpoint"）
+    endpoint_field = "endpoint"
+    # temperature を送るか（送らないプロバイダーでは complete() の temperature を無視する）
+    uses_temperature = True
+    # プロンプトキャッシュの単価（入力単価に対する倍率）
+    cache_price_ratios = {"read": 1.0, "write": 1.0}
+
+    def __init__(self, target: dict, api_key: str):
+        self.target = target
+        self.api_key = api_key
+        self.deployment_name = target.get("deployment_name", "")
+        self.endpoint = target.get("endpoint", "")
+
+    @classmethod
+    def endpoint_for(cls, region_info: dict) -> str:
+        """リージョン情報からこのプロバイダーで使うエンドポイントを選ぶ"""
+        return region_info.get(cls.endpoint_field) or region_info.get("endpoint", "")
+
+    def client(self):
+        raise NotImplementedError
+
+    def async_client(self):
+        raise NotImplementedError
+
+    def _stream(self, client, messages: list, max_tokens: int, temperature, on_text, prompt_cache: bool,
+                cancel=None) -> dict:
+        raise NotImplementedError
+
+    async def _astream(self, client, messages: list, max_tokens: int, temperature, on_text, prompt_cache: bool,
+                       cancel=None) -> dict:
+        raise NotImplementedError
+
+    @staticmethod
+    def _with_options(client, timeout: float | None, max_retries: int | None):
+        options = {}
+        if timeout is not None:
+            options["timeout"] = timeout
+        if max_retries is not None:
+            options["max_retries"] = max_retries
+        return client.with_options(**options) if options else client
+
+    def _finish(self, result: dict) -> dict:
+        result.update(api_type=self.api_type, deployment_name=self.deployment_name)
+        logger.debug(
+            "%s: 完了 deployment=%s, response_id=%s, prompt_tokens=%d, completion_tokens=%d, "
+            "finish_reason=%s, elapsed=%.3fs",
+            type(self).__name__, self.deployment_name, result["response_id"], result["prompt_tokens"],
+            result["completion_tokens"], result["finish_reason"], result["elapsed_seconds"],
+        )
+        return result
+
+    def complete(
+        self, messages: list, *, max_tokens: int, temperature: float | None = None, on_text=None,
+        timeout: float | None = None, max_retries: int | None = None, prompt_cache: bool = True, cancel=None,
+    ) -> dict:
+        """messages（OpenAI 形式のメッセージ列）をストリーミングで送り、正規化した結果の dict を返す。
+
+        Args:
+            max_tokens: 最大出力トークン数
+            temperature: uses_temperature のプロバイダーだけに送る（None ならモデルの既定値）
+            on_text: テキスト差分を受け取るたびに on_text(delta) で呼ばれる
+            timeout: 秒（None ならクライアントの既定値）
+            max_retries: SDK の自動再試行回数（None なら SDK の既定値。call_with_failover で再試行する場合は 0）
+            prompt_cache: プロンプトキャッシュのブレークポイントを付けるか（対応するプロバイダーのみ）
+            cancel: lib/llm_stream.py の CancelToken。取り消すと受信中のストリームを閉じ、
+                それまでのテキストを finish_reason="cancelled" で返す
+        """
+        client = self._with_options(self.client(), timeout, max_retries)
+        temperature = temperature if self.uses_temperature else None
+        return self._finish(self._stream(client, messages, max_tokens, temperature, on_text, prompt_cache, cancel))
+
+    async def acomplete(
+        self, messages: list, *, max_tokens: int, temperature: float | None = None, on_text=None,
+        timeout: float | None = None, max_retries: int | None = None, prompt_cache: bool = True, cancel=None,
+    ) -> dict:
+        """complete() の非同期版（引数・結果は同じ）"""
+        client = self._with_options(self.async_client(), timeout, max_retries)
+        temperature = temperature if self.uses_temperature else None
+        return self._finish(
+            await self._astream(client, messages, max_tokens, temperature, on_text, prompt_cache, cancel)
+        )
+
+
+@register_provider
+class AnthropicProvider(LLMProvider):
+    """Anthropic Messages API（Claude 系）"""
+
+    api_type = "anthropic"
+    label = "Anthropic"
+    endpoint_field = "anthropic_endpoint"
+    # 従来どおり temperature は送らない（モデルの既定値）
+    uses_temperature = False
+    # 読み出し 0.1 倍・書き込み 1.25 倍
+    cache_price_ratios = {"read": 0.1, "write": 1.25}
+
+    def client(self):
+        return get_anthropic_client(self.endpoint, self.api_key)
+
+    def async_client(self):
+        return get_async_anthropic_client(self.endpoint, self.api_key)
+
+    @staticmethod
+    def _request(messages: list, prompt_cache: bool) -> tuple:
+        """system メッセージを分離し、必要ならプロンプトキャッシュのブレークポイントを付ける"""
+        system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+        dialogue = [m for m in messages if m["role"] != "system"]
+        if prompt_cache:
+            # system プロンプトと前のターンまでの履歴をプロンプトキャッシュに載せる
+            return add_cache_breakpoints(system, dialogue)
+        return system, dialogue
+
+    def _stream(self, client, messages, max_tokens, temperature, on_text, prompt_cache, cancel=None):
+        system, dialogue = self._request(messages, prompt_cache)
+        return stream_anthropic_message(
+            client, model=self.deployment_name, max_tokens=max_tokens, system=system, messages=dialogue,
+            on_text=on_text, cancel=cancel,
+        )
+
+    async def _astream(self, client, messages, max_tokens, temperature, on_text, prompt_cache, cancel=None):
+        system, dialogue = self._request(messages, prompt_cache)
+        return await astream_anthropic_message(
+            client, model=self.deployment_name, max_tokens=max_tokens, system=system, messages=dialogue,
+            on_text=on_text, cancel=cancel,
+        )
+
+
+@register_provider
+class OpenAIProvider(LLMProvider):
+    """Azure OpenAI Chat Completions（GPT 系）。プロンプトキャッシュはサービス側で自動"""
+
+    api_type = "openai"
+    label = "OpenAI"
+    # 読み出し 0.5 倍（書き込みの割増なし）
+    cache_price_ratios = {"read": 0.5, "write": 1.0}
+
+    def __init__(self, target: dict, api_key: str):
+        super().__init__(target, api_key)
+        self.api_version = target.get("api_version") or DEFAULT_API_VERSION
+
+    def client(self):
+        return get_openai_client(self.endpoint, self.api_key, self.api_version)
+
+    def async_client(self):
+        return get_async_openai_client(self.endpoint, self.api_key, self.api_version)
+
+    def _stream(self, client, messages, max_tokens, temperature, on_text, prompt_cache, cancel=None):
+        return stream_openai_chat(
+            client, model=self.deployment_name, messages=messages, max_completion_tokens=max_tokens,
+            temperature=temperature, on_text=on_text, cancel=cancel,
+        )
+
+    async def _astream(self, client, messages, max_tokens, temperature, on_text, prompt_cache, cancel=None):
+        return await astream_openai_chat(
+            client, model=self.deployment_name, messages=messages, max_completion_tokens=max_tokens,
+            temperature=temperature, on_text=on_text, cancel=cancel,
+        )
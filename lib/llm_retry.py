@@ -0,0 +1,214 @@
+"""
+lib/llm_retry.py - LLM 呼び出しの再試行とリージョン間フェイルオーバー
+
+429 / 5xx / タイムアウト / 接続エラーなど一時的な失敗は、指数バックオフ（フルジッター）で
+同じデプロイに再試行する。応答に Retry-After（retry-after-ms / retry-after）があればその時間を待つ。
+再試行し尽くしたら（または Retry-After が長すぎる・認証やデプロイ不在などリージョン固有の失敗なら）、
+同じモデルを提供する次のリージョンのデプロイへ切り替える。
+
+- 各試行（リージョン・デプロイ・所要時間・エラー種別・HTTP ステータス・待ち時間）を記録する
+- 成功時は (結果, 記録) を返す。記録には応答したリージョンと、再試行・切り替えで増えた時間を含む
+- すべて失敗したら RetryExhaustedError（attempts と最後の例外を保持）を送出する
+- 400 などリクエスト自体の誤りは再試行も切り替えもせずに打ち切る
+
+SDK 側の自動再試行と二重にならないよう、呼び出し側はクライアントを max_retries=0 で使う。
+
+使い方:
+    result, record = call_with_failover([model_info, *equivalents], call)
+"""
+
+import email.utils
+import os
+import random
+import time
+
+import anthropic
+import httpx
+import openai
+
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+# 1 つのデプロイに対する最大試行回数（初回を含む）
+MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))
+# バックオフの基準値と上限（秒）
+BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+# Retry-After がこれより長ければ待たずに次のリージョンへ切り替える（秒）
+MAX_RETRY_AFTER = float(os.getenv("LLM_RETRY_AFTER_MAX", "30"))
+
+# 同じデプロイに再試行する HTTP ステータス
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+# 再試行はせず、すぐ別リージョンへ切り替える HTTP ステータス（キー・デプロイがリージョン固有のため）
+FAILOVER_STATUS = {401, 403, 404}
+# ストリーム途中のエラーイベント（HTTP 200 で届く）のうち再試行するもの
+RETRYABLE_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error", "server_error", "timeout"}
+
+_CONNECTION_ERRORS = (openai.APIConnectionError, anthropic.APIConnectionError, httpx.TransportError)
+
+
+class RetryExhaustedError(Exception):
+    """すべての試行（再試行・フェイルオーバー含む）が失敗した"""
+
+    def __init__(self, attempts: list, last_error: Exception):
+        self.attempts = attempts
+        self.last_error = last_error
+        regions = sorted({a["region"] for a in attempts})
+        super().__init__(
+            f"{len(attempts)} 回試行して失敗 ({', '.join(regions)}): {type(last_error).__name__}: {last_error}"
+        )
+
+
+# ========================================
+# エラー分類
+# ========================================
+def _error_type(exc: Exception) -> str | None:
+    """API エラー本文の error.type（ストリーム中のエラーイベント用）"""
+    body = getattr(exc, "body", None)
+    if isinstance(body, dict):
+        error = body.get("error", body)
+        if isinstance(error, dict):
+            return error.get("type")
+    return None
+
+
+def status_code(exc: Exception) -> int | None:
+    return getattr(exc, "status_code", None)
+
+
+def classify_error(exc: Exception) -> str:
+    """例外を "retry"（同じデプロイに再試行）/ "failover"（次のリージョンへ）/ "fatal"（打ち切り）に分類する"""
+    if isinstance(exc, _CONNECTION_ERRORS):
+        return "retry"
+    # クライアント側で送信前に止めたもの（lib/rate_limiter.py の RateLimitQueuedError）は待たずに次のリージョンへ
+    if getattr(exc, "local", False):
+        return "failover"
+    status = status_code(exc)
+    if status in RETRYABLE_STATUS or (status is not None and status >= 500):
+        return "retry"
+    if status in FAILOVER_STATUS:
+        return "failover"
+    # HTTP 200 で始まったストリームの途中で届いたエラーイベントは本文の種別で判断する
+    if (status is None or status < 400) and _error_type(exc) in RETRYABLE_ERROR_TYPES:
+        return "retry"
+    return "fatal"
+
+
+def retry_after_seconds(exc: Exception) -> float | None:
+    """応答ヘッダーの retry-after-ms / retry-after（秒数または HTTP 日付）を秒で返す"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+    except ValueError:
+        pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """attempt 回目（1 始まり）の失敗後に待つ秒数。Retry-After があればそれを優先する"""
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** (attempt - 1))))
+
+
+# ========================================
+# 呼び出し
+# ========================================
+def call_with_failover(targets: list, call, *, on_retry=None, sleep=time.sleep):
+    """targets（model_info の dict）を先頭から順に、再試行しながら call(target) を呼び出す。
+
+    Args:
+        targets: 先頭が本来のデプロイ、以降が同じモデルを提供する別リージョンのデプロイ
+        call: call(target) -> 結果。例外は classify_error() で分類する
+        on_retry: 次の試行の前に on_retry(attempt_record, next_target, wait_seconds) で呼ばれる
+
+    Returns:
+        (結果, 記録)。記録は attempts（試行ごとの dict）/ served_region / served_deployment /
+        failover（別リージョンで応答したか）/ retries / added_latency_seconds の dict。
+
+    Raises:
+        RetryExhaustedError: すべての試行が失敗した（fatal なエラーの場合はその時点で打ち切る）
+    """
+    attempts = []
+    started = time.perf_counter()
+    index, attempt = 0, 1
+    while True:
+        target = targets[index]
+        attempt_started = time.perf_counter()
+        try:
+            result = call(target)
+        except Exception as e:
+            kind = classify_error(e)
+            retry_after = retry_after_seconds(e)
+            record = {
+                "region": target.get("region", ""),
+                "deployment_name": target.get("deployment_name", ""),
+                "attempt": attempt,
+                "elapsed_seconds": round(time.perf_counter() - attempt_started, 3),
+                "error_type": type(e).__name__,
+                "status_code": status_code(e),
+                "error_message": str(e)[:300],
+                "action": kind,  # retry / failover / abort
+                "wait_seconds": 0.0,
+                "local": getattr(e, "local", False),  # 送信前にクライアント側で止めた
+            }
+            attempts.append(record)
+            if kind == "retry" and attempt < MAX_ATTEMPTS and (retry_after is None or retry_after <= MAX_RETRY_AFTER):
+                wait = backoff_delay(attempt, retry_after)
+                attempt += 1
+            elif kind != "fatal" and index + 1 < len(targets):
+                record["action"] = "failover"
+                wait = 0.0
+                index, attempt = index + 1, 1
+            else:
+                record["action"] = "abort"
+                logger.warning(
+                    "call_with_failover: 打ち切り region=%s, deployment=%s, attempt=%d, error=%s, status=%s",
+                    record["region"], record["deployment_name"], record["attempt"], record["error_type"],
+                    record["status_code"],
+                )
+                raise RetryExhaustedError(attempts, e) from e
+            record["wait_seconds"] = round(wait, 3)
+            logger.warning(
+                "call_with_failover: 失敗 region=%s, deployment=%s, attempt=%d, error=%s, status=%s -> %s "
+                "(next_region=%s, wait=%.2fs)",
+                record["region"], record["deployment_name"], record["attempt"], record["error_type"],
+                record["status_code"], record["action"], targets[index].get("region"), wait,
+            )
+            if on_retry is not None:
+                on_retry(record, targets[index], wait)
+            if wait > 0:
+                sleep(wait)
+            continue
+        added_latency = attempt_started - started
+        if attempts:
+            logger.info(
+                "call_with_failover: 成功 region=%s, deployment=%s（%d 回失敗、追加遅延 %.2fs）",
+                target.get("region"), target.get("deployment_name"), len(attempts), added_latency,
+            )
+        return result, {
+            "attempts": attempts,
+            "served_region": target.get("region", ""),
+            "served_deployment": target.get("deployment_name", ""),
+            "failover": index > 0,
+            "retries": len(attempts),
+            "added_latency_seconds": round(added_latency, 3),
+        }
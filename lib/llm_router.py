@@ -0,0 +1,221 @@
+"""
+lib/llm_router.py - 実測レイテンシに基づくリージョンの振り分け
+
+(デプロイ名, リージョン) ごとに、毎ターンの TTFT・応答時間とエラーを記録し、
+EWMA（指数加重移動平均）と直近 ROUTER_WINDOW 件の p50 / p95 を保持する（プロセス内で共有）。
+
+- route(): セッションの振り分けモードに応じて、呼び出し先の候補を並べ替える
+  - "pinned": セッション作成時のリージョンを先頭に固定（従来どおり。以降はフェイルオーバー先）
+  - "auto": エラー率の低い（健全な）候補を優先し、その中で TTFT の EWMA が小さい順に並べる。
+    未計測・長く使っていない候補は ROUTER_EXPLORE_RATE の確率で先頭にして計測し直す
+- record_success() / record_attempts(): 応答と失敗した試行（lib/llm_retry.py の記録）を統計に反映する
+- router_stats(): 候補ごとの統計（フッター表示用）
+- ttft_percentile(): 直近の TTFT の分位点（lib/llm_hedge.py がヘッジを送るまでの待ち時間に使う）
+
+使い方:
+    targets, decision = route([model_info, *equivalents], mode)
+    result, record = call_with_failover(targets, call)
+    record_success(..., ttft=result["ttft_seconds"], total=result["elapsed_seconds"])
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+ROUTING_MODES = ("pinned", "auto")
+DEFAULT_ROUTING_MODE = "pinned"
+
+_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.3"))
+_WINDOW = int(os.getenv("ROUTER_WINDOW", "100"))
+_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", "0.05"))
+# この秒数以上計測していない候補は「未計測」とみなして計測し直す対象にする
+_STALE_SECONDS = float(os.getenv("ROUTER_STALE_SECONDS", "600"))
+# エラー率（EWMA）がこれ以上の候補は不健全として後回しにする
+_UNHEALTHY_ERROR_RATE = 0.5
+# エラー率をスコア（秒）に上乗せする係数: score = ewma_ttft * (1 + _ERROR_PENALTY * error_rate)
+_ERROR_PENALTY = 4.0
+
+_stats: dict[tuple, dict] = {}
+_stats_lock = threading.Lock()
+
+
+def _entry(deployment_name: str, region: str) -> dict:
+    """統計エントリを返す（無ければ作る）。_stats_lock を保持して呼ぶこと"""
+    key = (deployment_name, region)
+    entry = _stats.get(key)
+    if entry is None:
+        entry = _stats[key] = {
+            "ewma_ttft": None,
+            "ewma_total": None,
+            "error_rate": 0.0,
+            "ttft": deque(maxlen=_WINDOW),
+            "total": deque(maxlen=_WINDOW),
+            "successes": 0,
+            "errors": 0,
+            "updated_at": None,
+        }
+    return entry
+
+
+def _ewma(previous: float | None, value: float) -> float:
+    return value if previous is None else _ALPHA * value + (1 - _ALPHA) * previous
+
+
+def _percentile(values, q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+# ========================================
+# 計測値の記録
+# ========================================
+def record_success(deployment_name: str, region: str, *, ttft: float, total: float) -> None:
+    """応答が得られたターンの TTFT・応答時間（秒）を記録する"""
+    with _stats_lock:
+        entry = _entry(deployment_name, region)
+        entry["ewma_ttft"] = _ewma(entry["ewma_ttft"], ttft)
+        entry["ewma_total"] = _ewma(entry["ewma_total"], total)
+        entry["error_rate"] = _ewma(entry["error_rate"], 0.0)
+        entry["ttft"].append(ttft)
+        entry["total"].append(total)
+        entry["successes"] += 1
+        entry["updated_at"] = time.time()
+
+
+def record_failure(deployment_name: str, region: str) -> None:
+    """失敗した試行を記録する（エラー率の EWMA を上げる）"""
+    with _stats_lock:
+        entry = _entry(deployment_name, region)
+        entry["error_rate"] = _ewma(entry["error_rate"], 1.0)
+        entry["errors"] += 1
+        entry["updated_at"] = time.time()
+
+
+def record_attempts(attempts: list) -> None:
+    """lib/llm_retry.py の試行記録のうち、失敗した試行をすべて記録する（送信前に止めたものは除く）"""
+    for attempt in attempts:
+        if attempt.get("local"):
+            continue
+        record_failure(attempt.get("deployment_name", ""), attempt.get("region", ""))
+
+
+# ========================================
+# 振り分け
+# ========================================
+def _snapshot(deployment_name: str, region: str, now: float) -> dict:
+    """候補 1 件の統計（スコア計算用）。_stats_lock を保持して呼ぶこと"""
+    entry = _stats.get((deployment_name, region))
+    if entry is None:
+        return {"samples": 0, "error_rate": 0.0, "score": None, "stale": True}
+    stale = now - entry["updated_at"] > _STALE_SECONDS
+    if entry["ewma_ttft"] is None:
+        return {"samples": 0, "error_rate": round(entry["error_rate"], 3), "score": None, "stale": stale}
+    score = entry["ewma_ttft"] * (1 + _ERROR_PENALTY * entry["error_rate"])
+    return {
+        "samples": len(entry["ttft"]),
+        "ewma_ttft": round(entry["ewma_ttft"], 3),
+        "ewma_total": round(entry["ewma_total"], 3),
+        "p50_ttft": round(_percentile(entry["ttft"], 0.5), 3),
+        "p95_ttft": round(_percentile(entry["ttft"], 0.95), 3),
+        "error_rate": round(entry["error_rate"], 3),
+        "score": round(score, 3),
+        "stale": stale,
+    }
+
+
+def route(candidates: list, mode: str = DEFAULT_ROUTING_MODE) -> tuple[list, dict]:
+    """候補（先頭がセッションのデプロイ）を呼び出し順に並べ替え、(並べ替えた候補, 判断の記録) を返す。
+
+    判断の記録は mode / reason / chosen_region / chosen_deployment と、候補ごとの統計の dict。
+    reason は pinned / only_candidate / fastest / explore / no_data のいずれか。
+    """
+    now = time.time()
+    with _stats_lock:
+        snapshots = [_snapshot(c.get("deployment_name", ""), c.get("region", ""), now) for c in candidates]
+
+    if mode != "auto" or len(candidates) <= 1:
+        ordered = list(range(len(candidates)))
+        reason = "pinned" if mode != "auto" else "only_candidate"
+    else:
+        def key(i):
+            snap = snapshots[i]
+            unhealthy = snap["error_rate"] >= _UNHEALTHY_ERROR_RATE
+            # 未計測は計測済みより後ろ（同順位なら元の順 = セッションのリージョン優先）
+            return (unhealthy, snap["score"] is None, snap["score"] or 0.0, i)
+
+        ordered = sorted(range(len(candidates)), key=key)
+        reason = "fastest" if snapshots[ordered[0]]["score"] is not None else "no_data"
+        # 未計測の健全な候補は一度計測する。しばらく使っていない候補（不健全だったものの回復確認を含む）は
+        # ROUTER_EXPLORE_RATE の確率で計測し直す
+        unmeasured = [i for i in ordered[1:]
+                      if snapshots[i]["score"] is None and snapshots[i]["error_rate"] < _UNHEALTHY_ERROR_RATE]
+        stale = [i for i in ordered[1:] if snapshots[i]["stale"]]
+        probe = unmeasured[0] if unmeasured and reason == "fastest" else None
+        if probe is None and stale and random.random() < _EXPLORE_RATE:
+            probe = stale[0]
+        if probe is not None:
+            ordered.remove(probe)
+            ordered.insert(0, probe)
+            reason = "explore"
+
+    chosen = candidates[ordered[0]]
+    decision = {
+        "mode": mode,
+        "reason": reason,
+        "chosen_region": chosen.get("region", ""),
+        "chosen_deployment": chosen.get("deployment_name", ""),
+        "candidates": [
+            {"region": candidates[i].get("region", ""), "deployment_name": candidates[i].get("deployment_name", ""),
+             **{k: v for k, v in snapshots[i].items() if k != "stale"}}
+            for i in ordered
+        ],
+    }
+    if mode == "auto":
+        logger.info(
+            "route: %s -> %s (reason=%s, candidates=%s)",
+            candidates[0].get("region"), decision["chosen_region"], reason,
+            [(c["region"], c["score"]) for c in decision["candidates"]],
+        )
+    return [candidates[i] for i in ordered], decision
+
+
+def ttft_percentile(deployment_name: str, region: str, q: float) -> tuple[float | None, int]:
+    """直近 ROUTER_WINDOW 件の TTFT の q 分位点（秒）と件数。計測が無ければ (None, 0)"""
+    with _stats_lock:
+        entry = _stats.get((deployment_name, region))
+        samples = list(entry["ttft"]) if entry else []
+    return _percentile(samples, q), len(samples)
+
+
+def router_stats() -> list[dict]:
+    """(デプロイ名, リージョン) ごとの統計（EWMA・p50 / p95・件数・エラー率）のリスト"""
+    with _stats_lock:
+        items = [(key, dict(entry, ttft=list(entry["ttft"]), total=list(entry["total"])))
+                 for key, entry in _stats.items()]
+    stats = []
+    for (deployment_name, region), entry in sorted(items):
+        stats.append({
+            "deployment_name": deployment_name,
+            "region": region,
+            "ewma_ttft": entry["ewma_ttft"],
+            "ewma_total": entry["ewma_total"],
+            "p50_ttft": _percentile(entry["ttft"], 0.5),
+            "p95_ttft": _percentile(entry["ttft"], 0.95),
+            "p50_total": _percentile(entry["total"], 0.5),
+            "p95_total": _percentile(entry["total"], 0.95),
+            "successes": entry["successes"],
+            "errors": entry["errors"],
+            "error_rate": entry["error_rate"],
+        })
+    return stats
@@ -0,0 +1,508 @@
+"""
+lib/llm_stream.py - Anthropic / Azure OpenAI のストリーミング応答の受信
+
+チャット送信時の API 呼び出しをストリーミングで行い、テキストの差分を受け取るたびに
+コールバックへ渡す（画面の AI メッセージをその場で更新するため）。受信完了後は
+最終テキスト・usage・finish_reason と、次の時間指標をまとめた dict を返す。
+
+- ttft_seconds: リクエスト送信から最初のテキスト差分を受け取るまで（キュー待ち + prefill）
+- decode_seconds: 最初の差分から受信完了まで
+- decode_tokens_per_second: (completion_tokens - 1) / decode_seconds（生成速度のみ）
+- elapsed_seconds: リクエスト送信から受信完了まで
+
+prompt_tokens はキャッシュから読んだ分・キャッシュに書いた分を含むプロンプト全体のトークン数で、
+その内訳を cache_read_tokens / cache_creation_tokens として返す（Anthropic のプロンプトキャッシュ、
+Azure OpenAI の自動キャッシュ）。Anthropic へ送る前に add_cache_breakpoints() で cache_control を付ける。
+
+非同期クライアント（AsyncAnthropic / AsyncAzureOpenAI）用に astream_anthropic_message /
+astream_openai_chat も用意している（同じ形式の dict を返す）。
+
+cancel に CancelToken を渡すと、別のスレッドから cancel() したときに受信中のストリーム（接続）を閉じて
+打ち切り、それまでに受け取ったテキストを finish_reason="cancelled" の結果として返す。usage を受け取る前に
+打ち切った場合は、送信したメッセージ列と受け取ったテキストからトークン数を概算する（usage_estimated=True）。
+run_in_worker() は呼び出しを別スレッドで実行し、呼び出し元のスレッドを画面の更新と取り消しの確認に空けておく。
+同期版は応答ヘッダーを受け取るまでストリームを閉じられないため、取り消してから cancel_grace 秒たっても
+呼び出しが終わらなければ、待つのをやめて WorkerAbandonedError を送出する（呼び出しは裏で打ち切られる）。
+
+使い方:
+    result = stream_openai_chat(client, model=..., messages=..., on_text=lambda delta: ...)
+    result = await astream_openai_chat(async_client, model=..., messages=..., on_text=...)
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import time
+
+from lib.logger import get_logger
+from lib.rate_limiter import estimate_tokens
+
+logger = get_logger(__name__)
+
+# Anthropic のプロンプトキャッシュ（cache_control のブレークポイント）を付けるか
+ANTHROPIC_PROMPT_CACHE = os.getenv("ANTHROPIC_PROMPT_CACHE", "1") not in ("0", "false", "False")
+_EPHEMERAL = {"type": "ephemeral"}
+
+
+def _cached_blocks(content) -> list:
+    """メッセージの content を、末尾のブロックに cache_control を付けたブロック列にする"""
+    blocks = [{"type": "text", "text": content}] if isinstance(content, str) else [dict(b) for b in content]
+    blocks[-1] = {**blocks[-1], "cache_control": _EPHEMERAL}
+    return blocks
+
+
+def add_cache_breakpoints(system: str, messages: list) -> tuple:
+    """Anthropic へ送る system / messages にプロンプトキャッシュのブレークポイントを付ける（元の list は変更しない）。
+
+    ブレークポイントは最大 3 つ:
+    - system プロンプト（毎ターン同じ）
+    - 最新のユーザー入力の直前のメッセージ（前のターンまでの会話 = 変わらない最長の接頭辞）
+    - 最新のユーザー入力（次のターンでこのターンまでの接頭辞をキャッシュから読めるように書き込む）
+    キャッシュの最小長に満たない部分は API 側で無視される（エラーにはならない）。
+    """
+    if not ANTHROPIC_PROMPT_CACHE:
+        return system, messages
+    system_blocks = [{"type": "text", "text": system, "cache_control": _EPHEMERAL}] if system else system
+    messages = list(messages)
+    for index in {len(messages) - 2, len(messages) - 1}:
+        if index >= 0 and messages[index].get("content"):
+            messages[index] = {**messages[index], "content": _cached_blocks(messages[index]["content"])}
+    return system_blocks, messages
+
+
+def _result(text: str, started: float, first_token_at: float | None, finished: float, **fields) -> dict:
+    """受信結果と時間指標をまとめる"""
+    elapsed = finished - started
+    ttft = (first_token_at - started) if first_token_at is not None else elapsed
+    decode = finished - first_token_at if first_token_at is not None else 0.0
+    completion_tokens = fields.get("completion_tokens") or 0
+    return {
+        "text": text,
+        "usage_estimated": False,
+        **fields,
+        "elapsed_seconds": elapsed,
+        "ttft_seconds": ttft,
+        "decode_seconds": decode,
+        # 最初のトークン自体は TTFT 側に含まれるため、残りのトークン数で割る
+        "decode_tokens_per_second": (completion_tokens - 1) / decode if decode > 0 and completion_tokens > 1 else 0.0,
+    }
+
+
+class CancelToken:
+    """生成の取り消し。cancel() すると登録済みのクローズ処理（ストリーム・接続を閉じる）を呼ぶ（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._closers = []
+        self.cancelled_at = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_at is not None
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self.cancelled_at is not None:
+                return
+            self.cancelled_at = time.time()
+            closers, self._closers = self._closers, []
+        for closer in closers:
+            try:
+                closer()
+            except Exception:
+                logger.debug("CancelToken: クローズ処理で例外", exc_info=True)
+
+    def on_cancel(self, closer):
+        """取り消されたときに closer() を呼ぶ（すでに取り消されていればすぐ呼ぶ）。登録を外す関数を返す"""
+        with self._lock:
+            if self.cancelled_at is None:
+                self._closers.append(closer)
+                return lambda: self._discard(closer)
+        closer()
+        return lambda: None
+
+    def _discard(self, closer) -> None:
+        with self._lock:
+            if closer in self._closers:
+                self._closers.remove(closer)
+
+
+class WorkerAbandonedError(Exception):
+    """取り消した後も呼び出しが終わらないため、run_in_worker() が待つのをやめた"""
+
+    def __init__(self, grace: float):
+        self.grace = grace
+        super().__init__(f"生成を停止しました（応答の受信前に停止し、{grace:g} 秒待っても終わらないため打ち切り）")
+
+
+def run_in_worker(call, *, on_idle=None, idle_interval: float = 0.5,
+                  cancel: CancelToken | None = None, cancel_grace: float = 1.0):
+    """call(post) を別スレッドで実行し、呼び出し元のスレッドで終わるのを待って結果を返す（例外もそのまま送出する）。
+
+    ワーカーが post(fn, *args) で渡した関数は呼び出し元のスレッドで順に呼ぶ（画面の更新など）。
+    idle_interval 秒の間に何も届かなければ on_idle(経過秒数) を呼ぶ。Streamlit では画面の操作（⏹ 停止など）が
+    スクリプトスレッドの st.* 呼び出しの時点で届くため、最初のトークンを待つ間もそこで取り消しに気付ける。
+    cancel が取り消されてから cancel_grace 秒たっても終わらなければ WorkerAbandonedError を送出する。
+    """
+    events = queue.Queue()
+
+    def post(fn, *args):
+        events.put(("call", fn, args))
+
+    def run():
+        try:
+            events.put(("done", call(post), None))
+        except Exception as e:
+            events.put(("done", None, e))
+
+    started = time.perf_counter()
+    abandon_at = None
+    threading.Thread(target=run, name="llm-worker", daemon=True).start()
+    while True:
+        timeout = idle_interval
+        if cancel is not None and cancel.cancelled:
+            if abandon_at is None:
+                abandon_at = time.perf_counter() + cancel_grace
+            timeout = max(0.0, min(timeout, abandon_at - time.perf_counter()))
+        try:
+            kind, value, extra = events.get(timeout=timeout)
+        except queue.Empty:
+            if abandon_at is not None and time.perf_counter() >= abandon_at:
+                logger.warning("run_in_worker: 取り消し後 %gs たっても終わらないため待つのをやめます", cancel_grace)
+                raise WorkerAbandonedError(cancel_grace) from None
+            if on_idle is not None:
+                on_idle(time.perf_counter() - started)
+            continue
+        if kind == "call":
+            value(*extra)
+            continue
+        if extra is not None:
+            raise extra
+        return value
+
+
+def _cancel_task_on(cancel: CancelToken | None):
+    """非同期版: 取り消されたら実行中のタスクを取り消す（別スレッドからの cancel() にも対応）。登録を外す関数を返す"""
+    if cancel is None:
+        return lambda: None
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    return cancel.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+
+
+class _Receiver:
+    """受信したテキスト差分を溜め、最初の差分を受け取った時刻を記録する"""
+
+    def __init__(self, name: str, on_text=None, cancel: CancelToken | None = None):
+        self.name = name
+        self.on_text = on_text
+        self.cancel = cancel
+        self.parts: list[str] = []
+        self.first_token_at = None
+        self.started = time.perf_counter()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.cancelled
+
+    def text(self, delta: str | None) -> None:
+        if not delta or self.cancelled:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            logger.debug("%s: 最初のトークン ttft=%.3fs", self.name, self.first_token_at - self.started)
+        self.parts.append(delta)
+        if self.on_text is not None:
+            self.on_text(delta)
+
+    def result(self, **fields) -> dict:
+        return _result("".join(self.parts), self.started, self.first_token_at, time.perf_counter(), **fields)
+
+    def cancelled_result(self, model: str, prompt_tokens: int | None, *, sent: bool = True, **known) -> dict:
+        """打ち切った時点の結果。usage が無い分は概算する（送信前に打ち切ったならプロンプトも 0）"""
+        text = "".join(self.parts)
+        estimated = prompt_tokens is None or known.get("completion_tokens") is None
+        if prompt_tokens is None:
+            prompt_tokens = known.pop("prompt_estimate", 0) if sent else 0
+        known.pop("prompt_estimate", None)
+        completion_tokens = known.pop("completion_tokens", None)
+        if completion_tokens is None:
+            completion_tokens = max(0, estimate_tokens([{"content": text}]) - 4) if text else 0
+        logger.info("%s: 打ち切り model=%s, chars=%d, sent=%s", self.name, model, len(text), sent)
+        fields = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cache_read_tokens": 0,
+            "cache_creation_tokens": 0,
+            "model": model,
+            "response_id": None,
+            **known,
+            "finish_reason": "cancelled",
+            "usage_estimated": estimated,
+        }
+        return _result(text, self.started, self.first_token_at, time.perf_counter(), **fields)
+
+
+def _anthropic_fields(final) -> dict:
+    """Anthropic の最終メッセージから usage・finish_reason・ID を取り出す"""
+    # input_tokens はキャッシュを使わなかった分だけなので、キャッシュの読み書き分を足してプロンプト全体にする
+    cache_read_tokens = getattr(final.usage, "cache_read_input_tokens", None) or 0
+    cache_creation_tokens = getattr(final.usage, "cache_creation_input_tokens", None) or 0
+    prompt_tokens = final.usage.input_tokens + cache_read_tokens + cache_creation_tokens
+    completion_tokens = final.usage.output_tokens
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cache_read_tokens": cache_read_tokens,
+        "cache_creation_tokens": cache_creation_tokens,
+        "finish_reason": final.stop_reason,
+        "model": final.model,
+        "response_id": final.id,
+    }
+
+
+def _plain_text(content) -> str:
+    """content（文字列、または cache_control 付きのブロック列）の本文"""
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content or [])
+
+
+def _anthropic_cancelled(receiver: _Receiver, stream, model: str, system, messages: list) -> dict:
+    """打ち切った Anthropic のストリームの結果。message_start を受け取っていればその usage を使う"""
+    prompt_estimate = estimate_tokens(
+        [{"content": _plain_text(system)}, *({"content": _plain_text(m.get("content"))} for m in messages)]
+    )
+    snapshot = None
+    if stream is not None:
+        try:
+            snapshot = stream.current_message_snapshot
+        except Exception:
+            snapshot = None
+    if snapshot is None:
+        return receiver.cancelled_result(model, None, sent=stream is not None, prompt_estimate=prompt_estimate)
+    fields = _anthropic_fields(snapshot)
+    # message_start の output_tokens は途中の値なので、受け取ったテキストから概算する
+    return receiver.cancelled_result(
+        fields["model"] or model, fields["prompt_tokens"],
+        cache_read_tokens=fields["cache_read_tokens"],
+        cache_creation_tokens=fields["cache_creation_tokens"],
+        response_id=fields["response_id"],
+    )
+
+
+def stream_anthropic_message(
+    client, *, model: str, system, messages: list, max_tokens: int, on_text=None,
+    cancel: CancelToken | None = None, **params,
+) -> dict:
+    """Anthropic Messages API をストリーミングで呼び出す。
+
+    Args:
+        client: anthropic.Anthropic
+        system: system プロンプト（文字列、または cache_control 付きのブロック列。空なら送らない）
+        on_text: テキスト差分を受け取るたびに on_text(delta) で呼ばれる
+        cancel: 取り消し用のトークン（モジュール docstring 参照）
+        params: その他の API パラメータ（temperature など）
+
+    Returns:
+        text / prompt_tokens / completion_tokens / total_tokens / cache_read_tokens / cache_creation_tokens /
+        finish_reason / model / response_id / usage_estimated と時間指標（モジュール docstring 参照）の dict。
+    """
+    receiver = _Receiver("stream_anthropic_message", on_text, cancel)
+    if receiver.cancelled:
+        return _anthropic_cancelled(receiver, None, model, system, messages)
+    if system:
+        params["system"] = system
+    stream = None
+    unregister = None
+    try:
+        with client.messages.stream(model=model, max_tokens=max_tokens, messages=messages, **params) as stream:
+            if cancel is not None:
+                unregister = cancel.on_cancel(stream.close)
+            for delta in stream.text_stream:
+                if receiver.cancelled:
+                    break
+                receiver.text(delta)
+            if not receiver.cancelled:
+                return receiver.result(**_anthropic_fields(stream.get_final_message()))
+    except Exception:
+        if not receiver.cancelled:
+            raise
+    finally:
+        if unregister is not None:
+            unregister()
+    return _anthropic_cancelled(receiver, stream, model, system, messages)
+
+
+async def astream_anthropic_message(
+    client, *, model: str, system, messages: list, max_tokens: int, on_text=None,
+    cancel: CancelToken | None = None, **params,
+) -> dict:
+    """stream_anthropic_message の非同期版（client は anthropic.AsyncAnthropic）"""
+    receiver = _Receiver("astream_anthropic_message", on_text, cancel)
+    if receiver.cancelled:
+        return _anthropic_cancelled(receiver, None, model, system, messages)
+    if system:
+        params["system"] = system
+    unregister = _cancel_task_on(cancel)
+    stream = None
+    try:
+        async with client.messages.stream(model=model, max_tokens=max_tokens, messages=messages, **params) as stream:
+            async for delta in stream.text_stream:
+                receiver.text(delta)
+            return receiver.result(**_anthropic_fields(await stream.get_final_message()))
+    except (asyncio.CancelledError, Exception):
+        if not receiver.cancelled:
+            raise
+    finally:
+        unregister()
+    return _anthropic_cancelled(receiver, stream, model, system, messages)
+
+
+class _OpenAIChunks:
+    """Chat Completions のストリーミングのチャンクから finish_reason・usage・ID を集める"""
+
+    def __init__(self, receiver: _Receiver):
+        self.receiver = receiver
+        self.finish_reason = None
+        self.usage = None
+        self.model = None
+        self.response_id = None
+
+    def add(self, chunk) -> None:
+        self.response_id = self.response_id or chunk.id
+        self.model = chunk.model or self.model
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        # Azure はコンテンツフィルタ結果だけのチャンク（choices が空）を先頭に送ることがある
+        if not chunk.choices:
+            return
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+        self.receiver.text(choice.delta.content if choice.delta else None)
+
+    def result(self, requested_model: str) -> dict:
+        usage = self.usage
+        if usage is None:
+            logger.warning("%s: usage を受信できませんでした (model=%s)", self.receiver.name, requested_model)
+        prompt_tokens = usage.prompt_tokens if usage else 0
+        completion_tokens = usage.completion_tokens if usage else 0
+        # Azure OpenAI の自動プロンプトキャッシュ（prompt_tokens に含まれる）
+        details = getattr(usage, "prompt_tokens_details", None)
+        cache_read_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        return self.receiver.result(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=usage.total_tokens if usage else prompt_tokens + completion_tokens,
+            cache_read_tokens=cache_read_tokens,
+            cache_creation_tokens=0,
+            finish_reason=self.finish_reason,
+            model=self.model,
+            response_id=self.response_id,
+        )
+
+    def cancelled(self, requested_model: str, messages: list, sent: bool = True) -> dict:
+        """打ち切った時点の結果（usage は最後のチャンクで届くため、打ち切った場合はほぼ概算になる）"""
+        if self.usage is not None:
+            return self.receiver.cancelled_result(
+                self.model or requested_model, self.usage.prompt_tokens,
+                completion_tokens=self.usage.completion_tokens, response_id=self.response_id,
+            )
+        return self.receiver.cancelled_result(
+            self.model or requested_model, None, sent=sent,
+            prompt_estimate=estimate_tokens(messages), response_id=self.response_id,
+        )
+
+
+def _openai_params(model: str, messages: list, max_completion_tokens: int, temperature, params: dict) -> dict:
+    request = {
+        "model": model,
+        "messages": messages,
+        "max_completion_tokens": max_completion_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        **params,
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    return request
+
+
+def stream_openai_chat(
+    client, *, model: str, messages: list, max_completion_tokens: int, temperature: float | None = None,
+    on_text=None, cancel: CancelToken | None = None, **params,
+) -> dict:
+    """Azure OpenAI Chat Completions をストリーミングで呼び出す。
+
+    usage は stream_options.include_usage で最後のチャンクとして受け取る
+    （api-version 2024-09-01-preview 以降）。
+
+    Args:
+        client: openai.AzureOpenAI
+        temperature: None ならモデルの既定値
+        on_text: テキスト差分を受け取るたびに on_text(delta) で呼ばれる
+        cancel: 取り消し用のトークン（モジュール docstring 参照）
+
+    Returns:
+        stream_anthropic_message と同じ形式の dict。
+    """
+    chunks = _OpenAIChunks(_Receiver("stream_openai_chat", on_text, cancel))
+    if chunks.receiver.cancelled:
+        return chunks.cancelled(model, messages, sent=False)
+    stream = None
+    unregister = None
+    try:
+        stream = client.chat.completions.create(
+            **_openai_params(model, messages, max_completion_tokens, temperature, params)
+        )
+        if cancel is not None:
+            unregister = cancel.on_cancel(stream.close)
+        for chunk in stream:
+            if chunks.receiver.cancelled:
+                break
+            chunks.add(chunk)
+    except Exception:
+        if not chunks.receiver.cancelled:
+            raise
+    finally:
+        if unregister is not None:
+            unregister()
+        if stream is not None:
+            stream.close()
+    # 最後まで（usage のチャンクまで）受信した後の取り消しは無視する。usage は finish_reason の後のチャンクで
+    # 届くため、その間に取り消した場合も usage を概算する
+    if chunks.receiver.cancelled and (chunks.finish_reason is None or chunks.usage is None):
+        return chunks.cancelled(model, messages)
+    return chunks.result(model)
+
+
+async def astream_openai_chat(
+    client, *, model: str, messages: list, max_completion_tokens: int, temperature: float | None = None,
+    on_text=None, cancel: CancelToken | None = None, **params,
+) -> dict:
+    """stream_openai_chat の非同期版（client は openai.AsyncAzureOpenAI）"""
+    chunks = _OpenAIChunks(_Receiver("astream_openai_chat", on_text, cancel))
+    if chunks.receiver.cancelled:
+        return chunks.cancelled(model, messages, sent=False)
+    unregister = _cancel_task_on(cancel)
+    stream = None
+    try:
+        stream = await client.chat.completions.create(
+            **_openai_params(model, messages, max_completion_tokens, temperature, params)
+        )
+        async for chunk in stream:
+            chunks.add(chunk)
+    except (asyncio.CancelledError, Exception):
+        if not chunks.receiver.cancelled:
+            raise
+    finally:
+        unregister()
+        if stream is not None:
+            await stream.close()
+    if chunks.receiver.cancelled and (chunks.finish_reason is None or chunks.usage is None):
+        return chunks.cancelled(model, messages)
+    return chunks.result(model)
@@ -0,0 +1,237 @@
+"""
+lib/rate_limiter.py - デプロイ単位の TPM / RPM レート制限（クライアント側）
+
+Azure のデプロイごとのクォータ（tokens-per-minute / requests-per-minute）を超えて 429 が
+連発しないよう、(デプロイ名, リージョン) ごとにトークンバケットを 2 つ（トークン用・リクエスト用）持つ（プロセス内で共有）。
+上限は config/deployment_models.json の各モデルの "limits": {"tpm": ..., "rpm": ...} で宣言する。
+
+- acquire(): 送信前に推定プロンプトトークン数と 1 リクエストを差し引く。残りが足りなければ
+  最大 RATE_LIMIT_MAX_WAIT 秒まで待ち、それ以上かかる見込みなら RateLimitQueuedError を送出する
+- reconcile(): 応答後、実際の usage（total_tokens）との差分をバケットに反映する
+- refund(): 送信に失敗したリクエストのトークンを戻す（リクエスト数は戻さない）
+- block(): サーバーから 429 + Retry-After を受けたら、その間はこのデプロイへの送信を止める
+- limiter_stats(): バケットの残量・待ち時間・待ち中の数などのメトリクス
+
+使い方:
+    reservation = acquire(deployment_name, region, limits, estimate_tokens(messages))
+    result = ...  # API 呼び出し（失敗したら refund(reservation)）
+    reconcile(reservation, result["total_tokens"])
+"""
+
+import math
+import os
+import threading
+import time
+
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+# バジェットを待つ最大秒数（これ以上かかる見込みなら待たずに RateLimitQueuedError）
+MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+# 待機中の再確認間隔（秒）
+_POLL_INTERVAL = 0.25
+
+_limiters: dict[tuple, dict] = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimitQueuedError(Exception):
+    """クライアント側の TPM / RPM 上限により、すぐには送信できない（約 retry_after 秒後に空く見込み）"""
+
+    # 送信前に止めたもの（サーバーのエラーではない）。lib/llm_retry.py は再試行せず別リージョンへ切り替える
+    local = True
+
+    def __init__(self, deployment_name: str, region: str, limit: str, retry_after: float):
+        self.deployment_name = deployment_name
+        self.region = region
+        self.limit = limit
+        self.retry_after = retry_after
+        super().__init__(
+            f"{deployment_name} ({region}) の {limit.upper()} 上限に達しています（約 {retry_after:.0f} 秒後に空きます）"
+        )
+
+
+def estimate_tokens(messages: list) -> int:
+    """メッセージ列のプロンプトトークン数を文字数から概算する（ASCII は約 4 文字、それ以外は約 1 文字で 1 トークン）"""
+    total = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = str(content)
+        ascii_chars = sum(1 for ch in content if ord(ch) < 128)
+        total += math.ceil(ascii_chars / 4) + (len(content) - ascii_chars) + 4  # 4: ロール等のオーバーヘッド
+    return total
+
+
+# ========================================
+# バケット
+# ========================================
+def _limiter(deployment_name: str, region: str, limits: dict) -> dict:
+    """(デプロイ名, リージョン) のバケットを返す（無ければ作る）。_limiters_lock を保持して呼ぶこと"""
+    key = (deployment_name, region)
+    limiter = _limiters.get(key)
+    tpm = float(limits.get("tpm") or 0)
+    rpm = float(limits.get("rpm") or 0)
+    if limiter is None or limiter["tpm"] != tpm or limiter["rpm"] != rpm:
+        # 初回、または設定が変わったときは満杯のバケットから始める。
+        # Retry-After による停止と待ち中の数は作り直しても引き継ぐ（acquire() の finally が古い値を減らさないように）
+        previous = limiter or {}
+        limiter = _limiters[key] = {
+            "deployment_name": deployment_name,
+            "region": region,
+            "tpm": tpm,
+            "rpm": rpm,
+            "tokens": tpm,
+            "requests": rpm,
+            "refilled_at": time.monotonic(),
+            "blocked_until": previous.get("blocked_until", 0.0),
+            "acquired": 0,
+            "waited": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "queued": 0,
+            "waiting": previous.get("waiting", 0),
+            "charged_tokens": 0,
+            "actual_tokens": 0,
+        }
+    return limiter
+
+
+def _refill(limiter: dict, now: float) -> None:
+    elapsed = now - limiter["refilled_at"]
+    limiter["refilled_at"] = now
+    if limiter["tpm"]:
+        limiter["tokens"] = min(limiter["tpm"], limiter["tokens"] + elapsed * limiter["tpm"] / 60)
+    if limiter["rpm"]:
+        limiter["requests"] = min(limiter["rpm"], limiter["requests"] + elapsed * limiter["rpm"] / 60)
+
+
+def _wait_needed(limiter: dict, tokens: int, now: float) -> tuple[float, str]:
+    """送信できるまでの秒数と、律速している上限（"tpm" / "rpm" / "retry-after"）"""
+    waits = [(max(0.0, limiter["blocked_until"] - now), "retry-after")]
+    if limiter["rpm"] and limiter["requests"] < 1:
+        waits.append(((1 - limiter["requests"]) * 60 / limiter["rpm"], "rpm"))
+    if limiter["tpm"] and limiter["tokens"] < tokens:
+        waits.append(((tokens - limiter["tokens"]) * 60 / limiter["tpm"], "tpm"))
+    return max(waits)
+
+
+def acquire(deployment_name: str, region: str, limits: dict | None, tokens: int, *, on_wait=None) -> dict:
+    """推定トークン数 tokens と 1 リクエストをバケットから差し引き、予約（dict）を返す。
+
+    Args:
+        limits: {"tpm": int, "rpm": int}（どちらも省略可。無ければ block() の停止期間だけを守る）
+        on_wait: 待つ前に on_wait(wait_seconds, limit) で呼ばれる（画面に「待機中」を出すため）
+
+    Raises:
+        RateLimitQueuedError: RATE_LIMIT_MAX_WAIT 秒以内に送信できる見込みがない
+    """
+    reservation = {"key": (deployment_name, region), "tokens": 0, "waited_seconds": 0.0}
+    if not limits or not (limits.get("tpm") or limits.get("rpm")):
+        limits = {}
+        with _limiters_lock:
+            if reservation["key"] not in _limiters:
+                return reservation  # 上限なし・429 も受けていない
+    started = time.monotonic()
+    waiting = False
+    try:
+        while True:
+            with _limiters_lock:
+                limiter = _limiter(deployment_name, region, limits)
+                now = time.monotonic()
+                _refill(limiter, now)
+                # 1 リクエストでバケット容量を超える場合は容量分だけ差し引く（永久に待たないように）
+                charge = min(tokens, int(limiter["tpm"])) if limiter["tpm"] else 0
+                wait, limit = _wait_needed(limiter, charge, now)
+                if wait <= 0:
+                    limiter["tokens"] -= charge
+                    limiter["requests"] -= 1 if limiter["rpm"] else 0
+                    limiter["acquired"] += 1
+                    limiter["charged_tokens"] += charge
+                    waited = now - started
+                    if waited > 0.001:
+                        limiter["waited"] += 1
+                        limiter["wait_seconds_total"] += waited
+                        limiter["wait_seconds_max"] = max(limiter["wait_seconds_max"], waited)
+                    reservation.update(tokens=charge, waited_seconds=round(waited, 3))
+                    return reservation
+                if (now - started) + wait > MAX_WAIT:
+                    limiter["queued"] += 1
+                    logger.warning(
+                        "rate_limiter: 送信待ち上限超過 deployment=%s, region=%s, limit=%s, retry_after=%.1fs",
+                        deployment_name, region, limit, wait,
+                    )
+                    raise RateLimitQueuedError(deployment_name, region, limit, wait)
+                if not waiting:
+                    waiting = True
+                    limiter["waiting"] += 1
+            if on_wait is not None:
+                on_wait(wait, limit)
+            time.sleep(min(wait, _POLL_INTERVAL))
+    finally:
+        if waiting:
+            with _limiters_lock:
+                _limiters[reservation["key"]]["waiting"] -= 1
+
+
+def reconcile(reservation: dict, actual_tokens: int) -> None:
+    """実際の usage（プロンプト + 生成）と推定の差分をバケットに反映する（超過分は残量がマイナスになる）"""
+    with _limiters_lock:
+        limiter = _limiters.get(reservation["key"])
+        if limiter is None or not limiter["tpm"]:
+            return
+        limiter["tokens"] -= actual_tokens - reservation["tokens"]
+        limiter["actual_tokens"] += actual_tokens
+
+
+def refund(reservation: dict) -> None:
+    """送信に失敗したリクエストの推定トークンを戻す"""
+    with _limiters_lock:
+        limiter = _limiters.get(reservation["key"])
+        if limiter is None or not limiter["tpm"]:
+            return
+        limiter["tokens"] = min(limiter["tpm"], limiter["tokens"] + reservation["tokens"])
+        limiter["charged_tokens"] -= reservation["tokens"]
+
+
+def block(deployment_name: str, region: str, seconds: float) -> None:
+    """サーバーの Retry-After の間、このデプロイへの送信を止める（同じプロセスの他のセッションも含む）。
+
+    "limits" を宣言していないデプロイには上限なしのバケットを作り、停止期間だけを適用する。
+    """
+    with _limiters_lock:
+        limiter = _limiters.get((deployment_name, region)) or _limiter(deployment_name, region, {})
+        limiter["blocked_until"] = max(limiter["blocked_until"], time.monotonic() + seconds)
+
+
+def limiter_stats() -> list[dict]:
+    """(デプロイ名, リージョン) ごとの上限・残量・待ち時間・待ち中の数のリスト"""
+    with _limiters_lock:
+        now = time.monotonic()
+        stats = []
+        for key in sorted(_limiters):
+            limiter = _limiters[key]
+            _refill(limiter, now)
+            stats.append({
+                "deployment_name": limiter["deployment_name"],
+                "region": limiter["region"],
+                "tpm": limiter["tpm"],
+                "rpm": limiter["rpm"],
+                "tokens_available": round(limiter["tokens"]),
+                "requests_available": round(limiter["requests"], 1),
+                "acquired": limiter["acquired"],
+                "waited": limiter["waited"],
+                "wait_seconds_total": round(limiter["wait_seconds_total"], 3),
+                "wait_seconds_max": round(limiter["wait_seconds_max"], 3),
+                "avg_wait_seconds": round(limiter["wait_seconds_total"] / limiter["waited"], 3) if limiter["waited"] else 0.0,
+                "queued": limiter["queued"],
+                "waiting": limiter["waiting"],
+                "blocked_seconds": round(max(0.0, limiter["blocked_until"] - now), 1),
+                "charged_tokens": limiter["charged_tokens"],
+                "actual_tokens": limiter["actual_tokens"],
+            })
+    return stats
@@ -0,0 +1,184 @@
+"""
+lib/response_cache.py - 同一プロンプトへの応答キャッシュ（ディスク、TTL + サイズ上限の LRU）
+
+同じ翻訳・定型文の依頼を既定の system プロンプトのまま新しいセッションに送り直す、といった
+完全一致の再送信には、LLM を呼ばずに前回の応答を返す（RESPONSE_CACHE_ENABLED=1 で有効。既定は無効）。
+
+- キーは (デプロイ名, メッセージ列（改行コード・前後の空白を正規化）, max_tokens, temperature)
+  の SHA-256。1 エントリ 1 ファイル（RESPONSE_CACHE_DIR/<キー先頭 2 文字>/<キー>.json）で保存する
+- RESPONSE_CACHE_TTL_SECONDS を過ぎたエントリは読み出し時に削除する
+- 合計サイズが RESPONSE_CACHE_MAX_MB を超えたら、最後に使われた時刻（ファイルの mtime。ヒット時に更新）
+  の古い順に削除する
+- ヒット / ミス / 保存 / 追い出し / 期限切れ / バイパスの回数は stats() で返す（フッター表示用）
+- モデルごとに使わない設定（config/deployment_models.json の "response_cache": false）は呼び出し側で判定し、
+  record_bypass() で回数だけ数える
+
+使い方:
+    cache = get_response_cache(RESPONSE_CACHE_DIR)
+    key = cache_key(deployment_name, messages, max_tokens, temperature)
+    entry = cache.get(key)      # 無ければ None
+    cache.put(key, {...})       # 応答が完了したら保存
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from lib.logger import get_logger
+from lib.session_store import atomic_write_text
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") not in ("0", "false", "False")
+TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+MAX_BYTES = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", "100")) * 1024 * 1024)
+
+_caches: dict[str, "ResponseCache"] = {}
+_caches_lock = threading.Lock()
+
+
+def cache_key(deployment_name: str, messages: list, max_tokens: int | None, temperature: float | None) -> str:
+    """キャッシュのキー（SHA-256 の 16 進文字列）。本文は改行コードと前後の空白だけ正規化する"""
+    normalized = [
+        {"role": m.get("role", ""), "content": str(m.get("content") or "").replace("\r\n", "\n").strip()}
+        for m in messages
+    ]
+    payload = json.dumps(
+        {"deployment": deployment_name, "messages": normalized, "max_tokens": max_tokens, "temperature": temperature},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """ディスク上の応答キャッシュ（スレッドセーフ。別プロセスが書いたエントリも読める）"""
+
+    def __init__(self, path: Path, ttl_seconds: float = TTL_SECONDS, max_bytes: int = MAX_BYTES):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # キー -> [サイズ, 最後に使われた時刻]。初回アクセス時にディレクトリを走査して作る
+        self._index: dict[str, list] | None = None
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "bypassed": 0}
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json"
+
+    def _scan(self) -> dict[str, list]:
+        """ディレクトリを走査してインデックスを作り直す。_lock を保持して呼ぶこと"""
+        index = {}
+        if self.path.exists():
+            for file in self.path.glob("*/*.json"):
+                try:
+                    st = file.stat()
+                except FileNotFoundError:
+                    continue
+                index[file.stem] = [st.st_size, st.st_mtime]
+        self._index = index
+        return index
+
+    def _remove(self, key: str) -> None:
+        """エントリを削除する。_lock を保持して呼ぶこと"""
+        self._entry_path(key).unlink(missing_ok=True)
+        if self._index is not None:
+            self._index.pop(key, None)
+
+    def get(self, key: str) -> dict | None:
+        """キーに対応するエントリ（保存時の dict）を返す。無い・期限切れなら None"""
+        with self._lock:
+            index = self._index if self._index is not None else self._scan()
+            path = self._entry_path(key)
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                index.pop(key, None)
+                self._counters["misses"] += 1
+                return None
+            except (OSError, ValueError):
+                logger.warning("ResponseCache.get: 壊れたエントリを削除 key=%s", key[:16])
+                self._remove(key)
+                self._counters["misses"] += 1
+                return None
+            if time.time() - entry.get("stored_at", 0) > self.ttl_seconds:
+                self._remove(key)
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return None
+            now = time.time()
+            try:
+                os.utime(path, (now, now))  # LRU 用に最後に使われた時刻を更新
+                index[key] = [path.stat().st_size, now]
+            except OSError:
+                # 読んだ直後に別プロセスが追い出した。読めた内容はそのまま返し、索引からだけ外す
+                index.pop(key, None)
+            self._counters["hits"] += 1
+            return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        """エントリを保存し、サイズ上限を超えていれば古いものから追い出す"""
+        text = json.dumps(
+            {**entry, "key": key, "stored_at": time.time(), "stored_at_iso": datetime.now().isoformat()},
+            ensure_ascii=False,
+        )
+        with self._lock:
+            index = self._index if self._index is not None else self._scan()
+            path = self._entry_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_text(path, text)
+            index[key] = [path.stat().st_size, time.time()]
+            self._counters["stores"] += 1
+            if sum(size for size, _ in index.values()) > self.max_bytes:
+                self._evict(keep=key)
+
+    def _evict(self, keep: str) -> None:
+        """合計サイズが上限以下になるまで、最後に使われた時刻の古い順に削除する。_lock を保持して呼ぶこと"""
+        # 別プロセスが書いたエントリも含めるため、走査し直してから追い出す
+        index = self._scan()
+        total = sum(size for size, _ in index.values())
+        for key, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            total -= size
+            self._counters["evictions"] += 1
+        logger.info("ResponseCache: 追い出し後 entries=%d, bytes=%d", len(index), total)
+
+    def record_bypass(self) -> None:
+        """キャッシュを使わない設定のモデルへの送信を数える"""
+        with self._lock:
+            self._counters["bypassed"] += 1
+
+    def stats(self) -> dict:
+        """エントリ数・合計サイズ・各回数・ヒット率"""
+        with self._lock:
+            index = self._index if self._index is not None else self._scan()
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "entries": len(index),
+                "bytes": sum(size for size, _ in index.values()),
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                **self._counters,
+                "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+def get_response_cache(path: Path) -> ResponseCache:
+    """保存先ディレクトリに対応するキャッシュを返す（プロセス内で共有）"""
+    key = str(Path(path).resolve())
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ResponseCache(path)
+            logger.info("get_response_cache: path=%s, ttl=%ss, max_bytes=%d", path, TTL_SECONDS, MAX_BYTES)
+        return cache
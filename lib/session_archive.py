@@ -0,0 +1,310 @@
+"""
+lib/session_archive.py - 終了・削除済みセッションのコールドアーカイブ
+
+終了 (status == "completed") またはゴミ箱内のセッションのうち、一定期間更新のないものを
+圧縮ブロブ (data/archive/<session_id>.json.zst / .json.gz) へ移す。
+ホットストアにはスカラー項目と集計値だけを持つスタブを残すため、一覧表示（サマリ）は
+そのまま動き、通常の保存で会話本体をパース・再シリアライズしなくなる。
+
+- 圧縮: zstandard がインストールされていれば zstd、無ければ gzip（標準ライブラリ）
+- get_session() は必要なときにブロブを展開して完全なセッションを返す（ホットには戻さない）
+- 会話の追加・名前変更・再開・ゴミ箱からの復元の前には自動でホットストアへ戻す（rehydrate）
+- 完全削除するとブロブも削除する
+
+一括操作はプロジェクトルートの archive_sessions.py から実行できる。
+"""
+
+import copy
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from lib.logger import get_logger
+from lib.session_store import (
+    SessionStore,
+    _now_iso,
+    build_session_summary,
+    freeze,
+    pack_session,
+    unpack_session,
+)
+
+try:
+    import zstandard
+except ImportError:  # 任意依存。無ければ gzip を使う
+    zstandard = None
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+# アーカイブ時にブロブへ移す（ホットストアから外す）フィールド
+ARCHIVE_BODY_FIELDS = ("conversation_history", "messages", "errors", "name_changes")
+_SUFFIXES = {"zstd": ".json.zst", "gzip": ".json.gz"}
+
+
+# ========================================
+# 圧縮ブロブ
+# ========================================
+class SessionArchive:
+    """セッション本体を 1 セッション 1 ファイルの圧縮ブロブとして保存する"""
+
+    def __init__(self, path: Path, codec: str | None = None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        if codec is None:
+            codec = "zstd" if zstandard is not None else "gzip"
+        if codec == "zstd" and zstandard is None:
+            logger.warning("SessionArchive: zstandard が未インストールのため gzip を使用")
+            codec = "gzip"
+        self.codec = codec
+
+    def blob_path(self, session_id: str, codec: str | None = None) -> Path:
+        return self.path / f"{session_id}{_SUFFIXES[codec or self.codec]}"
+
+    def _find(self, session_id: str) -> tuple[Path, str] | None:
+        """既存のブロブを探す（書き込み時と異なる圧縮方式のものも読めるようにする）"""
+        for codec in (self.codec, *(c for c in _SUFFIXES if c != self.codec)):
+            path = self.blob_path(session_id, codec)
+            if path.exists():
+                return path, codec
+        return None
+
+    def exists(self, session_id: str) -> bool:
+        return self._find(session_id) is not None
+
+    def write(self, session_id: str, body: dict) -> Path:
+        """本体をアトミックに書き込む（一時ファイル → fsync → rename）"""
+        raw = json.dumps(body, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+        if self.codec == "zstd":
+            data = zstandard.ZstdCompressor(level=10).compress(raw)
+        else:
+            data = gzip.compress(raw, compresslevel=6)
+        path = self.blob_path(session_id)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        logger.debug("SessionArchive.write: session_id=%s, %d -> %d bytes (%s)", session_id, len(raw), len(data), self.codec)
+        return path
+
+    def read(self, session_id: str) -> dict | None:
+        found = self._find(session_id)
+        if found is None:
+            return None
+        path, codec = found
+        with open(path, "rb") as f:
+            data = f.read()
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError(f"zstd ブロブの展開には zstandard が必要です: {path}")
+            raw = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            raw = gzip.decompress(data)
+        return json.loads(raw)
+
+    def delete(self, session_id: str) -> None:
+        for codec in _SUFFIXES:
+            path = self.blob_path(session_id, codec)
+            if path.exists():
+                path.unlink()
+
+
+# ========================================
+# アーカイブ対応ストア
+# ========================================
+def _last_activity(summary: dict) -> str:
+    return max(
+        (summary.get(k) or "" for k in ("updated_at", "last_llm_response_at", "ended_at", "deleted_at", "created_at")),
+    )
+
+
+class ArchivingSessionStore(SessionStore):
+    """任意のバックエンドをラップし、アーカイブ済みセッションを透過的に扱うストア。
+
+    アーカイブ済みセッションはホットストア上では ``archived`` フィールド
+    （アーカイブ日時・圧縮方式・ターン数・トークン/コスト合計）を持つスタブになる。
+    """
+
+    def __init__(self, inner: SessionStore, archive: SessionArchive, archive_after_days: float = 0):
+        self.inner = inner
+        self.archive = archive
+        self.archive_after_days = archive_after_days
+        if archive_after_days > 0:
+            threading.Thread(
+                target=self._archive_idle_in_background, name="session-archiver", daemon=True,
+            ).start()
+
+    @property
+    def backend(self) -> str:
+        return self.inner.backend
+
+    @property
+    def path(self) -> Path:
+        return self.inner.path
+
+    # --- アーカイブ / 復元 ---
+    def _expand(self, stub: dict) -> dict:
+        """スタブとブロブから完全なセッションを組み立てる"""
+        body = self.archive.read(stub["session_id"])
+        if body is None:
+            logger.error("ArchivingSessionStore: ブロブが見つかりません session_id=%s", stub["session_id"])
+            body = {}
+        session = {k: v for k, v in stub.items() if k != "archived"}
+        session.update(unpack_session(body))
+        return session
+
+    def archive_session(self, session_id: str) -> bool:
+        """セッション本体を圧縮ブロブへ移し、ホットストアにはスタブだけを残す"""
+        with self.inner.batch():
+            session = self.inner.get_session(session_id)
+            if session is None or session.get("archived") or session.get("purged_from_trash"):
+                return False
+            body = {k: copy.deepcopy(session.get(k) or []) for k in ARCHIVE_BODY_FIELDS}
+            self.archive.write(session_id, pack_session(body))
+            summary = build_session_summary(session)
+            stub = {k: copy.deepcopy(v) for k, v in session.items() if k not in ARCHIVE_BODY_FIELDS}
+            stub["archived"] = {
+                "at": _now_iso(),
+                "codec": self.archive.codec,
+                "turn_count": summary["turn_count"],
+                "total_tokens": summary["total_tokens"],
+                "total_cost_usd": summary["total_cost_usd"],
+            }
+            self.inner.create_session(stub)
+        logger.info("ArchivingSessionStore.archive_session: session_id=%s", session_id)
+        return True
+
+    def rehydrate_session(self, session_id: str) -> bool:
+        """アーカイブ済みセッションをホットストアへ戻す。
+
+        呼び出し元の batch() が確定する前にブロブを消さないよう、不要になったブロブは
+        remove_orphan_blobs() でまとめて削除する。
+        """
+        with self.inner.batch():
+            stub = self.inner.get_session(session_id)
+            if stub is None or not stub.get("archived"):
+                return False
+            self.inner.create_session(self._expand(stub))
+        logger.info("ArchivingSessionStore.rehydrate_session: session_id=%s", session_id)
+        return True
+
+    def remove_orphan_blobs(self) -> int:
+        """ホットストアでアーカイブ済みになっていないセッションのブロブを削除する"""
+        self.inner.flush()  # 復元した本体がディスクに書かれてからブロブを消す
+        summaries = self.inner.list_session_summaries()
+        removed = 0
+        for path in list(self.archive.path.iterdir()):
+            session_id = path.name.split(".", 1)[0]
+            if not any(path.name == f"{session_id}{suffix}" for suffix in _SUFFIXES.values()):
+                continue
+            summary = summaries.get(session_id)
+            if summary is None or not summary.get("archived") or summary.get("purged_from_trash"):
+                path.unlink()
+                removed += 1
+        if removed:
+            logger.info("ArchivingSessionStore: 不要なブロブを %d 件削除", removed)
+        return removed
+
+    def _ensure_hot(self, session_id: str) -> None:
+        summary = self.inner.get_session_summary(session_id)
+        if summary is not None and summary.get("archived"):
+            self.rehydrate_session(session_id)
+
+    def archive_idle_sessions(self, days: float, now: datetime | None = None) -> int:
+        """終了・削除済みで days 日以上更新のないセッションをアーカイブする。
+
+        Returns:
+            アーカイブしたセッション数。
+        """
+        threshold = ((now or datetime.now()) - timedelta(days=days)).isoformat()
+
+        def is_idle(s: dict | None) -> bool:
+            return (
+                s is not None and (s.get("status") == "completed" or s.get("deleted"))
+                and not s.get("purged_from_trash") and not s.get("archived")
+                and _last_activity(s) < threshold
+            )
+
+        targets = [sid for sid, s in self.inner.list_session_summaries().items() if is_idle(s)]
+        archived = 0
+        for sid in targets:
+            # 一覧を取ってから再開・追記されたセッションは、batch() 内で条件を見直して対象外にする
+            with self.inner.batch():
+                if is_idle(self.inner.get_session_summary(sid)) and self.archive_session(sid):
+                    archived += 1
+        if archived:
+            logger.info("ArchivingSessionStore: %d セッションをアーカイブ (%s 日以上更新なし)", archived, days)
+        self.remove_orphan_blobs()
+        return archived
+
+    def _archive_idle_in_background(self) -> None:
+        try:
+            self.archive_idle_sessions(self.archive_after_days)
+        except Exception:
+            logger.exception("ArchivingSessionStore: 自動アーカイブ失敗")
+
+    # --- 読み込み ---
+    def list_sessions(self) -> dict:
+        """全セッションを本体込みで返す（アーカイブ済みも展開する。移行・検証用）"""
+        return {
+            sid: freeze(self._expand(s)) if s.get("archived") else s
+            for sid, s in self.inner.list_sessions().items()
+        }
+
+    def get_session(self, session_id: str) -> dict | None:
+        session = self.inner.get_session(session_id)
+        if session is not None and session.get("archived"):
+            return freeze(self._expand(session))
+        return session
+
+    def list_session_summaries(self) -> dict:
+        return self.inner.list_session_summaries()
+
+    def get_session_summary(self, session_id: str) -> dict | None:
+        return self.inner.get_session_summary(session_id)
+
+    def stats(self) -> dict:
+        return self.inner.stats()
+
+    def flush(self) -> None:
+        self.inner.flush()
+
+    # --- 書き込み ---
+    def create_session(self, session: dict) -> None:
+        self.inner.create_session(session)
+
+    # 復元と書き込みは同じ inner.batch() で行い、間にバックグラウンドの再アーカイブが割り込まないようにする
+    def append_turn(self, session_id: str, history: list, message: dict, at: str | None = None) -> bool:
+        with self.inner.batch():
+            self._ensure_hot(session_id)
+            return self.inner.append_turn(session_id, history, message, at=at)
+
+    def append_error(self, session_id: str, error: dict) -> bool:
+        with self.inner.batch():
+            self._ensure_hot(session_id)
+            return self.inner.append_error(session_id, error)
+
+    def rename_session(self, session_id: str, new_name: str, *, generated_by_llm: bool = False) -> bool:
+        with self.inner.batch():
+            self._ensure_hot(session_id)
+            return self.inner.rename_session(session_id, new_name, generated_by_llm=generated_by_llm)
+
+    def update_session(self, session_id: str, fields: dict, unset: tuple = (), action: str = "update") -> bool:
+        with self.inner.batch():
+            # 再開・ゴミ箱からの復元は、この後すぐ開かれる前提でホットストアへ戻す
+            if action in ("status:active", "restore"):
+                self._ensure_hot(session_id)
+            applied = self.inner.update_session(session_id, fields, unset=unset, action=action)
+        if applied and action == "purge":
+            self.archive.delete(session_id)
+        return applied
+
+    def batch(self):
+        return self.inner.batch()
@@ -0,0 +1,249 @@
+"""
+lib/session_journal.py - 追記専用ジャーナル付き JSON セッションストア
+
+JSON 形式の会話ログ (data/chat_log.json) を維持したまま、書き込みのたびに
+ファイル全体を保存し直すのをやめる。各操作はイベントとして
+ジャーナル (data/chat_log.journal.jsonl) に 1 行追記するだけで完了する。
+
+特徴:
+- セッション作成・メッセージ追加・エラー追加・名前変更・終了・削除・完全削除は
+  すべて lib/session_store.apply_event が解釈するイベントとして 1 行で記録
+- 起動時は「スナップショット (chat_log.json) + ジャーナルの再生」で状態を復元
+- バックグラウンドのコンパクタがジャーナルをスナップショットへ畳み込む
+  （一定間隔、またはイベント数が閾値を超えたとき）
+- スナップショットには畳み込み済みの最終イベント番号 (journal_seq) を保存し、
+  コンパクション途中でクラッシュしてもイベントを二重適用しない
+- append_turn イベントの message_log は同じイベントの history への参照で本文を持つ
+  （lib/session_store.pack_messages、format_version 2）
+
+状態はプロセス内メモリに保持するため、書き込みプロセスは 1 つであることが前提。
+"""
+
+import atexit
+import contextlib
+import copy
+import json
+import os
+import threading
+from pathlib import Path
+
+from lib.logger import get_logger
+from lib.session_store import (
+    SESSION_FORMAT_VERSION,
+    JsonSessionStore,
+    ReadOnlyDict,
+    apply_event,
+    apply_event_cow,
+    atomic_write_text,
+    build_session_summary,
+    freeze,
+    pack_log_data,
+    pack_messages,
+    unpack_messages,
+)
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+_COMPACT_INTERVAL_SECONDS = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "60"))
+_COMPACT_MAX_EVENTS = int(os.getenv("JOURNAL_COMPACT_MAX_EVENTS", "500"))
+
+
+def journal_path_for(snapshot_path: Path) -> Path:
+    """スナップショットのパスに対応するジャーナルのパス（chat_log.json → chat_log.journal.jsonl）"""
+    snapshot_path = Path(snapshot_path)
+    return snapshot_path.with_name(f"{snapshot_path.stem}.journal.jsonl")
+
+
+class JournalSessionStore(JsonSessionStore):
+    """スナップショット + 追記専用ジャーナルで永続化する JSON セッションストア"""
+
+    backend = "journal"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.persister = None  # ジャーナルへの追記が同期書き込みの代わりになる
+        self.journal_path = journal_path_for(self.path)
+        data = self._load()
+        # sessions は可変 dict、各セッションは凍結済み（読み取り専用ビュー）で保持する
+        self._data = {**data, "sessions": dict(data["sessions"])}
+        self._seq = int(self._data.get("journal_seq", 0))
+        self._pending_events = 0
+        self._compact_lock = threading.Lock()
+        self._batch_lines: list[str] | None = None
+        self._replay()
+        self._summaries = {
+            sid: freeze(build_session_summary(session)) for sid, session in self._data["sessions"].items()
+        }
+
+        self._compact_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._compactor = threading.Thread(target=self._compactor_loop, name="session-journal-compactor", daemon=True)
+        self._compactor.start()
+        atexit.register(self.close)
+
+    # --- 起動時の復元 ---
+    def _replay(self) -> None:
+        """スナップショットに含まれていないジャーナルのイベントを再生する"""
+        if not self.journal_path.exists():
+            return
+        # 末尾が改行で終わっていない（追記途中でクラッシュした）場合は切り詰め、
+        # 次の追記が壊れた行に連結されないようにする
+        with open(self.journal_path, "rb+") as f:
+            raw = f.read()
+            if raw and not raw.endswith(b"\n"):
+                f.truncate(raw.rfind(b"\n") + 1)
+                logger.warning("JournalSessionStore._replay: 末尾の不完全な行を切り詰め (%s)", self.journal_path)
+        replayed = 0
+        touched: dict[str, dict] = {}
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中でクラッシュした末尾行など
+                    logger.warning("JournalSessionStore._replay: 壊れた行をスキップ line=%d (%s)", lineno, self.journal_path)
+                    continue
+                seq = event.get("seq", 0)
+                if seq <= self._seq:
+                    continue
+                if event["op"] == "append_turn" and "format_version" in event:
+                    event["message"] = unpack_messages(event["history"], [event["message"]])[0]
+                session_id = event["session_id"]
+                if session_id not in touched and session_id in self._data["sessions"]:
+                    touched[session_id] = copy.deepcopy(self._data["sessions"][session_id])
+                if event["op"] == "create" or session_id in touched:
+                    apply_event(touched, event)
+                else:
+                    apply_event(self._data["sessions"], event)  # 存在しないセッション → 警告のみ
+                self._seq = seq
+                replayed += 1
+        for session_id, session in touched.items():
+            self._data["sessions"][session_id] = freeze(session)
+        self._pending_events = replayed
+        logger.info(
+            "JournalSessionStore: 復元完了 sessions=%d, replayed_events=%d, journal_seq=%d",
+            len(self._data["sessions"]), replayed, self._seq,
+        )
+
+    # --- 書き込み ---
+    def _commit(self, event: dict) -> bool:
+        with self._lock:
+            if not apply_event_cow(self._data["sessions"], event):
+                return False
+            session_id = event["session_id"]
+            self._summaries[session_id] = freeze(build_session_summary(self._data["sessions"][session_id]))
+            self._seq += 1
+            record = {"seq": self._seq, **event}
+            if event["op"] == "append_turn":
+                record["message"] = pack_messages(event["history"], [event["message"]])[0]
+                record["format_version"] = SESSION_FORMAT_VERSION
+            line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+            if self._batch_lines is not None:
+                self._batch_lines.append(line)
+            else:
+                self._append_lines([line])
+            return True
+
+    def _append_lines(self, lines: list[str]) -> None:
+        """ジャーナルへ追記する（呼び出し側で self._lock を保持すること）"""
+        try:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+                f.flush()
+        except Exception:
+            logger.exception("JournalSessionStore: ジャーナル追記失敗 (%s)", self.journal_path)
+            return
+        self._pending_events += len(lines)
+        if self._pending_events >= _COMPACT_MAX_EVENTS:
+            self._compact_requested.set()
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self._lock:
+            outermost = self._batch_lines is None
+            if outermost:
+                self._batch_lines = []
+            try:
+                yield self
+            finally:
+                if outermost:
+                    lines, self._batch_lines = self._batch_lines, None
+                    if lines:
+                        self._append_lines(lines)
+
+    # --- 読み込み ---
+    def list_sessions(self) -> dict:
+        with self._lock:
+            return ReadOnlyDict(self._data["sessions"])
+
+    def get_session(self, session_id: str) -> dict | None:
+        with self._lock:
+            return self._data["sessions"].get(session_id)
+
+    def list_session_summaries(self) -> dict:
+        with self._lock:
+            return ReadOnlyDict(self._summaries)
+
+    # --- コンパクション ---
+    def compact(self) -> None:
+        """ジャーナルをスナップショットへ畳み込み、ジャーナルを切り詰める"""
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        with self._lock:
+            if self._pending_events == 0:
+                return
+            payload = json.dumps(
+                pack_log_data({**self._data, "journal_seq": self._seq}), ensure_ascii=False, indent=2, default=str,
+            )
+            snapshot_seq = self._seq
+            journal_offset = self.journal_path.stat().st_size if self.journal_path.exists() else 0
+
+        # 重いファイル書き込みはロック外で行う
+        atomic_write_text(self.path, payload)
+
+        with self._lock:
+            # スナップショット作成中に追記されたイベントだけを残す
+            tail = b""
+            if self.journal_path.exists():
+                with open(self.journal_path, "rb") as f:
+                    f.seek(journal_offset)
+                    tail = f.read()
+            tmp_path = self.journal_path.with_suffix(".jsonl.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.journal_path)
+            self._data["journal_seq"] = snapshot_seq
+            self._pending_events = self._seq - snapshot_seq
+        logger.info("JournalSessionStore.compact: journal_seq=%d まで畳み込み", snapshot_seq)
+
+    def _compactor_loop(self) -> None:
+        while not self._stopped.is_set():
+            self._compact_requested.wait(timeout=_COMPACT_INTERVAL_SECONDS)
+            self._compact_requested.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("JournalSessionStore: コンパクション失敗")
+
+    def close(self) -> None:
+        """コンパクタを停止し、最後に 1 回畳み込む（atexit から呼ばれる）"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._compact_requested.set()
+        self._compactor.join(timeout=5.0)
+        try:
+            self.compact()
+        except Exception:
+            logger.exception("JournalSessionStore.close: 最終コンパクション失敗")
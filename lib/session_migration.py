@@ -0,0 +1,340 @@
+"""
+lib/session_migration.py - 大きな会話ログ (chat_log.json) の逐次移行
+
+{"sessions": {...}} 形式の JSON を 1 セッションずつ読み出し（全体をメモリに載せない）、
+移行先の SessionStore へ一定件数ごとの batch()（トランザクション）で書き込む。
+
+- 読み込み: json.JSONDecoder.raw_decode をチャンク読みのバッファに適用し、
+  "sessions" オブジェクトの要素を 1 つずつ取り出す。メモリ使用量は
+  チャンクサイズ + 最大のセッション 1 件 + 書き込み中のバッチに比例し、ファイルサイズには比例しない
+- 再開: バッチを確定するたびにチェックポイント (<移行先>.migrate.json) に
+  ソースファイルのバイト位置を記録する。中断後はその位置から読み直す
+  （確定前のバッチは再投入される。create_session は同じ ID を上書きするため重複しない）
+- 検証: 移行したセッションごとのチェックサムと件数を台帳 (<移行先>.migrate.jsonl) に追記し、
+  verify_migration() で移行先から読み直した内容と突き合わせる
+
+CLI はプロジェクトルートの migrate_sessions.py。
+"""
+
+import codecs
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+from lib.logger import get_logger
+from lib.session_store import SessionStore, atomic_write_text, unpack_session
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+_CHUNK_SIZE = 1 << 20  # 1 MiB
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+# ストアが管理する項目（移行先で付け直されるためチェックサムに含めない）
+_STORE_MANAGED_FIELDS = ("version", "format_version")
+
+
+class MigrationError(Exception):
+    """移行元の形式不正・チェックポイント不整合"""
+
+
+# ========================================
+# 逐次 JSON 読み込み
+# ========================================
+class _StreamReader:
+    """バイナリファイルを UTF-8 として少しずつ読み、JSON の値を 1 つずつ取り出す"""
+
+    def __init__(self, f, offset: int, chunk_size: int):
+        f.seek(offset)
+        self._f = f
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+        self._mark = 0          # _base が指している _buf 上の位置
+        self._base = offset     # _buf[_mark] のファイル上のバイト位置
+        self._eof = False
+
+    def offset(self) -> int:
+        """次に読む位置のファイル上のバイト位置"""
+        self._base += len(self._buf[self._mark:self._pos].encode("utf-8"))
+        self._mark = self._pos
+        return self._base
+
+    def _fill(self) -> bool:
+        """読み終えた部分を捨てて追加で読み込む。ファイル末尾なら False。"""
+        self.offset()
+        self._buf, self._pos, self._mark = self._buf[self._pos:], 0, 0
+        # 1 つの値がチャンクより大きいときに再パースが二乗にならないよう、読み込み量を倍々にする
+        data = self._f.read(max(self._chunk_size, len(self._buf)))
+        if not data:
+            self._eof = True
+            self._buf += self._decoder.decode(b"", final=True)
+            return False
+        self._buf += self._decoder.decode(data)
+        return True
+
+    def peek(self) -> str:
+        """空白を読み飛ばし、次の 1 文字を返す（ファイル末尾なら空文字）"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos + 1]
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise MigrationError(f"'{char}' が必要な位置に {found!r} があります (byte {self.offset()})")
+        self._pos += 1
+
+    def value(self):
+        """次の JSON 値を 1 つ読む"""
+        self.peek()
+        while True:
+            try:
+                obj, end = _DECODER.raw_decode(self._buf, self._pos)
+                # 数値などはバッファ末尾で途切れている可能性があるため、続きを読んでから確定する
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return obj
+            except json.JSONDecodeError as e:
+                if self._eof:
+                    raise MigrationError(f"JSON の解析に失敗しました (byte {self.offset()}): {e}") from e
+            self._fill()
+
+
+def iter_log_sessions(path: Path, offset: int | None = None, chunk_size: int = _CHUNK_SIZE):
+    """{"sessions": {...}} 形式のログから 1 セッションずつ取り出す。
+
+    Args:
+        path: 移行元の JSON ファイル
+        offset: 再開位置（前回 yield したバイト位置）。None なら先頭から
+        chunk_size: 1 回に読み込むバイト数
+
+    Yields:
+        (session_id, session, end_offset)。session は参照展開済み、end_offset はこのセッションの
+        直後のバイト位置（チェックポイントに記録して再開に使う）。
+    """
+    with open(path, "rb") as f:
+        reader = _StreamReader(f, offset or 0, chunk_size)
+        first = offset is None
+        if first:
+            reader.expect("{")
+            while True:
+                if reader.peek() == "}":
+                    return  # "sessions" が無い
+                key = reader.value()
+                reader.expect(":")
+                if key == "sessions":
+                    reader.expect("{")
+                    break
+                reader.value()  # 他のトップレベル項目は読み飛ばす
+                if reader.peek() == ",":
+                    reader.expect(",")
+        while True:
+            if reader.peek() == "}":
+                return
+            if not first:
+                reader.expect(",")
+            first = False
+            session_id = reader.value()
+            reader.expect(":")
+            session = reader.value()
+            if not isinstance(session_id, str) or not isinstance(session, dict):
+                raise MigrationError(f"セッションの形式が不正です (byte {reader.offset()})")
+            yield session_id, unpack_session(session), reader.offset()
+
+
+# ========================================
+# チェックサム
+# ========================================
+def _canonical(session: dict) -> dict:
+    """バックエンドによる差（ストア管理項目・空の既定値）を除いた比較用の形"""
+    return {
+        k: v for k, v in session.items()
+        if k not in _STORE_MANAGED_FIELDS and v is not None and v is not False and v != {} and v != []
+    }
+
+
+def session_checksum(session: dict) -> str:
+    """セッション内容の SHA-256（キー順・バックエンドの既定値に依存しない）"""
+    raw = json.dumps(_canonical(session), ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def session_counts(session: dict) -> dict:
+    return {
+        "turns": len(session.get("messages") or []),
+        "history": len(session.get("conversation_history") or []),
+        "errors": len(session.get("errors") or []),
+    }
+
+
+# ========================================
+# 移行
+# ========================================
+def checkpoint_paths(target_path: Path) -> tuple[Path, Path]:
+    """移行先に対応するチェックポイントと台帳のパス"""
+    target_path = Path(target_path)
+    return (
+        target_path.with_name(f"{target_path.name}.migrate.json"),
+        target_path.with_name(f"{target_path.name}.migrate.jsonl"),
+    )
+
+
+def _source_key(path: Path) -> list:
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_checkpoint(target_path: Path) -> dict | None:
+    checkpoint_path, _ = checkpoint_paths(target_path)
+    if not checkpoint_path.exists():
+        return None
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def migrate_log(
+    source: Path,
+    store: SessionStore,
+    *,
+    batch_size: int = 200,
+    restart: bool = False,
+    progress=None,
+) -> dict:
+    """移行元の JSON ログを store へ逐次移行する。
+
+    Args:
+        source: 移行元の JSON ファイル（{"sessions": {...}} 形式）
+        store: 移行先のストア（get_session_store() で取得したもの）
+        batch_size: 1 回の batch() で書き込むセッション数
+        restart: True ならチェックポイントを無視して最初からやり直す
+        progress: バッチを確定するたびに呼ばれる関数。チェックポイントと同じ dict を受け取る
+
+    Returns:
+        最終的なチェックポイント（sessions / offset / total_bytes / completed など）。
+
+    Raises:
+        MigrationError: 移行元の形式不正、またはチェックポイント作成後に移行元が変更された場合。
+    """
+    source = Path(source)
+    checkpoint_path, ledger_path = checkpoint_paths(store.path)
+    checkpoint = None if restart else load_checkpoint(store.path)
+    if checkpoint is not None:
+        if checkpoint.get("source") != str(source.resolve()) or checkpoint.get("source_key") != _source_key(source):
+            raise MigrationError(
+                f"チェックポイント作成後に移行元が変わっています: {checkpoint.get('source')}（--restart で最初からやり直す）"
+            )
+        if checkpoint.get("completed"):
+            logger.info("migrate_log: 移行済み (%d セッション)", checkpoint["sessions"])
+            return checkpoint
+        logger.info("migrate_log: 再開 %d セッション済み, byte %d", checkpoint["sessions"], checkpoint["offset"])
+    else:
+        checkpoint = {
+            "source": str(source.resolve()),
+            "source_key": _source_key(source),
+            "backend": store.backend,
+            "target": str(Path(store.path).resolve()),
+            "total_bytes": os.path.getsize(source),
+            "offset": None,
+            "sessions": 0,
+            "completed": False,
+        }
+        if ledger_path.exists():
+            ledger_path.unlink()
+
+    started = time.monotonic()
+    resumed_sessions = checkpoint["sessions"]
+    resumed_elapsed = checkpoint.get("elapsed_seconds", 0.0)
+
+    def commit(batch: list[tuple[str, dict]], offset: int | None) -> None:
+        with store.batch():
+            for session_id, session in batch:
+                store.create_session(session)
+        store.flush()
+        lines = "".join(
+            json.dumps(
+                {"session_id": sid, "checksum": session_checksum(s), **session_counts(s)}, ensure_ascii=False,
+            ) + "\n"
+            for sid, s in batch
+        )
+        with open(ledger_path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        checkpoint["sessions"] += len(batch)
+        if offset is not None:
+            checkpoint["offset"] = offset
+        checkpoint["elapsed_seconds"] = round(resumed_elapsed + time.monotonic() - started, 3)  # 中断前の分も含む
+        atomic_write_text(checkpoint_path, json.dumps(checkpoint, ensure_ascii=False, indent=2))
+        if progress is not None:
+            progress(dict(checkpoint))
+
+    batch: list[tuple[str, dict]] = []
+    offset = checkpoint["offset"]
+    for session_id, session, offset in iter_log_sessions(source, checkpoint["offset"]):
+        if session.get("session_id") != session_id:
+            session = {**session, "session_id": session_id}
+        batch.append((session_id, session))
+        if len(batch) >= batch_size:
+            commit(batch, offset)
+            batch = []
+    checkpoint["completed"] = True
+    commit(batch, offset)
+    logger.info(
+        "migrate_log: 完了 %d セッション (今回 %d) %s -> %s:%s",
+        checkpoint["sessions"], checkpoint["sessions"] - resumed_sessions, source, store.backend, store.path,
+    )
+    return checkpoint
+
+
+def verify_migration(store: SessionStore, max_problems: int = 20) -> dict:
+    """台帳の各セッションを移行先から読み直し、件数とチェックサムを照合する。
+
+    Returns:
+        {"checked": 照合したセッション数, "completed": 移行が完了しているか,
+         "problems": [(session_id, 内容), ...]（最大 max_problems 件）, "problem_count": 不一致の総数}
+    """
+    checkpoint = load_checkpoint(store.path) or {}
+    _, ledger_path = checkpoint_paths(store.path)
+    result = {"checked": 0, "completed": bool(checkpoint.get("completed")), "problems": [], "problem_count": 0}
+    if not ledger_path.exists():
+        result["problems"].append(("-", f"台帳がありません: {ledger_path}"))
+        result["problem_count"] = 1
+        return result
+
+    def problem(session_id: str, detail: str) -> None:
+        result["problem_count"] += 1
+        if len(result["problems"]) < max_problems:
+            result["problems"].append((session_id, detail))
+
+    seen: set[str] = set()
+    with open(ledger_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            session_id = entry["session_id"]
+            if session_id in seen:
+                continue  # 中断・再開で再投入されたセッション
+            seen.add(session_id)
+            result["checked"] += 1
+            session = store.get_session(session_id)
+            if session is None:
+                problem(session_id, "移行先にありません")
+                continue
+            counts = session_counts(session)
+            expected = {k: entry[k] for k in counts}
+            if counts != expected:
+                problem(session_id, f"件数不一致 {counts} != {expected}")
+            elif session_checksum(session) != entry["checksum"]:
+                problem(session_id, "チェックサム不一致")
+    if result["checked"] != checkpoint.get("sessions"):
+        problem("-", f"台帳のセッション数 {result['checked']} がチェックポイント {checkpoint.get('sessions')} と一致しません")
+    return result
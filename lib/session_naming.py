@@ -0,0 +1,308 @@
+"""
+lib/session_naming.py - セッション名の生成をバックグラウンドで行う
+
+LLM によるセッション名の生成を Streamlit のスクリプトスレッドから切り離し、スレッドプール
+（SESSION_NAMING_WORKERS 本、プロセス内で共有）で実行する。生成した名前はワーカーが
+ストアの rename_session() で保存し、画面には次の再実行時に反映される（UI は待たない）。
+
+- submit_naming(): 生成を依頼する（同じセッションの生成が進行中なら何もしない）
+- cancel_naming(): 進行中の生成を取り消す（送信中の呼び出しは CancelToken でストリームを閉じて打ち切る）
+- naming_status(): 進行状況（pending / done / failed / cancelled）
+- take_result(): 終わった結果を受け取って消す（名前変更欄への反映・失敗の表示用）
+- naming_stats(): 進行中・完了・失敗の数（フッター表示用）
+
+一括操作ビューの「LLMで名前を生成」は BatchNamingJob で行う。デプロイごとに同時に送る数を
+SESSION_NAMING_MAX_IN_FLIGHT までに抑えながら並行して生成し、すべて終わったら（取り消した場合は
+実行中の呼び出しを打ち切ってから）名前の変更をまとめて 1 回の書き込み（store.batch()）で保存する。
+
+generate は generate(cancel) -> 名前 の形で、cancel（lib/llm_stream.py の CancelToken）を LLM の呼び出しに渡す。
+取り消された生成の結果（途中までの名前）は保存しない。
+
+使い方:
+    submit_naming(session_store, session_id, lambda cancel: generate_session_name_with_llm(..., cancel=cancel))
+    result = take_result(session_id)  # 次の再実行で
+
+    job_id = start_batch_naming(session_store, [(session_id, deployment_key, generate), ...], max_in_flight=4)
+    get_batch_job(job_id).progress()   # 進捗の表示
+    get_batch_job(job_id).cancel()     # 新しい呼び出しを止め、実行中の呼び出しを打ち切る
+"""
+
+import atexit
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.llm_stream import CancelToken
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+NAMING_WORKERS = int(os.getenv("SESSION_NAMING_WORKERS", "2"))
+# 一括生成でデプロイごとに同時に送る最大数
+MAX_IN_FLIGHT = int(os.getenv("SESSION_NAMING_MAX_IN_FLIGHT", "4"))
+# 受け取られないまま残る結果の上限（古いものから捨てる）
+_MAX_FINISHED = 500
+# 終わった一括生成ジョブを残す秒数（他のブラウザの進捗表示が結果を読み終えるまで消さない）
+_JOB_RETENTION_SECONDS = 30 * 60
+
+_executor: ThreadPoolExecutor | None = None
+_tasks: dict[str, dict] = {}
+_tasks_lock = threading.Lock()
+_counters = {"submitted": 0, "done": 0, "failed": 0, "cancelled": 0}
+_jobs: dict[str, "BatchNamingJob"] = {}
+_jobs_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """スレッドプールを返す（初回に作る）。_tasks_lock を保持して呼ぶこと"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=NAMING_WORKERS, thread_name_prefix="session-naming")
+        atexit.register(_shutdown)
+    return _executor
+
+
+def _shutdown() -> None:
+    """終了時に未着手の生成を取り消す（実行中のものは待たない）"""
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run(store, session_id: str, generate, cancel: CancelToken) -> None:
+    started = time.perf_counter()
+    try:
+        name = None if cancel.cancelled else generate(cancel)
+        if cancel.cancelled:
+            update = {"status": "cancelled"}
+            logger.info("session_naming: 取り消し session_id=%s, elapsed=%.3fs", session_id, time.perf_counter() - started)
+        elif not name:
+            raise ValueError("セッション名を生成できませんでした")
+        else:
+            store.rename_session(session_id, name, generated_by_llm=True)
+            update = {"status": "done", "name": name}
+            logger.info("session_naming: 完了 session_id=%s, name='%s', elapsed=%.3fs",
+                        session_id, name, time.perf_counter() - started)
+    except Exception as e:
+        logger.exception("session_naming: 失敗 session_id=%s", session_id)
+        update = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+    with _tasks_lock:
+        _counters[update["status"]] += 1
+        task = _tasks.get(session_id)
+        if task is not None:
+            task.update(update, finished_at=time.time(), elapsed_seconds=round(time.perf_counter() - started, 3))
+        finished = [sid for sid, t in _tasks.items() if t["status"] != "pending"]
+        for sid in finished[:max(0, len(finished) - _MAX_FINISHED)]:
+            del _tasks[sid]
+
+
+def submit_naming(store, session_id: str, generate) -> bool:
+    """generate(cancel) -> 名前 をバックグラウンドで実行し、ストアに保存する。
+
+    Returns:
+        依頼したら True、同じセッションの生成が進行中なら False
+    """
+    with _tasks_lock:
+        task = _tasks.get(session_id)
+        if task is not None and task["status"] == "pending":
+            return False
+        cancel = CancelToken()
+        _tasks[session_id] = {"status": "pending", "submitted_at": time.time(), "cancel": cancel}
+        _counters["submitted"] += 1
+        _get_executor().submit(_run, store, session_id, generate, cancel)
+    logger.info("session_naming: 依頼 session_id=%s", session_id)
+    return True
+
+
+def cancel_naming(session_id: str) -> bool:
+    """進行中の生成を取り消す（まだ始まっていなければ送らない）。取り消したら True"""
+    with _tasks_lock:
+        task = _tasks.get(session_id)
+        if task is None or task["status"] != "pending":
+            return False
+        cancel = task["cancel"]
+    cancel.cancel()
+    logger.info("session_naming: 取り消し依頼 session_id=%s", session_id)
+    return True
+
+
+def naming_status(session_id: str) -> str | None:
+    """生成の状態（"pending" / "done" / "failed" / "cancelled"。依頼が無い・受け取り済みなら None）"""
+    with _tasks_lock:
+        task = _tasks.get(session_id)
+        return task["status"] if task else None
+
+
+def take_result(session_id: str) -> dict | None:
+    """終わった生成の結果（status と name または error）を返して消す。進行中・依頼なしなら None"""
+    with _tasks_lock:
+        task = _tasks.get(session_id)
+        if task is None or task["status"] == "pending":
+            return None
+        return _tasks.pop(session_id)
+
+
+def naming_stats() -> dict:
+    """進行中の数と、これまでの依頼・完了・失敗・取り消しの数"""
+    with _tasks_lock:
+        return {
+            "pending": sum(1 for t in _tasks.values() if t["status"] == "pending"),
+            "workers": NAMING_WORKERS,
+            **_counters,
+        }
+
+
+# ========================================
+# 一括生成
+# ========================================
+class BatchNamingJob:
+    """複数セッションの名前をデプロイごとの同時実行数を守りながら並行して生成し、まとめて保存する"""
+
+    def __init__(self, store, items: list, max_in_flight: int = MAX_IN_FLIGHT):
+        """
+        Args:
+            store: 名前を保存するストア
+            items: (session_id, デプロイのキー, generate) のリスト。generate(cancel) -> 名前
+            max_in_flight: デプロイのキーごとの最大同時実行数
+        """
+        self.job_id = uuid.uuid4().hex[:12]
+        self.store = store
+        self.max_in_flight = max(1, max_in_flight)
+        self._queues: dict[str, deque] = {}
+        for session_id, deployment_key, generate in items:
+            self._queues.setdefault(deployment_key, deque()).append((session_id, generate))
+        self._in_flight = {key: 0 for key in self._queues}
+        self._cond = threading.Condition()
+        self._cancelled = False
+        # 実行中の呼び出しの CancelToken（取り消したら打ち切る）
+        self._tokens: dict[str, CancelToken] = {}
+        self.total = len(items)
+        self.names: dict[str, str] = {}
+        self.errors: dict[str, str] = {}
+        self.stopped = 0  # 実行中に打ち切った数
+        self.status = "running"  # running / committing / finished / failed
+        self.committed = 0
+        self.commit_error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._thread = threading.Thread(target=self._coordinate, name=f"batch-naming-{self.job_id}", daemon=True)
+
+    def start(self) -> "BatchNamingJob":
+        self._thread.start()
+        return self
+
+    def cancel(self) -> None:
+        """まだ送っていないセッションの生成を取りやめ、実行中の呼び出しも打ち切る（それまでに生成できた名前は保存する）"""
+        with self._cond:
+            self._cancelled = True
+            tokens = list(self._tokens.values())
+            self._cond.notify_all()
+        for token in tokens:
+            token.cancel()
+        logger.info("BatchNamingJob: 取り消し job_id=%s, 実行中 %d 件を打ち切り", self.job_id, len(tokens))
+
+    def _call(self, deployment_key: str, session_id: str, generate, cancel: CancelToken) -> None:
+        try:
+            name = generate(cancel)
+            if cancel.cancelled:
+                outcome = ("stopped", None)
+            elif not name:
+                raise ValueError("セッション名を生成できませんでした")
+            else:
+                outcome = ("name", name)
+        except Exception as e:
+            logger.warning("BatchNamingJob: 失敗 session_id=%s, error=%s: %s", session_id, type(e).__name__, e)
+            outcome = ("error", f"{type(e).__name__}: {e}")
+        with self._cond:
+            if outcome[0] == "stopped":
+                self.stopped += 1
+            else:
+                (self.names if outcome[0] == "name" else self.errors)[session_id] = outcome[1]
+            self._tokens.pop(session_id, None)
+            self._in_flight[deployment_key] -= 1
+            self._cond.notify_all()
+
+    def _coordinate(self) -> None:
+        workers = max(1, min(self.total, self.max_in_flight * len(self._queues)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"batch-naming-{self.job_id}") as pool:
+            with self._cond:
+                while True:
+                    if not self._cancelled:
+                        # デプロイごとに、同時実行数に空きがある分だけ送る
+                        for key, queue in self._queues.items():
+                            while queue and self._in_flight[key] < self.max_in_flight:
+                                session_id, generate = queue.popleft()
+                                self._in_flight[key] += 1
+                                self._tokens[session_id] = CancelToken()
+                                pool.submit(self._call, key, session_id, generate, self._tokens[session_id])
+                    remaining = 0 if self._cancelled else sum(len(q) for q in self._queues.values())
+                    if not remaining and not any(self._in_flight.values()):
+                        break
+                    self._cond.wait()
+                self.status = "committing"
+        self._commit()
+
+    def _commit(self) -> None:
+        """生成できた名前をまとめて 1 回の書き込みで保存する（name_changes も同じ書き込みに含まれる）"""
+        try:
+            with self.store.batch():
+                for session_id, name in self.names.items():
+                    self.store.rename_session(session_id, name, generated_by_llm=True)
+            self.committed = len(self.names)
+            self.status = "finished"
+        except Exception as e:
+            logger.exception("BatchNamingJob: 保存に失敗 job_id=%s", self.job_id)
+            self.commit_error = f"{type(e).__name__}: {e}"
+            self.status = "failed"
+        self.finished_at = time.time()
+        logger.info(
+            "BatchNamingJob: 完了 job_id=%s, total=%d, named=%d, failed=%d, stopped=%d, cancelled=%s, elapsed=%.2fs",
+            self.job_id, self.total, len(self.names), len(self.errors), self.stopped, self._cancelled,
+            self.finished_at - self.started_at,
+        )
+
+    def progress(self) -> dict:
+        """進捗（件数・実行中の数・状態・経過秒数）"""
+        with self._cond:
+            return {
+                "job_id": self.job_id,
+                "status": self.status,
+                "total": self.total,
+                "named": len(self.names),
+                "failed": len(self.errors),
+                "stopped": self.stopped,
+                "in_flight": sum(self._in_flight.values()),
+                "remaining": sum(len(q) for q in self._queues.values()),
+                "cancelled": self._cancelled,
+                "committed": self.committed,
+                "commit_error": self.commit_error,
+                "max_in_flight": self.max_in_flight,
+                "deployments": len(self._queues),
+                "elapsed_seconds": round((self.finished_at or time.time()) - self.started_at, 2),
+            }
+
+
+def start_batch_naming(store, items: list, max_in_flight: int = MAX_IN_FLIGHT) -> str:
+    """一括生成を開始してジョブ ID を返す（ジョブはプロセス内で共有し、get_batch_job() で参照する）"""
+    job = BatchNamingJob(store, items, max_in_flight)
+    with _jobs_lock:
+        # 終わってから _JOB_RETENTION_SECONDS 秒たったジョブを、新しいジョブを始めるときに片付ける
+        # （_jobs はプロセス内の全セッションで共有するため、終わったばかりのジョブは残す）
+        expire_before = time.time() - _JOB_RETENTION_SECONDS
+        for job_id in [j for j, old in _jobs.items()
+                       if old.finished_at is not None and old.finished_at < expire_before]:
+            del _jobs[job_id]
+        _jobs[job.job_id] = job
+    logger.info("start_batch_naming: job_id=%s, sessions=%d, deployments=%d, max_in_flight=%d",
+                job.job_id, job.total, len(job._queues), job.max_in_flight)
+    return job.start().job_id
+
+
+def get_batch_job(job_id: str | None) -> BatchNamingJob | None:
+    with _jobs_lock:
+        return _jobs.get(job_id) if job_id else None
@@ -0,0 +1,915 @@
+"""
+lib/session_store.py - 会話ログ（セッション）ストレージ層
+
+streamlit_app.py はセッションの読み書きをすべて本モジュールの
+SessionStore API 経由で行う。log_data dict を直接書き換えてファイル全体を
+保存し直すのではなく、「メッセージ追加」「名前変更」「状態変更」などの
+操作単位でバックエンドに書き込む。
+
+バックエンド:
+- "json"   : JsonSessionStore   … 従来どおり 1 ファイル (data/chat_log.json) に保存
+- "journal": JournalSessionStore … JSON スナップショット + 追記専用ジャーナル。
+                                   1 操作 = ジャーナル 1 行の追記 (lib/session_journal.py)
+- "sqlite" : SqliteSessionStore … SQLite (WAL モード)。セッション・メッセージ・
+                                   エラー・名前変更履歴を行として保存 (lib/sqlite_store.py)
+- "sharded": ShardedSessionStore … 1 セッション 1 ファイル + サマリのマニフェスト
+                                   (lib/sharded_store.py)
+
+保存形式 (format_version 2):
+    messages[].request.user_input / response.ai_response の本文は保存時に
+    conversation_history への参照 {"$history": <index>} に置き換え、本文を 1 回だけ
+    保存する。読み込み時に参照を展開するため、get_session() / list_sessions() が返す
+    構造は従来と同じ。format_version の無い旧形式はそのまま読め、次の保存で移行される。
+
+使い方:
+    from lib.session_store import get_session_store
+    store = get_session_store("sqlite", Path("data/chat_log.sqlite3"))
+    store.rename_session(session_id, "新しい名前")
+"""
+
+import contextlib
+import copy
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from lib.logger import get_logger
+from lib.write_behind import WriteBehindPersister
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス内ロックのみ
+    fcntl = None
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+SESSION_STORE_BACKENDS = ("json", "journal", "sqlite", "sharded")
+
+# セッションサマリ（サイドバー・ゴミ箱・一括操作ビュー用の軽量索引）に含めるフィールド
+SUMMARY_MODEL_FIELDS = (
+    "deployment_name", "display_name", "region", "model_type",
+    "provider", "provider_icon", "constructor", "constructor_icon",
+)
+SUMMARY_TIMESTAMP_FIELDS = ("created_at", "updated_at", "last_llm_response_at", "deleted_at", "ended_at")
+
+# 楽観的並行制御: バージョン競合時の再試行回数（超えたらロックを保持したまま適用する）
+_CAS_MAX_RETRIES = 8
+
+# json バックエンドの書き込み集約ウィンドウ（0 で同期書き込み）
+_WRITE_BEHIND_SECONDS = float(os.getenv("SESSION_WRITE_BEHIND_MS", "200")) / 1000
+
+# 保存形式のバージョン（2: メッセージ本文を conversation_history への参照で保存）
+SESSION_FORMAT_VERSION = 2
+_HISTORY_REF = "$history"
+
+
+def _now_iso() -> str:
+    """現在時刻の ISO 8601 文字列"""
+    return datetime.now().isoformat()
+
+
+_process_locks: dict[str, threading.Lock] = {}
+_process_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path: Path):
+    """path をロックファイルとする排他ロック（プロセス間・スレッド間）。
+
+    fcntl.flock はオープンごとに独立しているため、同一プロセス内の別スレッドとも排他になる。
+    fcntl の無い環境ではプロセス内のロックだけを取る。
+    """
+    if fcntl is None:
+        with _process_locks_guard:
+            lock = _process_locks.setdefault(str(path), threading.Lock())
+        with lock:
+            yield
+        return
+    with open(path, "a+b") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def session_version(session: dict | None) -> int:
+    """セッションのバージョン（イベントを適用するたびに 1 増える。旧データは 0）"""
+    return (session or {}).get("version", 0)
+
+
+def atomic_write_text(path: Path, text: str) -> None:
+    """一時ファイルに書き込み fsync してから rename する（途中で落ちても元ファイルは壊れない）。
+
+    一時ファイル名にはプロセス ID とスレッド ID を含め、同じファイルへの同時書き込みが
+    互いの一時ファイルを上書きしないようにする。
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# ========================================
+# 読み取り専用ビュー
+# ========================================
+def _read_only(*args, **kwargs):
+    raise TypeError("ストアから取得したセッションは読み取り専用です（copy.deepcopy で可変コピーを作成してください）")
+
+
+class ReadOnlyDict(dict):
+    """変更操作を禁止した dict。ストアのキャッシュをブラウザセッション間で共有するために使う。
+
+    dict のサブクラスなので json.dumps や isinstance(x, dict) はそのまま動く。
+    copy() は浅い可変コピー、copy.deepcopy() は深い可変コピー（通常の dict / list）を返す。
+    """
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _read_only
+
+    def copy(self) -> dict:
+        return dict(self)
+
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo) -> dict:
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class ReadOnlyList(list):
+    """変更操作を禁止した list（ReadOnlyDict と同じ方針）"""
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def copy(self) -> list:
+        return list(self)
+
+    def __copy__(self) -> list:
+        return list(self)
+
+    def __deepcopy__(self, memo) -> list:
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(value):
+    """dict / list を再帰的に読み取り専用ビューへ変換する（凍結済みの部分はそのまま再利用）"""
+    if isinstance(value, (ReadOnlyDict, ReadOnlyList)):
+        return value
+    if isinstance(value, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ReadOnlyList(freeze(v) for v in value)
+    return value
+
+
+# ========================================
+# セッションサマリ
+# ========================================
+def build_session_summary(session: dict) -> dict:
+    """セッション dict から一覧表示用のサマリを作る（conversation_history / messages 本体は含めない）。
+
+    Returns:
+        session_id, session_name, status, deleted, purged_from_trash, model（表示用フィールドのみ）,
+        各タイムスタンプ（存在するもののみ）, archived, turn_count, total_tokens, total_cost_usd を持つ dict。
+    """
+    messages = session.get("messages") or []
+    model = session.get("model") or {}
+    summary = {
+        "session_id": session.get("session_id"),
+        "session_name": session.get("session_name", session.get("session_id")),
+        "status": session.get("status", "active"),
+        "deleted": bool(session.get("deleted", False)),
+        "purged_from_trash": bool(session.get("purged_from_trash", False)),
+        "model": {k: model[k] for k in SUMMARY_MODEL_FIELDS if k in model},
+    }
+    for key in SUMMARY_TIMESTAMP_FIELDS:
+        if session.get(key):
+            summary[key] = session[key]
+    archived = session.get("archived")
+    summary["archived"] = bool(archived)
+    if archived:
+        # アーカイブ済み（lib/session_archive.py）は本体がブロブにあるため、スタブの集計値を使う
+        summary["turn_count"] = archived.get("turn_count", 0)
+        summary["total_tokens"] = archived.get("total_tokens", 0)
+        summary["total_cost_usd"] = archived.get("total_cost_usd", 0)
+        return summary
+    summary["turn_count"] = len(messages)
+    summary["total_tokens"] = sum(m.get("metrics", {}).get("total_tokens", 0) for m in messages)
+    summary["total_cost_usd"] = round(sum(m.get("cost", {}).get("total_cost_usd", 0) for m in messages), 6)
+    return summary
+
+
+# ========================================
+# 保存形式（メッセージ本文の重複排除）
+# ========================================
+def _is_history_ref(value) -> bool:
+    return isinstance(value, dict) and _HISTORY_REF in value
+
+
+def pack_messages(history: list, messages: list, offset: int = 0) -> list:
+    """messages[] の本文を conversation_history への参照に置き換えたリストを返す。
+
+    各 message_log の request.user_input / response.ai_response と同じ内容の
+    履歴エントリを先頭から順に探し、見つかったものだけを {"$history": index} にする。
+    見つからない本文（履歴が手で編集された場合など）はそのまま残す。
+
+    Args:
+        history: 参照先の conversation_history
+        messages: message_log のリスト（変更しない）
+        offset: 参照に加えるインデックスのずれ（history が履歴全体の途中から始まる場合）
+
+    Returns:
+        本文を参照に置き換えた message_log のリスト（変更のないものは元のオブジェクト）。
+    """
+    packed = []
+    pos = 0
+    for message in messages:
+        request = message.get("request") or {}
+        response = message.get("response") or {}
+        user_ref = ai_ref = None
+        user_input = request.get("user_input")
+        if isinstance(user_input, str):
+            for i in range(pos, len(history)):
+                entry = history[i]
+                if entry.get("role") == "user" and entry.get("content") == user_input:
+                    user_ref, pos = i, i + 1
+                    break
+        ai_response = response.get("ai_response")
+        if isinstance(ai_response, str) and pos < len(history):
+            entry = history[pos]
+            if entry.get("role") == "assistant" and entry.get("content") == ai_response:
+                ai_ref, pos = pos, pos + 1
+        if user_ref is None and ai_ref is None:
+            packed.append(message)
+            continue
+        message = dict(message)
+        if user_ref is not None:
+            message["request"] = {**request, "user_input": {_HISTORY_REF: offset + user_ref}}
+        if ai_ref is not None:
+            message["response"] = {**response, "ai_response": {_HISTORY_REF: offset + ai_ref}}
+        packed.append(message)
+    return packed
+
+
+def unpack_messages(history: list, messages: list, offset: int = 0) -> list:
+    """pack_messages の逆変換。参照を conversation_history の本文に展開する。"""
+    unpacked = []
+    for message in messages:
+        request = message.get("request") or {}
+        response = message.get("response") or {}
+        user_input = request.get("user_input")
+        ai_response = response.get("ai_response")
+        if not _is_history_ref(user_input) and not _is_history_ref(ai_response):
+            unpacked.append(message)
+            continue
+        message = dict(message)
+        if _is_history_ref(user_input):
+            message["request"] = {**request, "user_input": history[user_input[_HISTORY_REF] - offset]["content"]}
+        if _is_history_ref(ai_response):
+            message["response"] = {**response, "ai_response": history[ai_response[_HISTORY_REF] - offset]["content"]}
+        unpacked.append(message)
+    return unpacked
+
+
+def pack_session(session: dict) -> dict:
+    """保存用にセッションを format_version 2 へ変換した dict を返す（元の dict は変更しない）"""
+    packed = {**session, "format_version": SESSION_FORMAT_VERSION}
+    if session.get("messages"):
+        packed["messages"] = pack_messages(session.get("conversation_history") or [], session["messages"])
+    return packed
+
+
+def unpack_session(session: dict) -> dict:
+    """保存形式のセッションをアプリが扱う形（参照展開済み・format_version なし）に戻す。
+
+    format_version の無い旧形式はそのまま返す。
+    """
+    if "format_version" not in session:
+        return session
+    unpacked = {k: v for k, v in session.items() if k != "format_version"}
+    if session.get("messages"):
+        unpacked["messages"] = unpack_messages(session.get("conversation_history") or [], session["messages"])
+    return unpacked
+
+
+def pack_log_data(data: dict) -> dict:
+    """{"sessions": {...}} 全体を保存形式に変換する"""
+    return {**data, "sessions": {sid: pack_session(s) for sid, s in data.get("sessions", {}).items()}}
+
+
+def unpack_log_data(data: dict) -> dict:
+    """pack_log_data の逆変換（旧形式のセッションはそのまま）"""
+    return {**data, "sessions": {sid: unpack_session(s) for sid, s in data.get("sessions", {}).items()}}
+
+
+# ========================================
+# イベント適用（JSON 系バックエンド共通）
+# ========================================
+def apply_event(sessions: dict, event: dict) -> bool:
+    """ストア操作を表すイベントを sessions dict に適用する。
+
+    JSON 系バックエンドはすべての書き込みをイベントとして表現し、
+    この関数でメモリ上のセッション dict に反映する。適用したセッションの
+    version を 1 増やす（楽観的並行制御の比較に使う）。
+
+    Args:
+        sessions: session_id -> セッション dict。直接変更される。
+        event: ``{"op": ..., "session_id": ..., ...}`` 形式のイベント。
+
+    Returns:
+        対象セッションに適用できた場合 True。
+    """
+    op = event["op"]
+    session_id = event["session_id"]
+
+    if op == "create":
+        session = copy.deepcopy(event["session"])
+        session["version"] = session_version(session) + 1
+        sessions[session_id] = session
+        return True
+
+    session = sessions.get(session_id)
+    if session is None:
+        logger.warning("apply_event: セッションが存在しません op=%s, session_id=%s", op, session_id)
+        return False
+
+    if op == "append_turn":
+        session.setdefault("conversation_history", []).extend(copy.deepcopy(event["history"]))
+        session.setdefault("messages", []).append(copy.deepcopy(event["message"]))
+        session["updated_at"] = event["at"]
+        session["last_llm_response_at"] = event["at"]
+    elif op == "append_error":
+        session.setdefault("errors", []).append(copy.deepcopy(event["error"]))
+        session["updated_at"] = event["error"].get("timestamp", event["at"])
+    elif op == "rename":
+        change = {
+            "timestamp": event["at"],
+            "old_name": session.get("session_name", session_id),
+            "new_name": event["new_name"],
+        }
+        if event.get("generated_by_llm"):
+            change["generated_by_llm"] = True
+        session["session_name"] = event["new_name"]
+        session["updated_at"] = event["at"]
+        session.setdefault("name_changes", []).append(change)
+    elif op == "update":
+        session.update(copy.deepcopy(event.get("fields", {})))
+        for key in event.get("unset", []):
+            session.pop(key, None)
+    else:
+        raise ValueError(f"未知のイベント op={op}")
+    session["version"] = session_version(session) + 1
+    return True
+
+
+def apply_event_cow(sessions: dict, event: dict) -> bool:
+    """凍結済みセッションの map にイベントをコピーオンライトで適用する。
+
+    対象セッションだけを可変コピーしてから apply_event で変更し、再凍結して差し替える。
+    変更前のセッションオブジェクトは他の読み手が参照していても変化しない。
+
+    Args:
+        sessions: session_id -> 凍結済みセッション。エントリが差し替えられる（可変 dict であること）。
+        event: apply_event と同じ形式のイベント。
+    """
+    session_id = event["session_id"]
+    if event["op"] == "create" or session_id not in sessions:
+        working = {}
+        applied = apply_event(working, event)
+        if applied:
+            sessions[session_id] = freeze(working[session_id])
+        return applied
+    working = {session_id: copy.deepcopy(sessions[session_id])}
+    applied = apply_event(working, event)
+    sessions[session_id] = freeze(working[session_id])
+    return applied
+
+
+# ========================================
+# 抽象ストア
+# ========================================
+class SessionStore:
+    """セッションストアの共通インターフェース。
+
+    サブクラスは list_sessions / get_session / create_session / append_turn /
+    append_error / rename_session / update_session / batch を実装する。
+    状態変更系の便利メソッド（終了・削除・復元など）は update_session の上に
+    この基底クラスで定義する。
+    """
+
+    backend = ""
+
+    # --- 読み込み ---
+    def list_sessions(self) -> dict:
+        """全セッションを session_id -> セッション dict で返す"""
+        raise NotImplementedError
+
+    def get_session(self, session_id: str) -> dict | None:
+        """1 セッション分の dict を返す。存在しなければ None。"""
+        raise NotImplementedError
+
+    def list_session_summaries(self) -> dict:
+        """全セッションのサマリ（build_session_summary の形式）を session_id -> dict で返す。
+
+        会話本体を読み込まずに済むよう、各バックエンドは書き込みのたびに索引を更新しておく。
+        """
+        raise NotImplementedError
+
+    def get_session_summary(self, session_id: str) -> dict | None:
+        """1 セッションのサマリを返す（存在しなければ None）"""
+        return self.list_session_summaries().get(session_id)
+
+    def stats(self) -> dict:
+        """バックエンド固有の計測値（キャッシュヒット数・書き込みキュー長など）"""
+        return {}
+
+    def flush(self) -> None:
+        """遅延中の書き込みがあれば完了まで待つ"""
+
+    # --- 書き込み ---
+    def create_session(self, session: dict) -> None:
+        """セッションを新規作成する（messages 等を含む完全な dict も可）"""
+        raise NotImplementedError
+
+    def append_turn(self, session_id: str, history: list, message: dict, at: str | None = None) -> bool:
+        """1 ターン分の会話履歴エントリとメッセージログを追記する。
+
+        Args:
+            session_id: セッション ID
+            history: conversation_history に追加するエントリ（user / assistant）
+            message: messages に追加する message_log
+            at: LLM 応答時刻。updated_at / last_llm_response_at に使う。
+        """
+        raise NotImplementedError
+
+    def append_error(self, session_id: str, error: dict) -> bool:
+        """エラーログを追記する。updated_at はエラーの timestamp に更新。"""
+        raise NotImplementedError
+
+    def rename_session(self, session_id: str, new_name: str, *, generated_by_llm: bool = False) -> bool:
+        """セッション名を変更し、name_changes に履歴を残す"""
+        raise NotImplementedError
+
+    def update_session(self, session_id: str, fields: dict, unset: tuple = (), action: str = "update") -> bool:
+        """トップレベルのフィールドを更新・削除する。
+
+        Args:
+            session_id: セッション ID
+            fields: 上書きするフィールド
+            unset: 削除するフィールド名
+            action: ログ用の操作名（"terminate", "delete" など）
+        """
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ブロック内の複数操作を 1 回の書き込み（トランザクション）にまとめる"""
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+    # --- 状態変更ヘルパー ---
+    def set_status(self, session_id: str, status: str) -> bool:
+        """status を変更する（"active" / "completed"）"""
+        return self.update_session(
+            session_id, {"status": status, "updated_at": _now_iso()}, action=f"status:{status}",
+        )
+
+    def mark_deleted(self, session_id: str) -> bool:
+        """セッションをゴミ箱へ移動する（論理削除）"""
+        now = _now_iso()
+        return self.update_session(
+            session_id, {"deleted": True, "deleted_at": now, "updated_at": now}, action="delete",
+        )
+
+    def restore_session(self, session_id: str) -> bool:
+        """ゴミ箱からセッションを復元する"""
+        return self.update_session(
+            session_id, {"deleted": False, "updated_at": _now_iso()}, unset=("deleted_at",), action="restore",
+        )
+
+    def purge_session(self, session_id: str) -> bool:
+        """ゴミ箱からセッションを完全削除する"""
+        return self.update_session(
+            session_id, {"purged_from_trash": True, "updated_at": _now_iso()}, action="purge",
+        )
+
+    def touch_last_response(self, session_id: str, at: str | None = None) -> bool:
+        """最終更新日時（last_llm_response_at）を更新する"""
+        at = at or _now_iso()
+        return self.update_session(
+            session_id, {"last_llm_response_at": at, "updated_at": at}, action="touch",
+        )
+
+
+# ========================================
+# JSON バックエンド
+# ========================================
+class JsonSessionStore(SessionStore):
+    """1 つの JSON ファイル ({"sessions": {...}}) に全セッションを保存するストア。
+
+    従来の load_log_data() / save_log_data() と同じファイル形式。
+    パース結果はファイルの (mtime_ns, size, inode) をキーにプロセス内でキャッシュし、
+    ファイルが変わっていなければ stat() 1 回で返す。キャッシュは全ブラウザセッションで
+    共有されるため、読み込み結果は読み取り専用ビュー（ReadOnlyDict / ReadOnlyList）で返し、
+    書き込みは対象セッションだけをコピーオンライトで差し替える。
+
+    セッションサマリは索引ファイル (chat_log.index.json) にも保存し、対応する
+    ログファイルの同一性キーを記録しておく。別プロセスの起動直後などでも、
+    ログ本体をパースせずにサイドバーを描画できる。
+
+    SESSION_WRITE_BEHIND_MS > 0 のときは保存を WriteBehindPersister (lib/write_behind.py) に
+    委ね、スクリプトスレッドはメモリ上の状態を差し替えるだけで戻る。書き込み待ちの状態は
+    _pending に保持し、読み込みはそれを優先して返す。
+
+    並行書き込み:
+    - スレッド間: イベントの適用（セッションのコピーと変更）はロック外で行い、
+      差し替えの瞬間だけロックを取ってセッションの version を比較する（compare-and-swap）。
+      他のスレッドが先に同じセッションを更新していたら最新の状態に適用し直す
+    - プロセス間: ファイル書き込みは <ログ>.lock の fcntl ロック下で行う。最後に読み書きした後に
+      別プロセスがファイルを更新していたら、ディスクの内容に未保存のイベントを再適用してから書く
+    """
+
+    backend = "json"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._batch_data: dict | None = None
+        self._batch_depth = 0
+        self._cache_key: tuple | None = None
+        self._cache_data: dict | None = None
+        self.cache_stats = {"hits": 0, "misses": 0}
+        self.index_path = self.path.with_name(f"{self.path.stem}.index.json")
+        self._summaries: dict | None = None
+        self._summaries_key: tuple | None = None
+        self._batch_touched: set[str] = set()
+        self._pending: dict | None = None
+        self.lock_path = self.path.with_name(f"{self.path.name}.lock")
+        self._disk_key: tuple | None = None  # 最後に自プロセスが読み書きしたときのファイルの同一性キー
+        self._event_seq = 0
+        self._written_seq = 0
+        self._unflushed: list[tuple[int, dict]] = []  # ディスク未反映のイベント (seq, event)
+        self._batch_events: list[dict] = []
+        self.cas_stats = {"commits": 0, "conflicts": 0, "fallbacks": 0, "rebases": 0}
+        self.persister = (
+            WriteBehindPersister(self.path.stem, self._write, _WRITE_BEHIND_SECONDS)
+            if _WRITE_BEHIND_SECONDS > 0 else None
+        )
+
+    # --- ファイル I/O ---
+    def _file_key(self) -> tuple | None:
+        """ファイルの同一性キー (mtime_ns, size, inode)。ファイルが無ければ None。"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load(self) -> dict:
+        """ログデータを読み込む（ファイルが変わっていなければキャッシュを返す）"""
+        with self._lock:
+            if self._pending is not None:
+                self.cache_stats["hits"] += 1
+                return self._pending
+            key = self._file_key()
+            if key is not None and key == self._cache_key:
+                self.cache_stats["hits"] += 1
+                return self._cache_data
+            self.cache_stats["misses"] += 1
+            try:
+                if key is not None:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = unpack_log_data(json.load(f))
+                    logger.debug("JsonSessionStore._load: %d セッション読み込み", len(data.get("sessions", {})))
+                else:
+                    logger.debug("JsonSessionStore._load: ファイルなし、空データ返却")
+                    data = {"sessions": {}}
+            except Exception:
+                logger.exception("JsonSessionStore._load: ファイル読み込み失敗 (%s)", self.path)
+                return ReadOnlyDict(sessions=ReadOnlyDict())
+            data.setdefault("sessions", {})
+            self._cache_data = freeze(data)
+            self._cache_key = self._disk_key = key
+            return self._cache_data
+
+    def _save(self, data: dict, touched: set[str] | None = None, events: list | tuple = ()) -> None:
+        """ログデータを保存し、キャッシュとサマリ索引を保存内容で更新する。
+
+        write-behind 有効時はメモリ上の状態とサマリだけを更新して書き込みをキューに積む。
+
+        Args:
+            data: 保存する {"sessions": {...}}
+            touched: 変更したセッション ID。直前の索引が有効ならこのセッションだけ更新する。
+            events: data に含まれる未保存のイベント（別プロセスの書き込みと合流するときに再適用する）
+        """
+        with self._lock:
+            data = freeze(data)
+            sessions = data["sessions"]
+            summaries_valid = self._summaries is not None and (
+                self._pending is not None or self._summaries_key == self._cache_key
+            )
+            if touched is not None and summaries_valid:
+                summaries = dict(self._summaries)
+                for session_id in touched:
+                    if session_id in sessions:
+                        summaries[session_id] = freeze(build_session_summary(sessions[session_id]))
+            else:
+                summaries = {sid: freeze(build_session_summary(s)) for sid, s in sessions.items()}
+            self._summaries = summaries
+            for event in events:
+                self._event_seq += 1
+                self._unflushed.append((self._event_seq, event))
+            snapshot = (data, self._event_seq)
+            if self.persister is not None:
+                self._pending = data
+                self._summaries_key = None
+                self.persister.submit(snapshot)
+                return
+            try:
+                self._write(snapshot)
+            except Exception:
+                self._cache_key = self._cache_data = None
+
+    def _write(self, snapshot: tuple[dict, int]) -> None:
+        """スナップショットをアトミックに書き込み、キャッシュと索引を更新する。
+
+        write-behind 有効時はバックグラウンドスレッドから呼ばれる。data は凍結済みで
+        変更されないため、シリアライズとファイル書き込みはロック外で行う。
+
+        Args:
+            snapshot: (保存する状態, その状態に含まれる最後のイベント番号)
+        """
+        data, seq = snapshot
+        if seq and seq <= self._written_seq:
+            # 別プロセスとの合流時に、このスナップショットのイベントを含む状態をすでに書き込み済み
+            with self._lock:
+                if self._pending is data:
+                    self._pending = None
+            return
+        try:
+            with file_lock(self.lock_path):
+                if self._file_key() != self._disk_key:
+                    data, seq = self._rebase()
+                atomic_write_text(self.path, json.dumps(pack_log_data(data), ensure_ascii=False, indent=2, default=str))
+                disk_key = self._file_key()
+        except Exception:
+            logger.exception("JsonSessionStore._write: ファイル保存失敗 (%s)", self.path)
+            raise
+        logger.debug("JsonSessionStore._write: 保存完了 (%d セッション)", len(data["sessions"]))
+        with self._lock:
+            self._disk_key = disk_key
+            self._written_seq = max(self._written_seq, seq)
+            self._unflushed = [(s, e) for s, e in self._unflushed if s > seq]
+            if self._pending is not None and self._pending is not data:
+                return  # より新しい状態が書き込み待ち。キャッシュと索引はそちらの書き込みで更新する
+            self._pending = None
+            self._cache_data = data
+            self._cache_key = self._summaries_key = disk_key
+            self._write_index()
+
+    def _rebase(self) -> tuple[dict, int]:
+        """別プロセスが書き込んだ内容に、ディスク未反映のイベントを再適用する（ファイルロック下で呼ぶ）"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            disk = unpack_log_data(json.load(f))
+        with self._lock:
+            sessions = {sid: freeze(s) for sid, s in disk.get("sessions", {}).items()}
+            for _, event in self._unflushed:
+                apply_event_cow(sessions, event)
+            data = freeze({**disk, "sessions": sessions})
+            if self._pending is not None:
+                self._pending = data
+            self._summaries = {sid: freeze(build_session_summary(s)) for sid, s in sessions.items()}
+            self.cas_stats["rebases"] += 1
+            logger.warning(
+                "JsonSessionStore: 別プロセスの変更を取り込み、未保存の %d イベントを再適用 (%s)",
+                len(self._unflushed), self.path,
+            )
+            return data, self._event_seq
+
+    def flush(self) -> None:
+        if self.persister is not None:
+            self.persister.flush()
+
+    def stats(self) -> dict:
+        stats = {"cache_hits": self.cache_stats["hits"], "cache_misses": self.cache_stats["misses"]}
+        stats.update({f"cas_{k}": v for k, v in self.cas_stats.items()})
+        if self.persister is not None:
+            stats.update(self.persister.stats())
+        return stats
+
+    def _write_index(self) -> None:
+        """サマリ索引ファイルを書き出す（呼び出し側で self._lock を保持すること）"""
+        if self._cache_key is None:
+            return
+        try:
+            atomic_write_text(self.index_path, json.dumps(
+                {"source": list(self._cache_key), "sessions": self._summaries}, ensure_ascii=False, default=str,
+            ))
+        except Exception:
+            logger.exception("JsonSessionStore._write_index: 索引保存失敗 (%s)", self.index_path)
+
+    def _commit(self, event: dict) -> bool:
+        """イベントを適用して保存する（batch 中は保存を遅延）。
+
+        セッションのコピーと変更はロック外で行い、差し替え時に version を比較する。
+        他のスレッドが先に更新していたら最新の状態に適用し直す。
+        """
+        session_id = event["session_id"]
+        with self._lock:
+            if self._batch_data is not None:
+                self._batch_touched.add(session_id)
+                self._batch_events.append(event)
+                return apply_event_cow(self._batch_data["sessions"], event)
+
+        for _ in range(_CAS_MAX_RETRIES):
+            base = self._load()["sessions"].get(session_id)
+            if base is None and event["op"] != "create":
+                logger.warning("JsonSessionStore: セッションが存在しません op=%s, session_id=%s", event["op"], session_id)
+                return False
+            working = {} if event["op"] == "create" else {session_id: copy.deepcopy(base)}
+            apply_event(working, event)
+            updated = freeze(working[session_id])
+            with self._lock:
+                data = self._load()
+                current = data["sessions"].get(session_id)
+                if current is not base and session_version(current) != session_version(base):
+                    self.cas_stats["conflicts"] += 1
+                    continue
+                sessions = dict(data["sessions"])
+                sessions[session_id] = updated
+                self._save({**data, "sessions": sessions}, touched={session_id}, events=[event])
+                self.cas_stats["commits"] += 1
+                return True
+
+        # 競合が続く場合はロックを保持したまま適用する
+        with self._lock:
+            self.cas_stats["fallbacks"] += 1
+            data = self._load()
+            sessions = dict(data["sessions"])
+            applied = apply_event_cow(sessions, event)
+            if applied:
+                self._save({**data, "sessions": sessions}, touched={session_id}, events=[event])
+            return applied
+
+    # --- 読み込み ---
+    def list_sessions(self) -> dict:
+        with self._lock:
+            if self._batch_data is not None:
+                return ReadOnlyDict(self._batch_data["sessions"])
+            return self._load()["sessions"]
+
+    def get_session(self, session_id: str) -> dict | None:
+        return self.list_sessions().get(session_id)
+
+    def list_session_summaries(self) -> dict:
+        with self._lock:
+            if self._batch_data is not None:
+                return ReadOnlyDict(
+                    (sid, freeze(build_session_summary(s))) for sid, s in self._batch_data["sessions"].items()
+                )
+            if self._pending is not None:
+                return ReadOnlyDict(self._summaries)
+            key = self._file_key()
+            if key is None:
+                return ReadOnlyDict()
+            if key != self._summaries_key:
+                index = None
+                try:
+                    if self.index_path.exists():
+                        with open(self.index_path, "r", encoding="utf-8") as f:
+                            index = json.load(f)
+                except Exception:
+                    logger.warning("JsonSessionStore: 索引読み込み失敗、再構築します (%s)", self.index_path)
+                if index and index.get("source") == list(key):
+                    self._summaries = dict(freeze(index.get("sessions", {})))
+                    self._summaries_key = key
+                    logger.debug("JsonSessionStore: 索引から %d サマリ読み込み", len(self._summaries))
+                else:
+                    sessions = self._load()["sessions"]
+                    self._summaries = {sid: freeze(build_session_summary(s)) for sid, s in sessions.items()}
+                    self._summaries_key = self._cache_key
+                    self._write_index()
+                    logger.debug("JsonSessionStore: 索引を再構築 (%d サマリ)", len(self._summaries))
+            return ReadOnlyDict(self._summaries)
+
+    # --- 書き込み ---
+    def create_session(self, session: dict) -> None:
+        self._commit({"op": "create", "session_id": session["session_id"], "session": session})
+
+    def append_turn(self, session_id: str, history: list, message: dict, at: str | None = None) -> bool:
+        return self._commit({
+            "op": "append_turn", "session_id": session_id,
+            "history": history, "message": message, "at": at or _now_iso(),
+        })
+
+    def append_error(self, session_id: str, error: dict) -> bool:
+        return self._commit({"op": "append_error", "session_id": session_id, "error": error, "at": _now_iso()})
+
+    def rename_session(self, session_id: str, new_name: str, *, generated_by_llm: bool = False) -> bool:
+        return self._commit({
+            "op": "rename", "session_id": session_id, "new_name": new_name,
+            "generated_by_llm": generated_by_llm, "at": _now_iso(),
+        })
+
+    def update_session(self, session_id: str, fields: dict, unset: tuple = (), action: str = "update") -> bool:
+        return self._commit({
+            "op": "update", "session_id": session_id, "action": action,
+            "fields": fields, "unset": list(unset),
+        })
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self._lock:
+            outermost = self._batch_depth == 0
+            if outermost:
+                data = self._load()
+                self._batch_data = {**data, "sessions": dict(data["sessions"])}
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if outermost:
+                    data, self._batch_data = self._batch_data, None
+                    touched, self._batch_touched = self._batch_touched, set()
+                    events, self._batch_events = self._batch_events, []
+                    self._save(data, touched=touched, events=events)
+
+
+# ========================================
+# ファクトリ（プロセス内でパスごとに 1 インスタンス）
+# ========================================
+_stores: dict[tuple[str, str], SessionStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_session_store(
+    backend: str, path: Path, archive_dir: Path | None = None, archive_after_days: float = 0,
+) -> SessionStore:
+    """バックエンド名と保存先パスに対応するストアを返す。
+
+    Streamlit の再実行やブラウザセッションをまたいで同じインスタンスを共有する。
+
+    Args:
+        backend: "json" / "journal" / "sqlite" / "sharded"
+        path: JSON ファイル / SQLite データベース / シャードディレクトリのパス
+        archive_dir: 指定するとコールドアーカイブ (lib/session_archive.py) を有効にする
+        archive_after_days: 終了・削除済みセッションを自動アーカイブするまでの日数（0 で無効）
+
+    Returns:
+        SessionStore インスタンス。
+    """
+    backend = (backend or "json").lower()
+    if backend not in SESSION_STORE_BACKENDS:
+        logger.warning("get_session_store: 未知のバックエンド '%s'、json を使用", backend)
+        backend = "json"
+    if archive_dir is not None:
+        key = ("archive", backend, str(Path(path).resolve()), str(Path(archive_dir).resolve()))
+        with _stores_lock:
+            store = _stores.get(key)
+        if store is None:
+            from lib.session_archive import ArchivingSessionStore, SessionArchive
+            inner = get_session_store(backend, path)
+            with _stores_lock:
+                store = _stores.get(key)
+                if store is None:
+                    store = ArchivingSessionStore(inner, SessionArchive(archive_dir), archive_after_days)
+                    _stores[key] = store
+                    logger.info("get_session_store: アーカイブ有効 archive_dir=%s, after_days=%s", archive_dir, archive_after_days)
+        return store
+    key = (backend, str(Path(path).resolve()))
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            if backend == "sqlite":
+                from lib.sqlite_store import SqliteSessionStore
+                store = SqliteSessionStore(path)
+            elif backend == "sharded":
+                from lib.sharded_store import ShardedSessionStore
+                store = ShardedSessionStore(path)
+            elif backend == "journal":
+                from lib.session_journal import JournalSessionStore
+                store = JournalSessionStore(path)
+            else:
+                store = JsonSessionStore(path)
+            _stores[key] = store
+            logger.info("get_session_store: backend=%s, path=%s", backend, path)
+        return store
@@ -0,0 +1,338 @@
+"""
+lib/sharded_store.py - セッション単位シャードの JSON セッションストア
+
+1 セッション = 1 ファイル (data/sessions/<session_id>.json) として保存し、
+一覧表示用のサマリはマニフェスト (data/sessions/manifest.jsonl) に持つ。
+
+特徴:
+- 書き込みは変更のあったセッション（ダーティセッション）のシャードだけを
+  一時ファイル → rename でアトミックに置き換える
+- マニフェストは「session_id ごとの最新サマリ」を 1 行ずつ追記する形式。
+  読み込み時は後勝ちで畳み込み、行数が増えすぎたら書き直す（コンパクション）
+- 完全削除（ゴミ箱から purge）したセッションはシャードファイルを削除し、
+  マニフェストには purged_from_trash のサマリだけを残す
+- 1 つのシャードが壊れても他のセッションには影響しない
+- 読み込んだシャードは (mtime_ns, size, inode) をキーに少数だけキャッシュする
+  （メモリ使用量と I/O は表示中のセッションに比例し、履歴全体には比例しない）
+- シャードは format_version 2（メッセージ本文は conversation_history への参照）で保存する
+- 複数プロセス・スレッドからの同時書き込みは、セッション ID ごとのストライプロック
+  (.locks/NN.lock) 下でシャードを読み直してからイベントを適用するため、更新が失われない。
+  マニフェストへの追記は .manifest.lock で排他する
+"""
+
+import contextlib
+import copy
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+from lib.logger import get_logger
+from lib.session_store import (
+    ReadOnlyDict,
+    SessionStore,
+    _now_iso,
+    apply_event,
+    atomic_write_text,
+    build_session_summary,
+    file_lock,
+    freeze,
+    pack_session,
+    unpack_session,
+)
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+_SHARD_CACHE_SIZE = int(os.getenv("SESSION_SHARD_CACHE_SIZE", "32"))
+_SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+_LOCK_STRIPES = 64  # セッション用ファイルロックの数（session_id のハッシュで振り分ける）
+
+
+class ShardedSessionStore(SessionStore):
+    """セッションごとのシャードファイル + マニフェストで永続化するストア"""
+
+    backend = "sharded"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.path / "manifest.jsonl"
+        self.lock_dir = self.path / ".locks"
+        self.lock_dir.mkdir(exist_ok=True)
+        self._lock = threading.RLock()        # batch() の所有権と _batch_dirty
+        self._state_lock = threading.RLock()  # シャードキャッシュ・サマリ・マニフェスト
+        self._shard_cache: OrderedDict[str, tuple[tuple, dict]] = OrderedDict()
+        self._summaries: dict[str, dict] = {}
+        self._manifest_lines = 0
+        self._manifest_key: tuple | None = None
+        self._batch_dirty: dict[str, dict] | None = None
+        self._batch_events: dict[str, list[dict]] = {}
+        with self._state_lock, file_lock(self.path / ".manifest.lock"):
+            self._load_manifest()
+
+    # --- パス・ファイル I/O ---
+    def shard_path(self, session_id: str) -> Path:
+        """セッション ID に対応するシャードファイルのパス"""
+        if not _SESSION_ID_RE.match(session_id or ""):
+            raise ValueError(f"シャード名に使えないセッション ID です: {session_id!r}")
+        return self.path / f"{session_id}.json"
+
+    def _session_lock(self, session_id: str):
+        """セッションのシャードを読み直して書き込む間に取るファイルロック"""
+        stripe = zlib.crc32(session_id.encode("utf-8")) % _LOCK_STRIPES
+        return file_lock(self.lock_dir / f"{stripe:02d}.lock")
+
+    @staticmethod
+    def _file_key(path: Path) -> tuple | None:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _read_shard(self, session_id: str) -> dict | None:
+        """シャードを読み込む（キャッシュが有効ならそれを返す）"""
+        path = self.shard_path(session_id)
+        key = self._file_key(path)
+        with self._state_lock:
+            if key is None:
+                self._shard_cache.pop(session_id, None)
+                return None
+            cached = self._shard_cache.get(session_id)
+            if cached is not None and cached[0] == key:
+                self._shard_cache.move_to_end(session_id)
+                return cached[1]
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                session = freeze(unpack_session(json.load(f)))
+        except Exception:
+            logger.exception("ShardedSessionStore: シャード読み込み失敗 (%s)", path)
+            return None
+        self._remember(session_id, key, session)
+        return session
+
+    def _remember(self, session_id: str, key: tuple | None, session: dict) -> None:
+        if key is None:
+            return
+        with self._state_lock:
+            self._shard_cache[session_id] = (key, session)
+            self._shard_cache.move_to_end(session_id)
+            while len(self._shard_cache) > _SHARD_CACHE_SIZE:
+                self._shard_cache.popitem(last=False)
+
+    def _write_shard(self, session_id: str, session: dict) -> None:
+        """シャードをアトミックに書き込む。完全削除済みならファイルを削除する。"""
+        path = self.shard_path(session_id)
+        if session.get("purged_from_trash"):
+            with self._state_lock:
+                self._shard_cache.pop(session_id, None)
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+            logger.info("ShardedSessionStore: 完全削除のためシャード削除 session_id=%s", session_id)
+            return
+        atomic_write_text(path, json.dumps(pack_session(session), ensure_ascii=False, indent=2, default=str))
+        self._remember(session_id, self._file_key(path), session)
+
+    # --- マニフェスト ---
+    def _load_manifest(self) -> None:
+        """マニフェストを読み込む。無ければシャードから再構築する。"""
+        summaries: dict[str, dict] = {}
+        lines = 0
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning("ShardedSessionStore: マニフェストの壊れた行をスキップ (%s)", self.manifest_path)
+                        continue
+                    summaries[entry["session_id"]] = freeze(entry["summary"])
+                    lines += 1
+            self._summaries, self._manifest_lines = summaries, lines
+            self._manifest_key = self._file_key(self.manifest_path)
+            logger.info("ShardedSessionStore: マニフェスト読み込み %d セッション (%s)", len(summaries), self.path)
+            return
+        for shard in sorted(self.path.glob("*.json")):
+            session = self._read_shard(shard.stem)
+            if session is not None:
+                summaries[shard.stem] = freeze(build_session_summary(session))
+        self._summaries = summaries
+        self._rewrite_manifest()
+        logger.info("ShardedSessionStore: シャードからマニフェストを再構築 %d セッション", len(summaries))
+
+    def _rewrite_manifest(self) -> None:
+        """現在のサマリだけでマニフェストを書き直す"""
+        text = "".join(
+            json.dumps({"session_id": sid, "summary": summary}, ensure_ascii=False, default=str) + "\n"
+            for sid, summary in self._summaries.items()
+        )
+        atomic_write_text(self.manifest_path, text)
+        self._manifest_lines = len(self._summaries)
+        self._manifest_key = self._file_key(self.manifest_path)
+
+    def _append_manifest(self, summaries: dict[str, dict]) -> None:
+        """変更のあったセッションのサマリをマニフェストへ追記する。
+
+        他プロセスの追記を取りこぼさないよう、マニフェストのロック下で読み直してから追記する。
+        """
+        if not summaries:
+            return
+        lines = [
+            json.dumps({"session_id": sid, "summary": summary}, ensure_ascii=False, default=str) + "\n"
+            for sid, summary in summaries.items()
+        ]
+        with self._state_lock, file_lock(self.path / ".manifest.lock"):
+            if self._file_key(self.manifest_path) != self._manifest_key:
+                self._load_manifest()
+            self._summaries.update(summaries)
+            with open(self.manifest_path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+                f.flush()
+            self._manifest_lines += len(lines)
+            self._manifest_key = self._file_key(self.manifest_path)
+            if self._manifest_lines > 2 * len(self._summaries) + 100:
+                self._rewrite_manifest()
+
+    def _refresh_manifest(self) -> None:
+        """他プロセスがマニフェストを更新していれば読み直す"""
+        with self._state_lock:
+            if self._file_key(self.manifest_path) == self._manifest_key:
+                return
+            with file_lock(self.path / ".manifest.lock"):
+                self._load_manifest()
+
+    # --- 書き込み ---
+    @staticmethod
+    def _apply(current: dict | None, event: dict) -> dict | None:
+        """current のコピーにイベントを適用した新しいセッションを返す（適用できなければ None）"""
+        session_id = event["session_id"]
+        if event["op"] == "create":
+            working = {}
+        elif current is None:
+            logger.warning("ShardedSessionStore: セッションが存在しません op=%s, session_id=%s", event["op"], session_id)
+            return None
+        else:
+            working = {session_id: copy.deepcopy(current)}
+        if not apply_event(working, event):
+            return None
+        return freeze(working[session_id])
+
+    def _commit(self, event: dict) -> bool:
+        session_id = event["session_id"]
+        with self._lock:
+            if self._batch_dirty is not None:
+                session = self._apply(self._pending_or_stored(session_id), event)
+                if session is None:
+                    return False
+                self._batch_dirty[session_id] = session
+                self._batch_events.setdefault(session_id, []).append(event)
+                return True
+        return self._flush({session_id: [event]}) > 0
+
+    def _pending_or_stored(self, session_id: str) -> dict | None:
+        if self._batch_dirty is not None and session_id in self._batch_dirty:
+            return self._batch_dirty[session_id]
+        return self._read_shard(session_id)
+
+    def _flush(self, events: dict[str, list[dict]]) -> int:
+        """セッションごとにロック下でシャードを読み直し、イベントを適用して書き込む。
+
+        読んでから書くまでの間に他プロセス・スレッドの更新が入り込まないため、
+        同じセッションへの同時追記でもターンが失われない。
+
+        Returns:
+            1 つ以上のイベントが適用されたセッション数。
+        """
+        summaries = {}
+        for session_id, session_events in events.items():
+            try:
+                with self._session_lock(session_id):
+                    session = current = self._read_shard(session_id)
+                    for event in session_events:
+                        session = self._apply(session, event) or session
+                    if session is None or session is current:
+                        continue
+                    self._write_shard(session_id, session)
+            except Exception:
+                logger.exception("ShardedSessionStore: シャード保存失敗 session_id=%s", session_id)
+                continue
+            summaries[session_id] = freeze(build_session_summary(session))
+        try:
+            self._append_manifest(summaries)
+        except Exception:
+            logger.exception("ShardedSessionStore: マニフェスト保存失敗 (%s)", self.manifest_path)
+        logger.debug("ShardedSessionStore._flush: %d シャード書き込み", len(summaries))
+        return len(summaries)
+
+    def create_session(self, session: dict) -> None:
+        self._commit({"op": "create", "session_id": session["session_id"], "session": session})
+
+    def append_turn(self, session_id: str, history: list, message: dict, at: str | None = None) -> bool:
+        return self._commit({
+            "op": "append_turn", "session_id": session_id,
+            "history": history, "message": message, "at": at or _now_iso(),
+        })
+
+    def append_error(self, session_id: str, error: dict) -> bool:
+        return self._commit({"op": "append_error", "session_id": session_id, "error": error, "at": _now_iso()})
+
+    def rename_session(self, session_id: str, new_name: str, *, generated_by_llm: bool = False) -> bool:
+        return self._commit({
+            "op": "rename", "session_id": session_id, "new_name": new_name,
+            "generated_by_llm": generated_by_llm, "at": _now_iso(),
+        })
+
+    def update_session(self, session_id: str, fields: dict, unset: tuple = (), action: str = "update") -> bool:
+        return self._commit({
+            "op": "update", "session_id": session_id, "action": action,
+            "fields": fields, "unset": list(unset),
+        })
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self._lock:
+            outermost = self._batch_dirty is None
+            if outermost:
+                self._batch_dirty, self._batch_events = {}, {}
+            try:
+                yield self
+            finally:
+                if outermost:
+                    events, self._batch_dirty, self._batch_events = self._batch_events, None, {}
+                    if events:
+                        self._flush(events)
+
+    # --- 読み込み ---
+    def get_session(self, session_id: str) -> dict | None:
+        with self._lock:
+            return self._pending_or_stored(session_id)
+
+    def list_sessions(self) -> dict:
+        """全シャードを読み込む（移行・検証用。画面描画では list_session_summaries を使う）"""
+        with self._lock:
+            self._refresh_manifest()
+            sessions = {}
+            with self._state_lock:
+                session_ids = list(self._summaries)
+            for session_id in session_ids:
+                session = self._pending_or_stored(session_id)
+                if session is not None:
+                    sessions[session_id] = session
+            return ReadOnlyDict(sessions)
+
+    def list_session_summaries(self) -> dict:
+        with self._lock:
+            self._refresh_manifest()
+            with self._state_lock:
+                summaries = dict(self._summaries)
+            for session_id, session in (self._batch_dirty or {}).items():
+                summaries[session_id] = freeze(build_session_summary(session))
+            return ReadOnlyDict(summaries)
@@ -0,0 +1,449 @@
+"""
+lib/sqlite_store.py - SQLite (WAL モード) セッションストア
+
+セッション・会話履歴・メッセージログ・エラー・名前変更履歴をそれぞれ行として保存する。
+メッセージ追加・名前変更・状態変更はインデックス付きの数行の書き込みで完了し、
+ファイル全体の再シリアライズは発生しない。
+
+テーブル:
+- sessions      : 1 セッション 1 行（スカラー列 + model / config / stats の JSON 列）。
+                  turn_count / total_tokens / total_cost_usd をサマリ索引として保持
+- conversation  : conversation_history の各エントリ (session_id, seq)
+- messages      : messages[] の各 message_log (session_id, seq)。本文 (user_input / ai_response) は
+                  conversation の seq への参照 {"$history": seq} で保存する (format_version 2)
+- errors        : errors[] の各エラーログ (session_id, seq)
+- name_changes  : name_changes[] の各履歴 (session_id, seq)
+
+接続はスレッドごとに 1 つ保持する（Streamlit はスクリプトを複数スレッドで実行するため）。
+"""
+
+import contextlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from lib.logger import get_logger
+from lib.session_store import (
+    SESSION_FORMAT_VERSION,
+    SUMMARY_MODEL_FIELDS,
+    SUMMARY_TIMESTAMP_FIELDS,
+    SessionStore,
+    _now_iso,
+    pack_messages,
+    unpack_messages,
+)
+
+logger = get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id           TEXT PRIMARY KEY,
+    session_name         TEXT NOT NULL,
+    status               TEXT NOT NULL DEFAULT 'active',
+    created_at           TEXT,
+    updated_at           TEXT,
+    last_llm_response_at TEXT,
+    ended_at             TEXT,
+    deleted              INTEGER NOT NULL DEFAULT 0,
+    deleted_at           TEXT,
+    purged_from_trash    INTEGER NOT NULL DEFAULT 0,
+    model_json           TEXT NOT NULL DEFAULT '{}',
+    config_json          TEXT NOT NULL DEFAULT '{}',
+    stats_json           TEXT,
+    extra_json           TEXT NOT NULL DEFAULT '{}',
+    turn_count           INTEGER NOT NULL DEFAULT 0,
+    total_tokens         INTEGER NOT NULL DEFAULT 0,
+    total_cost_usd       REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_listing
+    ON sessions (deleted, purged_from_trash, status, last_llm_response_at);
+
+CREATE TABLE IF NOT EXISTS conversation (
+    session_id TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    role       TEXT NOT NULL,
+    content    TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    data_json  TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS errors (
+    session_id TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    data_json  TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS name_changes (
+    session_id TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    data_json  TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+"""
+
+# sessions テーブルの列として持つフィールド（それ以外は extra_json）
+_SCALAR_COLUMNS = (
+    "session_name", "status", "created_at", "updated_at", "last_llm_response_at",
+    "ended_at", "deleted", "deleted_at", "purged_from_trash",
+)
+_JSON_COLUMNS = {"model": "model_json", "config": "config_json", "stats": "stats_json"}
+_BOOL_COLUMNS = ("deleted", "purged_from_trash")
+# NULL のときは dict にキー自体を含めない列
+_OPTIONAL_COLUMNS = ("ended_at", "deleted_at")
+# NOT NULL の列を unset したときに入れる値（json / journal バックエンドでキーが無いときの既定値と同じ。
+# session_name はセッション ID）
+_UNSET_VALUES = {
+    "status": "active", "deleted": 0, "purged_from_trash": 0,
+    "model_json": "{}", "config_json": "{}",
+}
+_CHILD_TABLES = {"messages": "messages", "errors": "errors", "name_changes": "name_changes"}
+# サマリ索引列（古いデータベースには ALTER TABLE で追加する）
+_SUMMARY_COLUMNS = {
+    "turn_count": "INTEGER NOT NULL DEFAULT 0",
+    "total_tokens": "INTEGER NOT NULL DEFAULT 0",
+    "total_cost_usd": "REAL NOT NULL DEFAULT 0",
+}
+
+_SUMMARY_SELECT = (
+    "SELECT session_id, session_name, status, deleted, purged_from_trash, model_json, extra_json, "
+    f"{', '.join(SUMMARY_TIMESTAMP_FIELDS)}, turn_count, total_tokens, total_cost_usd FROM sessions"
+)
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _message_totals(message: dict) -> tuple[int, float]:
+    """message_log からサマリ集計用の (total_tokens, total_cost_usd) を取り出す"""
+    return (
+        message.get("metrics", {}).get("total_tokens", 0),
+        message.get("cost", {}).get("total_cost_usd", 0),
+    )
+
+
+class SqliteSessionStore(SessionStore):
+    """SQLite (WAL モード) をバックエンドとするセッションストア"""
+
+    backend = "sqlite"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+        self._migrate_summary_columns()
+        self._migrate_message_refs()
+
+    def _migrate_summary_columns(self) -> None:
+        """サマリ索引列が無い既存データベースに列を追加し、messages から再集計する"""
+        conn = self._conn()
+        existing = {r["name"] for r in conn.execute("PRAGMA table_info(sessions)")}
+        missing = [col for col in _SUMMARY_COLUMNS if col not in existing]
+        if not missing:
+            return
+        with self._transaction():
+            for col in missing:
+                conn.execute(f"ALTER TABLE sessions ADD COLUMN {col} {_SUMMARY_COLUMNS[col]}")
+            for row in conn.execute("SELECT session_id FROM sessions").fetchall():
+                totals = [
+                    _message_totals(json.loads(r["data_json"]))
+                    for r in conn.execute("SELECT data_json FROM messages WHERE session_id = ?", (row["session_id"],))
+                ]
+                conn.execute(
+                    "UPDATE sessions SET turn_count = ?, total_tokens = ?, total_cost_usd = ? WHERE session_id = ?",
+                    (len(totals), sum(t for t, _ in totals), sum(c for _, c in totals), row["session_id"]),
+                )
+        logger.info("SqliteSessionStore: サマリ索引列を追加 %s", missing)
+
+    def _migrate_message_refs(self) -> None:
+        """旧形式 (user_version < 2) の messages 行の本文を conversation への参照に置き換える"""
+        conn = self._conn()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SESSION_FORMAT_VERSION:
+            return
+        migrated = 0
+        with self._transaction():
+            for row in conn.execute("SELECT session_id FROM sessions").fetchall():
+                session_id = row["session_id"]
+                history = [
+                    {"role": r["role"], "content": r["content"]}
+                    for r in conn.execute("SELECT role, content FROM conversation WHERE session_id = ? ORDER BY seq", (session_id,))
+                ]
+                rows = conn.execute(
+                    "SELECT seq, data_json FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+                ).fetchall()
+                packed = pack_messages(history, [json.loads(r["data_json"]) for r in rows])
+                conn.executemany(
+                    "UPDATE messages SET data_json = ? WHERE session_id = ? AND seq = ?",
+                    [(_dumps(m), session_id, r["seq"]) for r, m in zip(rows, packed)],
+                )
+                migrated += len(rows)
+            conn.execute(f"PRAGMA user_version = {SESSION_FORMAT_VERSION}")
+        logger.info("SqliteSessionStore: メッセージ本文を参照形式へ移行 (%d 件)", migrated)
+
+    # --- 接続・トランザクション ---
+    def _conn(self) -> sqlite3.Connection:
+        """スレッドローカルな接続を返す（初回のみ作成）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            self._local.depth = 0
+            logger.debug("SqliteSessionStore: 接続作成 thread=%s, path=%s", threading.current_thread().name, self.path)
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """書き込みトランザクション。ネスト時は最外側でのみ BEGIN / COMMIT。"""
+        conn = self._conn()
+        outermost = self._local.depth == 0
+        if outermost:
+            conn.execute("BEGIN IMMEDIATE")
+        self._local.depth += 1
+        try:
+            yield conn
+        except Exception:
+            self._local.depth -= 1
+            if outermost:
+                conn.execute("ROLLBACK")
+            raise
+        else:
+            self._local.depth -= 1
+            if outermost:
+                conn.execute("COMMIT")
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self._transaction():
+            yield self
+
+    # --- 行 <-> dict 変換 ---
+    def _session_from_row(self, conn: sqlite3.Connection, row: sqlite3.Row) -> dict:
+        session_id = row["session_id"]
+        session = {"session_id": session_id}
+        for col in _SCALAR_COLUMNS:
+            value = row[col]
+            if col in _OPTIONAL_COLUMNS and value is None:
+                continue
+            session[col] = bool(value) if col in _BOOL_COLUMNS else value
+        session["model"] = json.loads(row["model_json"])
+        session["config"] = json.loads(row["config_json"])
+        session["stats"] = json.loads(row["stats_json"]) if row["stats_json"] else None
+        session["conversation_history"] = [
+            {"role": r["role"], "content": r["content"]}
+            for r in conn.execute(
+                "SELECT role, content FROM conversation WHERE session_id = ? ORDER BY seq", (session_id,)
+            )
+        ]
+        for key, table in _CHILD_TABLES.items():
+            session[key] = [
+                json.loads(r["data_json"])
+                for r in conn.execute(f"SELECT data_json FROM {table} WHERE session_id = ? ORDER BY seq", (session_id,))
+            ]
+        session["messages"] = unpack_messages(session["conversation_history"], session["messages"])
+        session.update(json.loads(row["extra_json"]))
+        return session
+
+    @staticmethod
+    def _split_fields(fields: dict) -> tuple[dict, dict]:
+        """fields を (列名 -> 値, extra_json 用 dict) に分ける"""
+        columns, extra = {}, {}
+        for key, value in fields.items():
+            if key in _SCALAR_COLUMNS:
+                columns[key] = int(bool(value)) if key in _BOOL_COLUMNS else value
+            elif key in _JSON_COLUMNS:
+                columns[_JSON_COLUMNS[key]] = _dumps(value) if value is not None else None
+            elif key not in ("session_id", "conversation_history", *_CHILD_TABLES):
+                extra[key] = value
+        return columns, extra
+
+    @staticmethod
+    def _next_seq(conn: sqlite3.Connection, table: str, session_id: str) -> int:
+        row = conn.execute(f"SELECT COALESCE(MAX(seq), -1) + 1 FROM {table} WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0]
+
+    # --- 読み込み ---
+    def list_sessions(self) -> dict:
+        conn = self._conn()
+        rows = conn.execute("SELECT * FROM sessions").fetchall()
+        sessions = {row["session_id"]: self._session_from_row(conn, row) for row in rows}
+        logger.debug("SqliteSessionStore.list_sessions: %d セッション", len(sessions))
+        return sessions
+
+    def get_session(self, session_id: str) -> dict | None:
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return self._session_from_row(conn, row) if row else None
+
+    @staticmethod
+    def _summary_from_row(row: sqlite3.Row) -> dict:
+        model = json.loads(row["model_json"])
+        summary = {
+            "session_id": row["session_id"],
+            "session_name": row["session_name"],
+            "status": row["status"],
+            "deleted": bool(row["deleted"]),
+            "purged_from_trash": bool(row["purged_from_trash"]),
+            "model": {k: model[k] for k in SUMMARY_MODEL_FIELDS if k in model},
+        }
+        for key in SUMMARY_TIMESTAMP_FIELDS:
+            if row[key]:
+                summary[key] = row[key]
+        summary["archived"] = "archived" in json.loads(row["extra_json"])
+        summary["turn_count"] = row["turn_count"]
+        summary["total_tokens"] = row["total_tokens"]
+        summary["total_cost_usd"] = round(row["total_cost_usd"], 6)
+        return summary
+
+    def list_session_summaries(self) -> dict:
+        rows = self._conn().execute(_SUMMARY_SELECT).fetchall()
+        return {row["session_id"]: self._summary_from_row(row) for row in rows}
+
+    def get_session_summary(self, session_id: str) -> dict | None:
+        row = self._conn().execute(f"{_SUMMARY_SELECT} WHERE session_id = ?", (session_id,)).fetchone()
+        return self._summary_from_row(row) if row else None
+
+    # --- 書き込み ---
+    def create_session(self, session: dict) -> None:
+        session_id = session["session_id"]
+        columns, extra = self._split_fields(session)
+        columns.setdefault("session_name", session_id)
+        columns["extra_json"] = _dumps(extra)
+        archived = session.get("archived")
+        if archived:
+            # アーカイブ済みスタブ（lib/session_archive.py）は本体を持たないため、スタブの集計値を使う
+            columns["turn_count"] = archived.get("turn_count", 0)
+            columns["total_tokens"] = archived.get("total_tokens", 0)
+            columns["total_cost_usd"] = archived.get("total_cost_usd", 0)
+        else:
+            totals = [_message_totals(m) for m in session.get("messages") or []]
+            columns["turn_count"] = len(totals)
+            columns["total_tokens"] = sum(t for t, _ in totals)
+            columns["total_cost_usd"] = sum(c for _, c in totals)
+        with self._transaction() as conn:
+            for table in ("conversation", *_CHILD_TABLES.values()):
+                conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+            names = ", ".join(columns)
+            marks = ", ".join("?" for _ in columns)
+            conn.execute(
+                f"INSERT OR REPLACE INTO sessions (session_id, {names}) VALUES (?, {marks})",
+                (session_id, *columns.values()),
+            )
+            conn.executemany(
+                "INSERT INTO conversation (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, i, m["role"], m["content"]) for i, m in enumerate(session.get("conversation_history", []))],
+            )
+            children = {key: session.get(key) or [] for key in _CHILD_TABLES}
+            children["messages"] = pack_messages(session.get("conversation_history") or [], children["messages"])
+            for key, table in _CHILD_TABLES.items():
+                conn.executemany(
+                    f"INSERT INTO {table} (session_id, seq, data_json) VALUES (?, ?, ?)",
+                    [(session_id, i, _dumps(item)) for i, item in enumerate(children[key])],
+                )
+        logger.debug("SqliteSessionStore.create_session: session_id=%s", session_id)
+
+    def _exists(self, conn: sqlite3.Connection, session_id: str, op: str) -> bool:
+        if conn.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone():
+            return True
+        logger.warning("SqliteSessionStore.%s: セッションが存在しません session_id=%s", op, session_id)
+        return False
+
+    def append_turn(self, session_id: str, history: list, message: dict, at: str | None = None) -> bool:
+        at = at or _now_iso()
+        with self._transaction() as conn:
+            if not self._exists(conn, session_id, "append_turn"):
+                return False
+            seq = self._next_seq(conn, "conversation", session_id)
+            conn.executemany(
+                "INSERT INTO conversation (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, seq + i, m["role"], m["content"]) for i, m in enumerate(history)],
+            )
+            conn.execute(
+                "INSERT INTO messages (session_id, seq, data_json) VALUES (?, ?, ?)",
+                (
+                    session_id, self._next_seq(conn, "messages", session_id),
+                    _dumps(pack_messages(history, [message], offset=seq)[0]),
+                ),
+            )
+            tokens, cost = _message_totals(message)
+            conn.execute(
+                "UPDATE sessions SET updated_at = ?, last_llm_response_at = ?, turn_count = turn_count + 1, "
+                "total_tokens = total_tokens + ?, total_cost_usd = total_cost_usd + ? WHERE session_id = ?",
+                (at, at, tokens, cost, session_id),
+            )
+        return True
+
+    def append_error(self, session_id: str, error: dict) -> bool:
+        with self._transaction() as conn:
+            if not self._exists(conn, session_id, "append_error"):
+                return False
+            conn.execute(
+                "INSERT INTO errors (session_id, seq, data_json) VALUES (?, ?, ?)",
+                (session_id, self._next_seq(conn, "errors", session_id), _dumps(error)),
+            )
+            conn.execute(
+                "UPDATE sessions SET updated_at = ? WHERE session_id = ?",
+                (error.get("timestamp", _now_iso()), session_id),
+            )
+        return True
+
+    def rename_session(self, session_id: str, new_name: str, *, generated_by_llm: bool = False) -> bool:
+        now = _now_iso()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT session_name FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                logger.warning("SqliteSessionStore.rename_session: セッションが存在しません session_id=%s", session_id)
+                return False
+            change = {"timestamp": now, "old_name": row["session_name"], "new_name": new_name}
+            if generated_by_llm:
+                change["generated_by_llm"] = True
+            conn.execute(
+                "UPDATE sessions SET session_name = ?, updated_at = ? WHERE session_id = ?",
+                (new_name, now, session_id),
+            )
+            conn.execute(
+                "INSERT INTO name_changes (session_id, seq, data_json) VALUES (?, ?, ?)",
+                (session_id, self._next_seq(conn, "name_changes", session_id), _dumps(change)),
+            )
+        return True
+
+    def update_session(self, session_id: str, fields: dict, unset: tuple = (), action: str = "update") -> bool:
+        columns, extra = self._split_fields(fields)
+        for key in unset:
+            if key == "session_name":
+                columns[key] = session_id
+            elif key in _SCALAR_COLUMNS:
+                columns[key] = _UNSET_VALUES.get(key)
+            elif key in _JSON_COLUMNS:
+                columns[_JSON_COLUMNS[key]] = _UNSET_VALUES.get(_JSON_COLUMNS[key])
+        extra_unset = [k for k in unset if k not in _SCALAR_COLUMNS and k not in _JSON_COLUMNS]
+        with self._transaction() as conn:
+            if not self._exists(conn, session_id, f"update_session[{action}]"):
+                return False
+            if extra or extra_unset:
+                row = conn.execute("SELECT extra_json FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+                merged = json.loads(row["extra_json"])
+                merged.update(extra)
+                for key in extra_unset:
+                    merged.pop(key, None)
+                columns["extra_json"] = _dumps(merged)
+            if columns:
+                assignments = ", ".join(f"{col} = ?" for col in columns)
+                conn.execute(
+                    f"UPDATE sessions SET {assignments} WHERE session_id = ?",
+                    (*columns.values(), session_id),
+                )
+        logger.debug("SqliteSessionStore.update_session: action=%s, session_id=%s", action, session_id)
+        return True
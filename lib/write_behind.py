@@ -0,0 +1,150 @@
+"""
+lib/write_behind.py - 書き込みを遅延・集約するバックグラウンド永続化
+
+lib/logger.py の QueueHandler / QueueListener と同じ構成で、保存処理を
+Streamlit のスクリプトスレッドからバックグラウンドスレッドへ移す。
+
+特徴:
+- submit() はキューに積むだけで即座に戻る（UI スレッドはディスク I/O を待たない）
+- バックグラウンドスレッドは最初の要素を受け取ってから短い集約ウィンドウの間
+  後続の要素を待ち、最新の 1 件だけを書き込む（状態全体のスナップショットを前提）
+- flush() でキューが空になるまで待機、atexit で残りを書き切ってから停止
+- stats() でキュー長・書き込み回数・集約件数・書き込み所要時間を返す
+
+使い方:
+    persister = WriteBehindPersister("chat_log", write_fn)
+    persister.submit(snapshot)
+"""
+
+import atexit
+import queue
+import threading
+import time
+
+from lib.logger import get_logger
+
+logger = get_logger(__name__)
+
+# ========================================
+# 定数
+# ========================================
+_STOP = object()  # 停止用の番兵
+
+
+class WriteBehindPersister:
+    """submit されたスナップショットを集約してバックグラウンドで書き込む"""
+
+    def __init__(self, name: str, write_fn, coalesce_seconds: float = 0.2):
+        """
+        Args:
+            name: スレッド名・ログ用の名前
+            write_fn: スナップショットを 1 つ受け取って永続化する関数（バックグラウンドスレッドで呼ばれる）
+            coalesce_seconds: 最初の要素を受け取ってから後続を待つ時間
+        """
+        self.name = name
+        self._write_fn = write_fn
+        self._coalesce_seconds = coalesce_seconds
+        self._queue: queue.Queue = queue.Queue(-1)  # 上限なし
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "flushes": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    # --- スレッド管理 ---
+    def _ensure_thread(self) -> None:
+        """書き込みスレッドがまだ起動していなければ起動する"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                self._queue.task_done()
+                return
+            items = [first]
+            stop = False
+            deadline = time.monotonic() + self._coalesce_seconds
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                items.append(item)
+            self._write(items)
+            for _ in items:
+                self._queue.task_done()
+            if stop:
+                self._queue.task_done()
+                return
+
+    def _write(self, items: list) -> None:
+        """集約した要素のうち最新の 1 件を書き込む"""
+        started = time.perf_counter()
+        try:
+            self._write_fn(items[-1])
+        except Exception:
+            logger.exception("WriteBehindPersister[%s]: 書き込み失敗", self.name)
+            with self._stats_lock:
+                self._stats["errors"] += 1
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            self._stats["flushes"] += 1
+            self._stats["coalesced"] += len(items) - 1
+            self._stats["last_flush_ms"] = elapsed_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+            self._stats["total_flush_ms"] += elapsed_ms
+        logger.debug(
+            "WriteBehindPersister[%s]: %d 件を集約して書き込み (%.1f ms)", self.name, len(items), elapsed_ms,
+        )
+
+    # --- 公開 API ---
+    def submit(self, snapshot) -> None:
+        """スナップショットを書き込みキューに積む（即座に戻る）"""
+        self._ensure_thread()
+        with self._stats_lock:
+            self._stats["submitted"] += 1
+        self._queue.put(snapshot)
+
+    def flush(self) -> None:
+        """キューに積まれた書き込みがすべて終わるまで待つ"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stop(self) -> None:
+        """残りを書き切ってからスレッドを停止する（atexit から呼ばれる）"""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join()
+
+    def stats(self) -> dict:
+        """queue_depth, submitted, flushes, coalesced, errors, 書き込み所要時間 (ms) を返す"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+        return stats
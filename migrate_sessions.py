@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+既存の会話ログ (LOG_FILE_PATH の JSON) を別のバックエンドへ逐次移行する（lib/session_migration.py）。
+数百 MB のログでも 1 セッションずつ読むため、メモリ使用量はログのサイズに比例しない。
+アプリと同じ .env（LOG_FILE_PATH / SESSION_DB_PATH / SESSION_SHARD_DIR）を読む。
+プロジェクトルートで実行すること:
+
+    python migrate_sessions.py migrate --to sqlite          # 中断しても同じコマンドで続きから再開
+    python migrate_sessions.py migrate --to sharded --restart
+    python migrate_sessions.py verify --to sqlite           # 件数・チェックサムを照合
+    python migrate_sessions.py status --to sqlite
+
+移行が終わったら .env の SESSION_STORE_BACKEND を移行先に変更する。
+json / journal バックエンドは同じ JSON ファイルを使うため移行は不要。
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+from dotenv import load_dotenv
+
+load_dotenv(ROOT / ".env")
+
+from lib.session_migration import MigrationError, load_checkpoint, migrate_log, verify_migration
+from lib.session_store import get_session_store
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 移行先（セッション単位で書き込めるバックエンド）
+TARGET_BACKENDS = ("sqlite", "sharded")
+
+
+def target_path(backend: str, args) -> Path:
+    if args.target:
+        return ROOT / args.target
+    if backend == "sqlite":
+        return ROOT / os.getenv("SESSION_DB_PATH", "data/chat_log.sqlite3")
+    return ROOT / os.getenv("SESSION_SHARD_DIR", "data/sessions")
+
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def print_progress(checkpoint: dict) -> None:
+    total = checkpoint["total_bytes"] or 1
+    done = total if checkpoint["completed"] else (checkpoint["offset"] or 0)
+    elapsed = checkpoint.get("elapsed_seconds") or 0.0
+    rate = f"{done / elapsed / (1024 * 1024):.1f} MB/s" if elapsed else "-"
+    print(
+        f"  {checkpoint['sessions']:>8,} sessions  {done:>14,} / {total:,} bytes ({done / total:6.1%})  {rate}",
+        flush=True,
+    )
+
+
+def cmd_migrate(args, source: Path, store):
+    print(f"source : {source} ({source.stat().st_size:,} bytes)")
+    print(f"target : {store.backend} ({store.path})")
+    started = time.monotonic()
+    last = [0.0]
+
+    def progress(checkpoint):
+        now = time.monotonic()
+        if checkpoint["completed"] or now - last[0] >= args.progress_interval:
+            last[0] = now
+            print_progress(checkpoint)
+
+    try:
+        checkpoint = migrate_log(source, store, batch_size=args.batch_size, restart=args.restart, progress=progress)
+    except MigrationError as e:
+        print(f"FAIL: {e}")
+        return 1
+    rss = peak_rss_mb()
+    print(f"done   : {checkpoint['sessions']:,} sessions in {time.monotonic() - started:.1f}s"
+          + (f", peak RSS {rss:.0f} MB" if rss is not None else ""))
+    print(f"次: python migrate_sessions.py verify --to {store.backend} で照合し、"
+          f".env の SESSION_STORE_BACKEND={store.backend} に切り替える")
+    return 0
+
+
+def cmd_verify(args, source: Path, store):
+    result = verify_migration(store)
+    for session_id, detail in result["problems"]:
+        print(f"FAIL {session_id}: {detail}")
+    if not result["completed"]:
+        print("移行が完了していません（migrate を再実行すると続きから再開します）")
+    if result["problem_count"] or not result["completed"]:
+        print(f"NG: {result['problem_count']} problem(s) in {result['checked']:,} session(s)")
+        return 1
+    print(f"OK: {result['checked']:,} sessions verified (counts + checksums).")
+    return 0
+
+
+def cmd_status(args, source: Path, store):
+    checkpoint = load_checkpoint(store.path)
+    if checkpoint is None:
+        print(f"チェックポイントがありません ({store.backend}: {store.path})")
+        return 0
+    print(f"source : {checkpoint['source']}")
+    print(f"target : {checkpoint['backend']} ({checkpoint['target']})")
+    print(f"state  : {'completed' if checkpoint['completed'] else 'in progress'}")
+    print_progress(checkpoint)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話ログの逐次移行（JSON -> 他のバックエンド）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (
+        ("migrate", "移行（中断後は続きから再開）"), ("verify", "移行結果を照合"), ("status", "進捗を表示"),
+    ):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--to", required=True, choices=TARGET_BACKENDS, help="移行先バックエンド")
+        p.add_argument("--target", help="移行先のパス（既定: .env の SESSION_DB_PATH / SESSION_SHARD_DIR）")
+        p.add_argument("--source", default=os.getenv("LOG_FILE_PATH", "data/chat_log.json"), help="移行元の JSON")
+        if name == "migrate":
+            p.add_argument("--batch-size", type=int, default=200, help="1 トランザクションのセッション数")
+            p.add_argument("--restart", action="store_true", help="チェックポイントを捨てて最初から")
+            p.add_argument("--progress-interval", type=float, default=1.0, help="進捗表示の間隔（秒）")
+    args = parser.parse_args()
+
+    source = ROOT / args.source
+    if args.command == "migrate" and not source.exists():
+        print(f"移行元がありません: {source}")
+        return 1
+    store = get_session_store(args.to, target_path(args.to, args))
+    handlers = {"migrate": cmd_migrate, "verify": cmd_verify, "status": cmd_status}
+    return handlers[args.command](args, source, store)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,20 +20,42 @@ Azure OpenAI / Anthropic モデル選択チャットアプリ
 
 import streamlit as st
 import streamlit.components.v1 as components
+import copy
 import json
 import os
+import threading
 import time
 import uuid
-import httpx
 from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import AzureOpenAI
-import anthropic
+from streamlit.runtime.scriptrunner import RerunException, StopException
 
 load_dotenv()
 
 from lib.logger import get_logger
+from lib.context_budget import CONTEXT_BUDGET_TOKENS, SUMMARY_MAX_TOKENS, build_context
+from lib.llm_clients import client_stats
+from lib.llm_compare import COMPARE_MAX_MODELS, append_compare_log, run_parallel
+from lib.circuit_breaker import BREAKER_ENABLED, breaker_state, breaker_stats, call_with_breaker
+from lib.llm_hedge import HEDGE_ENABLED, budget_allows, call_hedged, charge as charge_hedge, hedge_stats
+from lib.llm_retry import RetryExhaustedError, call_with_failover
+from lib.llm_stream import CancelToken, WorkerAbandonedError, run_in_worker
+from lib.llm_router import DEFAULT_ROUTING_MODE, record_attempts, record_failure, record_success, route, router_stats
+from lib.rate_limiter import RateLimitQueuedError, acquire, block, estimate_tokens, limiter_stats, reconcile, refund
+from lib.llm_providers import get_provider, provider_class, registered_api_types
+from lib.response_cache import RESPONSE_CACHE_ENABLED, cache_key, get_response_cache
+from lib.session_naming import (
+    cancel_naming,
+    MAX_IN_FLIGHT as NAMING_MAX_IN_FLIGHT,
+    get_batch_job,
+    naming_stats,
+    naming_status,
+    start_batch_naming,
+    submit_naming,
+    take_result,
+)
+from lib.session_store import get_session_store
 from lib.themes import THEMES
 from lib.css_loader import get_app_css
 from lib.js_loader import get_danger_btn_js, get_popover_close_html
@@ -71,6 +93,8 @@ if "app_theme" not in st.session_state:
 # カスタムCSS（テーマ対応）
 # ========================================
 FONT_ZOOM = 0.8
+# ストリーミング中に AI メッセージを再描画する最小間隔（秒）
+STREAM_RENDER_INTERVAL = 0.05
 _current_theme = THEMES[st.session_state.app_theme]
 st.markdown(get_app_css(st.session_state.app_theme, FONT_ZOOM), unsafe_allow_html=True)
 
@@ -95,7 +119,36 @@ BASE_DIR = Path(__file__).parent
 LOG_FILE_PATH = BASE_DIR / os.getenv("LOG_FILE_PATH", "data/chat_log.json")
 LOG_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
 
+# 会話ログのストレージバックエンド（"json" / "journal" / "sqlite" / "sharded"）
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "json").lower()
+SESSION_DB_PATH = BASE_DIR / os.getenv("SESSION_DB_PATH", "data/chat_log.sqlite3")
+SESSION_SHARD_DIR = BASE_DIR / os.getenv("SESSION_SHARD_DIR", "data/sessions")
+# 終了・削除済みセッションのコールドアーカイブ（SESSION_ARCHIVE_AFTER_DAYS=0 で自動アーカイブ無効）
+SESSION_ARCHIVE_DIR = BASE_DIR / os.getenv("SESSION_ARCHIVE_DIR", "data/archive")
+SESSION_ARCHIVE_AFTER_DAYS = float(os.getenv("SESSION_ARCHIVE_AFTER_DAYS", "30"))
+session_store = get_session_store(
+    SESSION_STORE_BACKEND,
+    {"sqlite": SESSION_DB_PATH, "sharded": SESSION_SHARD_DIR}.get(SESSION_STORE_BACKEND, LOG_FILE_PATH),
+    archive_dir=SESSION_ARCHIVE_DIR,
+    archive_after_days=SESSION_ARCHIVE_AFTER_DAYS,
+)
+
 API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-12-01-preview")
+# 再試行し尽くしたとき、同じモデルを提供する別リージョンへ切り替えるか（再試行の設定は lib/llm_retry.py）
+LLM_FAILOVER_ENABLED = os.getenv("LLM_FAILOVER_ENABLED", "1") not in ("0", "false", "False")
+# 新規セッションの system プロンプト（比較モードで会話履歴を共有しない場合にも使う）
+DEFAULT_SYSTEM_PROMPT = "あなたは親切で知識豊富なアシスタントです。日本語で回答してください。会話の文脈を踏まえて応答してください。"
+# モデル比較の記録（1 回の比較を 1 行の JSON で追記）
+COMPARE_LOG_PATH = BASE_DIR / os.getenv("COMPARE_LOG_PATH", "data/compare_log.jsonl")
+# 応答の最大トークン数と temperature（temperature を送るプロバイダーのみ指定）。応答キャッシュのキーにも含める
+MAX_OUTPUT_TOKENS = 16384
+CHAT_TEMPERATURE = 0.7
+# 同一プロンプトへの応答キャッシュ（RESPONSE_CACHE_ENABLED=1 で有効。TTL・サイズ上限は lib/response_cache.py）
+RESPONSE_CACHE_DIR = BASE_DIR / os.getenv("RESPONSE_CACHE_DIR", "data/response_cache")
+response_cache = get_response_cache(RESPONSE_CACHE_DIR) if RESPONSE_CACHE_ENABLED else None
+# セッション名の自動生成（この往復数に達したらバックグラウンドで生成。0 で無効）と生成時の最大トークン数
+SESSION_NAMING_AUTO_TURN = int(os.getenv("SESSION_NAMING_AUTO_TURN", "0"))
+SESSION_NAMING_MAX_TOKENS = int(os.getenv("SESSION_NAMING_MAX_TOKENS", "64"))
 
 REGIONS = {
     "Japan East": {
@@ -119,6 +172,7 @@ REGION_DISPLAY_MAP = {
 # --- 起動ログ ---
 logger.info("=== アプリケーション起動 ===")
 logger.info("LOG_FILE_PATH=%s", LOG_FILE_PATH)
+logger.info("SESSION_STORE_BACKEND=%s", session_store.backend)
 logger.info("API_VERSION=%s", API_VERSION)
 for _rname, _rinfo in REGIONS.items():
     logger.info(
@@ -139,10 +193,11 @@ def format_region_display(region):
 MODEL_METADATA_PATH = BASE_DIR / "config" / "deployment_models.json"
 _model_metadata_cache = None
 _provider_metadata_cache = None
+_naming_model_cache = None
 
 def _load_deployment_config():
-    """config/deployment_models.json を読み込み、models リストと providers dict をキャッシュする"""
-    global _model_metadata_cache, _provider_metadata_cache
+    """config/deployment_models.json を読み込み、models リスト・providers dict・naming_model をキャッシュする"""
+    global _model_metadata_cache, _provider_metadata_cache, _naming_model_cache
     if _model_metadata_cache is not None:
         return
     try:
@@ -155,6 +210,7 @@ def _load_deployment_config():
         else:
             _model_metadata_cache = data.get("models", [])
             _provider_metadata_cache = data.get("providers", {})
+            _naming_model_cache = data.get("naming_model")
         logger.debug("_load_deployment_config: %d モデル, %d プロバイダーをロード",
                      len(_model_metadata_cache), len(_provider_metadata_cache))
     except Exception:
@@ -172,6 +228,11 @@ def load_provider_metadata():
     _load_deployment_config()
     return _provider_metadata_cache
 
+def load_naming_model_config():
+    """config/deployment_models.json の naming_model（セッション名の生成に使うモデル。無ければ None）"""
+    _load_deployment_config()
+    return _naming_model_cache
+
 def get_provider_for_deployment(deployment_name):
     """デプロイ名からプロバイダー名を取得。マスタに無い場合は 'その他'。"""
     if not deployment_name:
@@ -210,55 +271,83 @@ PRICING = {
 USD_TO_JPY = 150
 
 def get_pricing_for_model(deployment_name, model_type):
-    """モデルに応じた料金設定を取得（JSON の pricing フィールドを参照）"""
+    """モデルに応じた料金設定を取得（JSON の pricing フィールドを参照。
+
+    JSON の pricing に cache_read_per_1k / cache_write_per_1k が無ければ、プロバイダーの
+    cache_price_ratios（入力単価に対する倍率）から補う。
+    """
+    pricing = PRICING
     metadata = load_model_metadata()
     for m in metadata:
-        if m.get("deployment_name") == deployment_name:
-            pricing = m.get("pricing")
-            if pricing:
-                return pricing
-    return PRICING
+        if m.get("deployment_name") == deployment_name and m.get("pricing"):
+            pricing = m["pricing"]
+            break
+    ratios = provider_class(model_type if model_type in registered_api_types() else "openai").cache_price_ratios
+    return {
+        "cache_read_per_1k": pricing["prompt_per_1k"] * ratios["read"],
+        "cache_write_per_1k": pricing["prompt_per_1k"] * ratios["write"],
+        **pricing,
+    }
+
+def get_context_budget_for_model(deployment_name):
+    """モデルのコンテキスト予算（トークン）を取得（JSON の context_budget。無ければ CONTEXT_BUDGET_TOKENS、0 で無効）"""
+    metadata = load_model_metadata()
+    for m in metadata:
+        if m.get("deployment_name") == deployment_name and m.get("context_budget") is not None:
+            return int(m["context_budget"])
+    return CONTEXT_BUDGET_TOKENS
+
+def is_response_cache_enabled_for_model(deployment_name):
+    """モデルで応答キャッシュを使うか（JSON の response_cache が false ならバイパス）"""
+    metadata = load_model_metadata()
+    for m in metadata:
+        if m.get("deployment_name") == deployment_name and m.get("response_cache") is False:
+            return False
+    return True
+
+def get_limits_for_model(deployment_name, region):
+    """デプロイ・リージョンの TPM / RPM 上限を取得（JSON の limits フィールド。無ければ制限なし）"""
+    metadata = load_model_metadata()
+    region = format_region_display(region)
+    for m in metadata:
+        if m.get("deployment_name") == deployment_name and m.get("region") == region:
+            return m.get("limits") or {}
+    return {}
 
 # ========================================
 # ユーティリティ関数
 # ========================================
-def load_log_data():
-    """ログデータを読み込む"""
-    try:
-        if LOG_FILE_PATH.exists():
-            with open(LOG_FILE_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            logger.debug("load_log_data: %d セッション読み込み", len(data.get("sessions", {})))
-            return data
-        logger.debug("load_log_data: ファイルなし、空データ返却")
-        return {"sessions": {}}
-    except Exception:
-        logger.exception("load_log_data: ファイル読み込み失敗 (%s)", LOG_FILE_PATH)
-        return {"sessions": {}}
-
-def save_log_data(data):
-    """ログデータを保存する"""
-    try:
-        with open(LOG_FILE_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
-        logger.debug("save_log_data: 保存完了 (%d セッション)", len(data.get("sessions", {})))
-    except Exception:
-        logger.exception("save_log_data: ファイル保存失敗 (%s)", LOG_FILE_PATH)
-
-def calculate_cost(prompt_tokens, completion_tokens, pricing=None):
-    """トークン数からコストを計算"""
+def calculate_cost(prompt_tokens, completion_tokens, pricing=None, cache_read_tokens=0, cache_creation_tokens=0):
+    """トークン数からコストを計算（prompt_tokens はキャッシュの読み書き分を含むプロンプト全体）"""
     if pricing is None:
         pricing = PRICING
-    prompt_cost = (prompt_tokens / 1000) * pricing["prompt_per_1k"]
+    uncached_tokens = max(0, prompt_tokens - cache_read_tokens - cache_creation_tokens)
+    cache_read_cost = (cache_read_tokens / 1000) * pricing.get("cache_read_per_1k", pricing["prompt_per_1k"])
+    cache_creation_cost = (cache_creation_tokens / 1000) * pricing.get("cache_write_per_1k", pricing["prompt_per_1k"])
+    prompt_cost = (uncached_tokens / 1000) * pricing["prompt_per_1k"] + cache_read_cost + cache_creation_cost
     completion_cost = (completion_tokens / 1000) * pricing["completion_per_1k"]
     total_cost = prompt_cost + completion_cost
     return {
         "prompt_cost_usd": round(prompt_cost, 6),
         "completion_cost_usd": round(completion_cost, 6),
+        "cache_read_cost_usd": round(cache_read_cost, 6),
+        "cache_creation_cost_usd": round(cache_creation_cost, 6),
         "total_cost_usd": round(total_cost, 6),
         "total_cost_jpy": round(total_cost * USD_TO_JPY, 2)
     }
 
+def summarize_cache_usage(messages):
+    """メッセージログのプロンプトキャッシュの集計（読み出し・書き込みトークン数とヒット率）"""
+    prompt_tokens = sum(m.get("metrics", {}).get("prompt_tokens", 0) for m in messages)
+    cache_read = sum(m.get("metrics", {}).get("cache_read_tokens", 0) for m in messages)
+    cache_creation = sum(m.get("metrics", {}).get("cache_creation_tokens", 0) for m in messages)
+    return {
+        "cache_read_tokens": cache_read,
+        "cache_creation_tokens": cache_creation,
+        # プロンプトトークンのうちキャッシュから読めた割合
+        "cache_hit_ratio": round(cache_read / prompt_tokens, 4) if prompt_tokens else 0.0,
+    }
+
 def get_api_key_for_region(region):
     """リージョンから API Key を取得（旧表記のリージョン名にも対応）"""
     region_key = REGION_DISPLAY_MAP.get(region, region)
@@ -291,15 +380,15 @@ def get_all_models():
             continue
         try:
             model_type = get_model_type(dep)
+            if model_type not in registered_api_types():
+                logger.warning("get_all_models: api_type '%s' のプロバイダーがありません (deployment=%s)", model_type, dep)
+                continue
             provider = meta.get("provider", "その他")
             provider_icon = get_provider_icon(provider)
             display_name = meta.get("display_name", dep)
 
-            # Anthropic モデルの場合は専用エンドポイントを使用
-            if model_type == "anthropic":
-                endpoint = region_info.get("anthropic_endpoint") or region_info.get("endpoint", "")
-            else:
-                endpoint = region_info.get("endpoint", "")
+            # プロバイダーごとのエンドポイント（Anthropic モデルは専用エンドポイント）を使用
+            endpoint = provider_class(model_type).endpoint_for(region_info)
 
             # 後方互換性のため config dict を構築
             config = {
@@ -320,6 +409,10 @@ def get_all_models():
                 "sort_order": meta.get("sort_order", 999),
                 "capability_tag": meta.get("capability_tag", []),
                 "recommended_usage": meta.get("recommended_usage", ""),
+                # 同じ model_group（未指定ならデプロイ名）の別リージョンをフェイルオーバー先とみなす
+                "model_group": meta.get("model_group") or dep,
+                "limits": meta.get("limits") or {},
+                "context_budget": meta.get("context_budget", CONTEXT_BUDGET_TOKENS),
                 "endpoint": endpoint,
                 "config": config,
                 "dropdown_label": f"{provider_icon} {display_name} ({region_name})"
@@ -332,6 +425,25 @@ def get_all_models():
     logger.info("get_all_models: %d モデルを検出", len(all_models))
     return all_models
 
+def get_equivalent_models(model_info):
+    """同じモデルを別リージョンで提供するデプロイの一覧（振り分け・フェイルオーバー先、sort_order 順）"""
+    region = format_region_display(model_info.get("region"))
+    deployment_name = model_info.get("deployment_name", "")
+    # 保存済みセッションの model_info には model_group が無いことがあるため、現在の定義から引く
+    current = next(
+        (m for m in all_models if m["deployment_name"] == deployment_name and m["region"] == region),
+        model_info,
+    )
+    group = current.get("model_group") or deployment_name
+    return [
+        m for m in all_models
+        if m["region"] != region
+        and m.get("model_group") == group
+        and m["model_type"] == current.get("model_type", "openai")
+        and m.get("endpoint")
+        and get_api_key_for_region(m["region"])
+    ]
+
 def format_timestamp(ts_str):
     """タイムスタンプをフォーマット"""
     try:
@@ -341,8 +453,12 @@ def format_timestamp(ts_str):
         logger.warning("format_timestamp: パース失敗 ts_str=%s", ts_str)
         return ts_str
 
-def terminate_session(session_data):
-    """セッションを終了し統計を計算する。session_data を直接変更する。"""
+def terminate_session(session_id):
+    """セッションを終了し統計を計算してストアに保存する。"""
+    session_data = session_store.get_session(session_id)
+    if session_data is None:
+        logger.warning("terminate_session: セッションが存在しません session_id=%s", session_id)
+        return
     messages = session_data.get("messages", [])
     total_tokens = sum(m.get("metrics", {}).get("total_tokens", 0) for m in messages)
     total_cost = sum(m.get("cost", {}).get("total_cost_usd", 0) for m in messages)
@@ -352,10 +468,7 @@ def terminate_session(session_data):
     session_end = datetime.now()
     session_start = datetime.fromisoformat(session_data.get("created_at", session_end.isoformat()))
     session_duration = (session_end - session_start).total_seconds()
-    session_data["status"] = "completed"
-    session_data["ended_at"] = session_end.isoformat()
-    session_data["updated_at"] = session_end.isoformat()
-    session_data["stats"] = {
+    stats = {
         "total_turns": total_turns,
         "total_tokens": total_tokens,
         "total_cost_usd": round(total_cost, 6),
@@ -364,13 +477,148 @@ def terminate_session(session_data):
         "min_response_time_seconds": round(min(response_times), 3) if response_times else 0,
         "max_response_time_seconds": round(max(response_times), 3) if response_times else 0,
         "session_duration_seconds": round(session_duration, 3),
-        "conversation_length": len(session_data.get("conversation_history", []))
+        "conversation_length": len(session_data.get("conversation_history", [])),
+        **summarize_cache_usage(messages),
     }
+    session_store.update_session(session_id, {
+        "status": "completed",
+        "ended_at": session_end.isoformat(),
+        "updated_at": session_end.isoformat(),
+        "stats": stats,
+    }, action="terminate")
     logger.debug("セッション終了統計: turns=%d, tokens=%d, cost=$%.6f, duration=%.1fs",
                  total_turns, total_tokens, total_cost, session_duration)
 
-def generate_session_name_with_llm(session_id, model_info, conversation_history):
-    """LLMを使ってセッション名を生成"""
+def summarize_history_with_llm(target, api_key, request_messages, cancel=None):
+    """古い会話履歴の要約を model_info（target）のモデルで 1 回生成し、lib/llm_providers.py の結果 dict を返す。
+
+    stream_llm() と同じく再試行は呼び出し側（call_with_failover）に任せ、サーキットブレーカーを通して送る。
+    cancel を取り消すと受信を打ち切る（結果の finish_reason が "cancelled" になる）。
+    """
+    def call():
+        return get_provider(target, api_key).complete(
+            request_messages, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.3, prompt_cache=False, max_retries=0,
+            cancel=cancel,
+        )
+    if cancel is not None and cancel.cancelled:
+        return call()
+    result = call_with_breaker(target.get("endpoint", ""), target.get("deployment_name", ""), call)
+    logger.info(
+        "summarize_history_with_llm: 完了 deployment=%s, region=%s, prompt_tokens=%d, completion_tokens=%d, elapsed=%.3fs",
+        target.get("deployment_name"), target.get("region"), result["prompt_tokens"], result["completion_tokens"],
+        result["elapsed_seconds"],
+    )
+    return result
+
+def get_naming_model(model_info):
+    """セッション名の生成に使うモデル（config の naming_model。無い・使えなければセッションのモデル）。
+
+    naming_model はデプロイ名の文字列、または {"deployment_name": ..., "region": ...}。
+    リージョンを省略した場合はセッションと同じリージョンを優先する。
+    """
+    naming = load_naming_model_config()
+    if not naming:
+        return model_info
+    if isinstance(naming, str):
+        naming = {"deployment_name": naming}
+    candidates = [m for m in get_all_models() if m["deployment_name"] == naming.get("deployment_name")
+                  and (not naming.get("region") or m["region"] == naming["region"])]
+    if not candidates:
+        logger.warning("get_naming_model: naming_model %s が見つかりません。セッションのモデルを使います", naming)
+        return model_info
+    candidates.sort(key=lambda m: m["region"] != format_region_display(model_info.get("region", "")))
+    return candidates[0]
+
+def stream_llm(target, api_key, messages, on_text=None, cancel=None):
+    """model_info（target）のモデルへ messages をストリーミングで送り、lib/llm_providers.py の結果 dict を返す。
+
+    再試行は呼び出し側（call_with_failover）が行うため SDK の自動再試行は無効にする。
+    cancel（lib/llm_stream.py の CancelToken）を取り消すと受信を打ち切る。
+    エンドポイントのサーキットブレーカーが open なら送信せずに CircuitOpenError を送出する。
+    """
+    def call():
+        return get_provider(target, api_key).complete(
+            messages, max_tokens=MAX_OUTPUT_TOKENS, temperature=CHAT_TEMPERATURE, on_text=on_text, max_retries=0,
+            cancel=cancel,
+        )
+    if cancel is not None and cancel.cancelled:
+        # 送信前に取り消された（送らずに打ち切りの結果を返す）ので、ブレーカーの成功・回復確認には数えない
+        return call()
+    return call_with_breaker(target.get("endpoint", ""), target.get("deployment_name", ""), call)
+
+BREAKER_STATE_LABELS = {"open": "⚠️ 応答なし（送信停止中）", "half_open": "🩺 回復確認中"}
+
+def get_breaker_state(model_entry):
+    """モデルのエンドポイントのサーキットブレーカーの状態（closed / open / half_open）"""
+    return breaker_state(model_entry.get("endpoint", ""), model_entry.get("deployment_name", ""))
+
+def build_model_target(model_entry):
+    """get_all_models() の 1 件を、呼び出しに使う model_info（API Key・API バージョン付き）にする"""
+    config = model_entry.get("config", {})
+    return {
+        **model_entry,
+        "api_key": config.get("Azure API Key", ""),
+        "api_version": config.get("Azure API Version", API_VERSION),
+    }
+
+def build_compare_branch(target, outcome):
+    """比較モードの 1 モデル分の記録（所要時間・トークン数・コスト、失敗時はエラー）"""
+    branch = {
+        "deployment_name": target.get("deployment_name", ""),
+        "region": target.get("region", ""),
+        "display_name": target.get("display_name", target.get("deployment_name", "")),
+        "model_type": target.get("model_type", "openai"),
+        "elapsed_seconds": outcome["elapsed_seconds"],
+    }
+    result = outcome["result"]
+    if result is None:
+        error = outcome["error"]
+        branch["error"] = {"error_type": type(error).__name__, "error_message": str(error)[:300]}
+        return branch
+    elapsed = result["elapsed_seconds"]
+    branch["response"] = {
+        "model": result["model"],
+        "response_id": result["response_id"],
+        "finish_reason": result["finish_reason"],
+        "ai_response": result["text"],
+        "ai_response_chars": len(result["text"]),
+    }
+    branch["metrics"] = {
+        "response_time_seconds": round(elapsed, 3),
+        "ttft_seconds": round(result["ttft_seconds"], 3),
+        "decode_tokens_per_second": round(result["decode_tokens_per_second"], 2),
+        "tokens_per_second": round(result["completion_tokens"] / elapsed, 2) if elapsed > 0 else 0,
+        "prompt_tokens": result["prompt_tokens"],
+        "completion_tokens": result["completion_tokens"],
+        "total_tokens": result["total_tokens"],
+        "cache_read_tokens": result["cache_read_tokens"],
+        "cache_creation_tokens": result["cache_creation_tokens"],
+        "rate_limit_wait_seconds": result.get("rate_limit_wait_seconds", 0.0),
+    }
+    branch["cost"] = calculate_cost(
+        result["prompt_tokens"], result["completion_tokens"],
+        get_pricing_for_model(branch["deployment_name"], branch["model_type"]),
+        cache_read_tokens=result["cache_read_tokens"],
+        cache_creation_tokens=result["cache_creation_tokens"],
+    )
+    return branch
+
+def format_compare_metrics(branch):
+    """比較モードの応答欄のメトリクス行"""
+    if "error" in branch:
+        return f"❌ {branch['error']['error_type']} ({branch['elapsed_seconds']:.2f}秒)"
+    m = branch["metrics"]
+    return (
+        f"{m['response_time_seconds']:.2f}秒 | {m['total_tokens']:,}トークン | ¥{branch['cost']['total_cost_jpy']:.2f}"
+        f" | TTFT {m['ttft_seconds']:.2f}秒 | {m['decode_tokens_per_second']:.1f} tok/s"
+    )
+
+def generate_session_name_with_llm(session_id, model_info, conversation_history, cancel=None):
+    """LLMを使ってセッション名を生成（バックグラウンドのスレッドからも呼ばれるため st.* は使わない）。
+
+    model_info には get_naming_model() で選んだモデルを渡す。最大 SESSION_NAMING_MAX_TOKENS トークンだけ生成する。
+    会話が無い・cancel（CancelToken）で取り消された場合は None、API エラーは例外のまま送出する。
+    """
     logger.info(
         "generate_session_name_with_llm: session_id=%s, deployment=%s, model_type=%s",
         session_id, model_info.get("deployment_name"), model_info.get("model_type"),
@@ -393,71 +641,66 @@ def generate_session_name_with_llm(session_id, model_info, conversation_history)
 会話内容:
 {conversation_text}"""
 
-    try:
-        model_type = model_info.get("model_type", "openai")
-        api_key = model_info.get("api_key", "")
-        if not api_key:
-            api_key = get_api_key_for_region(model_info.get("region", ""))
-        
-        start_time = time.time()
-        if model_type == "anthropic":
-            logger.debug(
-                "generate_session_name_with_llm: Anthropic API 呼び出し開始 endpoint=%s, model=%s",
-                model_info.get("endpoint"), model_info.get("deployment_name"),
-            )
-            client = anthropic.Anthropic(
-                api_key=api_key,
-                base_url=model_info.get("endpoint", ""),
-            )
-            response = client.messages.create(
-                model=model_info.get("deployment_name", ""),
-                max_tokens=4096,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            raw = response.content[0].text if response.content else None
-            generated_name = raw.strip() if raw else None
-            logger.debug(
-                "generate_session_name_with_llm: Anthropic レスポンス response_id=%s, input_tokens=%s, output_tokens=%s",
-                response.id, response.usage.input_tokens, response.usage.output_tokens,
-            )
-        else:
-            logger.debug(
-                "generate_session_name_with_llm: OpenAI API 呼び出し開始 endpoint=%s, model=%s",
-                model_info.get("endpoint"), model_info.get("deployment_name"),
-            )
-            client = AzureOpenAI(
-                api_key=api_key,
-                api_version=model_info.get("api_version", "2024-12-01-preview"),
-                azure_endpoint=model_info.get("endpoint", ""),
-                timeout=httpx.Timeout(30.0, connect=10.0)
-            )
-            response = client.chat.completions.create(
-                model=model_info.get("deployment_name", ""),
-                messages=[{"role": "user", "content": prompt}],
-                max_completion_tokens=4096,
-                temperature=0.7
-            )
-            raw = response.choices[0].message.content if response.choices else None
-            generated_name = raw.strip() if raw else None
-            logger.debug(
-                "generate_session_name_with_llm: OpenAI レスポンス response_id=%s, prompt_tokens=%s, completion_tokens=%s",
-                response.id, response.usage.prompt_tokens, response.usage.completion_tokens,
-            )
-        
-        elapsed = time.time() - start_time
-        # 20文字に切り詰め
-        if generated_name and len(generated_name) > 20:
-            generated_name = generated_name[:20]
-        
-        logger.info(
-            "generate_session_name_with_llm: 完了 generated_name='%s', elapsed=%.3fs",
-            generated_name, elapsed,
-        )
-        return generated_name
-    except Exception as e:
-        logger.exception("generate_session_name_with_llm: エラー session_id=%s", session_id)
-        st.error(f"セッション名生成エラー: {e}")
+    api_key = model_info.get("api_key", "")
+    if not api_key:
+        api_key = get_api_key_for_region(model_info.get("region", ""))
+    
+    result = get_provider(model_info, api_key).complete(
+        [{"role": "user", "content": prompt}],
+        max_tokens=SESSION_NAMING_MAX_TOKENS, temperature=0.7, timeout=30.0, prompt_cache=False, cancel=cancel,
+    )
+    if result["finish_reason"] == "cancelled":
+        logger.info("generate_session_name_with_llm: 取り消し session_id=%s", session_id)
         return None
+    generated_name = result["text"].strip() or None
+    elapsed = result["elapsed_seconds"]
+    logger.debug(
+        "generate_session_name_with_llm: レスポンス response_id=%s, prompt_tokens=%s, completion_tokens=%s",
+        result["response_id"], result["prompt_tokens"], result["completion_tokens"],
+    )
+    
+    # 20文字に切り詰め
+    if generated_name and len(generated_name) > 20:
+        generated_name = generated_name[:20]
+    
+    logger.info(
+        "generate_session_name_with_llm: 完了 generated_name='%s', elapsed=%.3fs",
+        generated_name, elapsed,
+    )
+    return generated_name
+
+def request_session_name(session_id, model_info, conversation_history):
+    """セッション名の生成をバックグラウンドで依頼する（結果は次の再実行で反映）。依頼したら True"""
+    # 生成中に画面側で会話履歴が変わっても影響しないようにコピーを渡す
+    history = copy.deepcopy(list(conversation_history[:6]))
+    model_info = dict(get_naming_model(model_info))
+    submitted = submit_naming(
+        session_store, session_id,
+        lambda cancel: generate_session_name_with_llm(session_id, model_info, history, cancel=cancel),
+    )
+    st.session_state.naming_requested.add(session_id)
+    return submitted
+
+def start_batch_session_naming(session_ids, max_in_flight):
+    """選択したセッションの名前を一括生成するジョブを開始し、ジョブ ID を返す（デプロイごとに同時実行数を制限）"""
+    items = []
+    naming_models = {}
+    for sid in session_ids:
+        summary_model = session_summaries.get(sid, {}).get("model", {})
+        model_key = (summary_model.get("deployment_name", ""), summary_model.get("region", ""))
+        if model_key not in naming_models:
+            full_model = (session_store.get_session(sid) or {}).get("model", {})
+            naming_models[model_key] = dict(get_naming_model(full_model))
+        naming_model = naming_models[model_key]
+
+        def generate(cancel, sid=sid, naming_model=naming_model):
+            # 会話本体はワーカーで読み込む（画面側は待たない）
+            history = (session_store.get_session(sid) or {}).get("conversation_history", [])
+            return generate_session_name_with_llm(sid, naming_model, history, cancel=cancel)
+
+        deployment_key = f"{naming_model.get('deployment_name', '')}@{naming_model.get('region', '')}"
+        items.append((sid, deployment_key, generate))
+    return start_batch_naming(session_store, items, max_in_flight)
 
 # ========================================
 # セッション状態の初期化
@@ -474,6 +717,8 @@ if "view_mode" not in st.session_state:
     st.session_state.view_mode = "chat"  # "chat" / "trash" / "batch" / "analysis"
 if "generating_name" not in st.session_state:
     st.session_state.generating_name = False
+if "naming_requested" not in st.session_state:
+    st.session_state.naming_requested = set()  # このブラウザから名前の生成を依頼したセッション
 if "trash_purge_mode" not in st.session_state:
     st.session_state.trash_purge_mode = None  # ゴミ箱の完全削除確認フロー用 (None / "selected" / "all" / "single:{session_id}")
 if "_close_popover" not in st.session_state:
@@ -485,6 +730,22 @@ if "active_expander_open" not in st.session_state:
 if "completed_expander_open" not in st.session_state:
     st.session_state.completed_expander_open = False  # 終了済みセッション Expander の開閉
 
+# バックグラウンドで生成したセッション名を受け取り、名前変更欄（widget 描画前の pending キー）に反映する
+for _naming_sid in list(st.session_state.naming_requested):
+    _naming_result = take_result(_naming_sid)
+    if _naming_result is None:
+        if naming_status(_naming_sid) is None:
+            st.session_state.naming_requested.discard(_naming_sid)
+        continue
+    st.session_state.naming_requested.discard(_naming_sid)
+    if _naming_result["status"] == "done":
+        st.session_state[f"_pending_rename_{_naming_sid}"] = _naming_result["name"]
+        st.toast(f"✨ セッション名を生成しました: {_naming_result['name']}")
+    elif _naming_result["status"] == "cancelled":
+        st.toast("⏹ セッション名の生成を停止しました")
+    else:
+        st.toast(f"⚠️ セッション名を生成できませんでした: {_naming_result.get('error', '')}")
+
 # ========================================
 # モデル情報取得
 # ========================================
@@ -495,9 +756,8 @@ all_models = get_all_models()
 # ========================================
 st.sidebar.markdown(get_sidebar_title_html(), unsafe_allow_html=True)
 
-# ログデータ読み込み
-log_data = load_log_data()
-sessions = log_data.get("sessions", {})
+# セッション一覧（サマリ索引のみ。会話本体はセッションを開いたときに読み込む）
+session_summaries = session_store.list_session_summaries()
 
 # 新規セッション作成ボタン
 if st.sidebar.button("➕ 新規セッション", use_container_width=True):
@@ -511,28 +771,41 @@ if st.sidebar.button("➕ 新規セッション", use_container_width=True):
 
 # セッション分類
 active_sessions = sorted(
-    [(k, v) for k, v in sessions.items() if not v.get("deleted", False) and v.get("status", "active") == "active"],
+    [(k, v) for k, v in session_summaries.items() if not v.get("deleted", False) and v.get("status", "active") == "active"],
     key=lambda x: x[1].get("last_llm_response_at", x[1].get("created_at", "")),
     reverse=True
 )
 completed_sessions = sorted(
-    [(k, v) for k, v in sessions.items() if not v.get("deleted", False) and v.get("status") == "completed"],
+    [(k, v) for k, v in session_summaries.items() if not v.get("deleted", False) and v.get("status") == "completed"],
     key=lambda x: x[1].get("last_llm_response_at", x[1].get("created_at", "")),
     reverse=True
 )
 deleted_sessions = sorted(
-    [(k, v) for k, v in sessions.items() if v.get("deleted", False) and not v.get("purged_from_trash", False)],
+    [(k, v) for k, v in session_summaries.items() if v.get("deleted", False) and not v.get("purged_from_trash", False)],
     key=lambda x: x[1].get("deleted_at", ""),
     reverse=True
 )
 
+# --- ヘルパー関数: セッションを開く ---
+def open_session(session_id):
+    """ストアからセッション本体を読み込み、チャット画面で開く状態にする"""
+    full_session = session_store.get_session(session_id) or {}
+    st.session_state.current_session_id = session_id
+    st.session_state.conversation_history = copy.deepcopy(full_session.get("conversation_history", []))
+    model_info_copy = dict(full_session.get("model", {}))
+    if not model_info_copy.get("api_key"):
+        model_info_copy["api_key"] = get_api_key_for_region(model_info_copy.get("region", ""))
+    st.session_state.selected_model = model_info_copy
+    st.session_state.is_new_session = False
+    st.session_state.view_mode = "chat"
+
 # --- ヘルパー関数: セッションアイテム表示 ---
 def render_session_item(session_id, session_info, container=None, show_resume=False, session_type="active"):
     """サイドバーのセッションアイテムをレンダリング
     
     Args:
         session_id: セッションID
-        session_info: セッション情報
+        session_info: セッションサマリ（build_session_summary の形式）
         container: 描画先コンテナ（Noneの場合はst.sidebar）
         show_resume: 再開ボタン表示フラグ
         session_type: セッションタイプ（"active" or "completed"）
@@ -567,14 +840,7 @@ def render_session_item(session_id, session_info, container=None, show_resume=Fa
         button_label = f"{display_name}\n{model_display}"
         if st.button(button_label, key=f"btn_{session_id}", use_container_width=True):
             logger.info("セッション選択: session_id=%s, name=%s", session_id, session_name)
-            st.session_state.current_session_id = session_id
-            st.session_state.conversation_history = session_info.get("conversation_history", [])
-            model_info_copy = model_info.copy()
-            if not model_info_copy.get("api_key"):
-                model_info_copy["api_key"] = get_api_key_for_region(region_raw)
-            st.session_state.selected_model = model_info_copy
-            st.session_state.is_new_session = False
-            st.session_state.view_mode = "chat"
+            open_session(session_id)
             st.rerun()
     
     with col2:
@@ -595,57 +861,32 @@ def render_session_item(session_id, session_info, container=None, show_resume=Fa
                 new_name = st.text_input("📝 新しいセッション名", key=_widget_key)
                 if st.button("入力した名前を保存", key=f"sidebar_rename_save_{session_id}", use_container_width=True):
                     if new_name and new_name.strip() and new_name.strip() != session_name:
-                        log_data = load_log_data()
-                        if session_id in log_data.get("sessions", {}):
-                            old_name = log_data["sessions"][session_id]["session_name"]
-                            logger.info("サイドバー名前変更: session_id=%s, '%s' → '%s'", session_id, old_name, new_name.strip())
-                            log_data["sessions"][session_id]["session_name"] = new_name.strip()
-                            log_data["sessions"][session_id]["updated_at"] = datetime.now().isoformat()
-                            log_data["sessions"][session_id]["name_changes"].append({
-                                "timestamp": datetime.now().isoformat(),
-                                "old_name": old_name,
-                                "new_name": new_name.strip()
-                            })
-                            save_log_data(log_data)
+                        logger.info("サイドバー名前変更: session_id=%s, '%s' → '%s'", session_id, session_name, new_name.strip())
+                        session_store.rename_session(session_id, new_name.strip())
                         # 次の rerun で widget 描画前に反映される pending キーに保存
                         st.session_state[f"_pending_rename_{session_id}"] = new_name.strip()
                         st.session_state._close_popover = True
                         st.rerun()
                 
-                # セッション名生成
-                if st.button("✨ LLMで名前を生成", key=f"menu_gen_{session_id}", use_container_width=True):
-                    st.session_state.is_processing = True
-                    with st.spinner("生成中..."):
-                        generated = generate_session_name_with_llm(
-                            session_id, model_info, session_info.get("conversation_history", [])
-                        )
-                        if generated:
-                            log_data = load_log_data()
-                            old_name = log_data["sessions"][session_id]["session_name"]
-                            log_data["sessions"][session_id]["session_name"] = generated
-                            log_data["sessions"][session_id]["updated_at"] = datetime.now().isoformat()
-                            log_data["sessions"][session_id]["name_changes"].append({
-                                "timestamp": datetime.now().isoformat(),
-                                "old_name": old_name,
-                                "new_name": generated,
-                                "generated_by_llm": True
-                            })
-                            save_log_data(log_data)
-                            # 次の rerun で widget 描画前に反映される pending キーに保存
-                            st.session_state[f"_pending_rename_{session_id}"] = generated
-                            st.session_state.is_processing = False
-                            st.session_state._close_popover = True
-                            st.rerun()
-                        else:
-                            st.session_state.is_processing = False
-                            st.warning("セッション名を生成できませんでした")
+                # セッション名生成（バックグラウンド。できた名前は次の再実行で反映される）
+                _naming = naming_status(session_id) == "pending"
+                if _naming:
+                    if st.button("⏹ 名前の生成を停止", key=f"menu_gen_stop_{session_id}", use_container_width=True):
+                        cancel_naming(session_id)
+                        st.session_state._close_popover = True
+                        st.rerun()
+                elif st.button("✨ LLMで名前を生成", key=f"menu_gen_{session_id}", use_container_width=True):
+                    full_session = session_store.get_session(session_id) or {}
+                    request_session_name(
+                        session_id, full_session.get("model", {}), full_session.get("conversation_history", [])
+                    )
+                    st.session_state._close_popover = True
+                    st.rerun()
                 
                 # セッション終了
                 if st.button("✔ セッションを終了", key=f"menu_end_{session_id}", use_container_width=True):
                     logger.info("サイドバー: セッション終了 session_id=%s", session_id)
-                    log_data = load_log_data()
-                    terminate_session(log_data["sessions"][session_id])
-                    save_log_data(log_data)
+                    terminate_session(session_id)
                     st.session_state._close_popover = True
                     st.rerun()
             
@@ -655,29 +896,15 @@ def render_session_item(session_id, session_info, container=None, show_resume=Fa
                 # セッション再開
                 if st.button("🔄 セッションを再開", key=f"menu_resume_{session_id}", use_container_width=True):
                     logger.info("サイドバー: セッション再開 session_id=%s", session_id)
-                    log_data = load_log_data()
-                    log_data["sessions"][session_id]["status"] = "active"
-                    log_data["sessions"][session_id]["updated_at"] = datetime.now().isoformat()
-                    save_log_data(log_data)
-                    st.session_state.current_session_id = session_id
-                    st.session_state.conversation_history = session_info.get("conversation_history", [])
-                    model_info_copy = model_info.copy()
-                    if not model_info_copy.get("api_key"):
-                        model_info_copy["api_key"] = get_api_key_for_region(region_raw)
-                    st.session_state.selected_model = model_info_copy
-                    st.session_state.is_new_session = False
-                    st.session_state.view_mode = "chat"
+                    session_store.set_status(session_id, "active")
+                    open_session(session_id)
                     st.session_state._close_popover = True
                     st.rerun()
                 
                 # セッション削除（ゴミ箱へ移動・確認なし）
                 if st.button("🗑️ セッションを削除", key=f"menu_del_{session_id}", use_container_width=True):
                     logger.info("サイドバー: セッション削除 session_id=%s", session_id)
-                    log_data = load_log_data()
-                    log_data["sessions"][session_id]["deleted"] = True
-                    log_data["sessions"][session_id]["deleted_at"] = datetime.now().isoformat()
-                    log_data["sessions"][session_id]["updated_at"] = datetime.now().isoformat()
-                    save_log_data(log_data)
+                    session_store.mark_deleted(session_id)
                     if st.session_state.current_session_id == session_id:
                         st.session_state.current_session_id = None
                         st.session_state.conversation_history = []
@@ -715,6 +942,12 @@ if st.sidebar.button("📊 分析", use_container_width=True):
     st.session_state.is_new_session = False
     st.rerun()
 
+if st.sidebar.button("⚖️ モデル比較", use_container_width=True):
+    st.session_state.view_mode = "compare"
+    st.session_state.current_session_id = None
+    st.session_state.is_new_session = False
+    st.rerun()
+
 st.sidebar.markdown("---")
 
 # --- ゴミ箱 ---
@@ -739,9 +972,8 @@ if st.session_state.view_mode == "trash":
     st.title("ゴミ箱")
     st.markdown("---")
     
-    log_data = load_log_data()
     deleted_sessions = sorted(
-        [(k, v) for k, v in log_data.get("sessions", {}).items() if v.get("deleted", False) and not v.get("purged_from_trash", False)],
+        [(k, v) for k, v in session_store.list_session_summaries().items() if v.get("deleted", False) and not v.get("purged_from_trash", False)],
         key=lambda x: x[1].get("deleted_at", ""),
         reverse=True
     )
@@ -770,13 +1002,9 @@ if st.session_state.view_mode == "trash":
     with btn_row1_col3:
         if st.button("🔄 チェックしたセッションを復元", use_container_width=True, disabled=not has_checked):
             logger.info("ゴミ箱: チェックしたセッションを復元 (%d件)", len(trash_checked_ids))
-            log_data = load_log_data()
-            for sid in trash_checked_ids:
-                if sid in log_data.get("sessions", {}):
-                    log_data["sessions"][sid]["deleted"] = False
-                    log_data["sessions"][sid].pop("deleted_at", None)
-                    log_data["sessions"][sid]["updated_at"] = datetime.now().isoformat()
-            save_log_data(log_data)
+            with session_store.batch():
+                for sid in trash_checked_ids:
+                    session_store.restore_session(sid)
             st.rerun()
     
     st.markdown(get_marker_div_html("danger-btn-marker"), unsafe_allow_html=True)
@@ -794,12 +1022,9 @@ if st.session_state.view_mode == "trash":
             st.markdown(get_marker_div_html("danger-btn-marker"), unsafe_allow_html=True)
             if st.button("完全削除する", type="primary", use_container_width=True):
                 logger.info("ゴミ箱: チェックしたセッションを完全削除 (%d件)", len(trash_checked_ids))
-                log_data = load_log_data()
-                for sid in trash_checked_ids:
-                    if sid in log_data.get("sessions", {}):
-                        log_data["sessions"][sid]["purged_from_trash"] = True
-                        log_data["sessions"][sid]["updated_at"] = datetime.now().isoformat()
-                save_log_data(log_data)
+                with session_store.batch():
+                    for sid in trash_checked_ids:
+                        session_store.purge_session(sid)
                 st.session_state.trash_purge_mode = None
                 st.rerun()
         
@@ -818,10 +1043,9 @@ if st.session_state.view_mode == "trash":
             provider = model_info.get("provider") or model_info.get("constructor") or get_provider_for_deployment(model_info.get("deployment_name", ""))
             type_icon = model_info.get("provider_icon") or model_info.get("constructor_icon") or get_provider_icon(provider)
             
-            messages = session_info.get("messages", [])
-            total_turns = len(messages)
-            total_tokens = sum(m.get("metrics", {}).get("total_tokens", 0) for m in messages)
-            total_cost = sum(m.get("cost", {}).get("total_cost_usd", 0) for m in messages)
+            total_turns = session_info.get("turn_count", 0)
+            total_tokens = session_info.get("total_tokens", 0)
+            total_cost = session_info.get("total_cost_usd", 0)
             
             with st.container():
                 col_cb, col1, col2, col3, col4, col5 = st.columns([0.4, 2.6, 2, 1, 1, 2])
@@ -860,9 +1084,8 @@ elif st.session_state.view_mode == "batch":
     st.title("一括操作")
     st.markdown("---")
 
-    log_data = load_log_data()
     all_batch_sessions = sorted(
-        [(k, v) for k, v in log_data.get("sessions", {}).items()
+        [(k, v) for k, v in session_store.list_session_summaries().items()
          if not v.get("deleted", False) and v.get("status") in ("active", "completed")],
         key=lambda x: x[1].get("last_llm_response_at", x[1].get("created_at", "")),
         reverse=True
@@ -914,12 +1137,6 @@ elif st.session_state.view_mode == "batch":
         # セッション名キーワード
         if batch_name_kw and batch_name_kw.lower() not in sinfo.get("session_name", "").lower():
             continue
-        # 本文キーワード
-        if batch_body_kw:
-            found = any(batch_body_kw.lower() in m.get("content", "").lower()
-                        for m in sinfo.get("conversation_history", []))
-            if not found:
-                continue
         # セッション作成日時の範囲
         if batch_created_start or batch_created_end:
             created_str = sinfo.get("created_at", "")
@@ -963,6 +1180,13 @@ elif st.session_state.view_mode == "batch":
             status_label = "アクティブ" if sinfo.get("status") == "active" else "終了済み"
             if status_label not in batch_filter_status:
                 continue
+        # 本文キーワード（本文はサマリに無いため、他の条件を通過したセッションのみ本体を読み込む）
+        if batch_body_kw:
+            body_session = session_store.get_session(sid) or {}
+            found = any(batch_body_kw.lower() in m.get("content", "").lower()
+                        for m in body_session.get("conversation_history", []))
+            if not found:
+                continue
         filtered_sessions.append((sid, sinfo))
 
     st.caption(f"{len(filtered_sessions)} / {total_count} 件表示")
@@ -988,46 +1212,85 @@ elif st.session_state.view_mode == "batch":
     with btn_r1_c3:
         if st.button("▶️ アクティブにする", key="batch_activate", use_container_width=True, disabled=not has_visible_checked):
             logger.info("一括操作: アクティブにする (%d件)", len(visible_checked_ids))
-            log_data = load_log_data()
-            for sid in visible_checked_ids:
-                if sid in log_data.get("sessions", {}):
-                    log_data["sessions"][sid]["status"] = "active"
-                    log_data["sessions"][sid]["updated_at"] = datetime.now().isoformat()
-            save_log_data(log_data)
+            with session_store.batch():
+                for sid in visible_checked_ids:
+                    session_store.set_status(sid, "active")
             st.rerun()
 
-    btn_r2_c1, btn_r2_c2 = st.columns(2)
+    batch_naming_job = get_batch_job(st.session_state.get("batch_naming_job_id"))
+    batch_naming_running = batch_naming_job is not None and batch_naming_job.status in ("running", "committing")
+    btn_r2_c1, btn_r2_c2, btn_r2_c3 = st.columns(3)
+    with btn_r2_c3:
+        if st.button("✨ LLMで名前を生成", key="batch_gen_names", use_container_width=True,
+                     disabled=not has_visible_checked or batch_naming_running):
+            logger.info("一括操作: LLMで名前を生成 (%d件)", len(visible_checked_ids))
+            st.session_state.batch_naming_job_id = start_batch_session_naming(
+                sorted(visible_checked_ids), st.session_state.get("batch_naming_max_in_flight", NAMING_MAX_IN_FLIGHT),
+            )
+            st.rerun()
     with btn_r2_c1:
         if st.button("🕐 最終更新日時を更新", key="batch_update_ts", use_container_width=True, disabled=not has_visible_checked):
             logger.info("一括操作: 最終更新日時を更新 (%d件)", len(visible_checked_ids))
-            log_data = load_log_data()
             now_str = datetime.now().isoformat()
-            for sid in visible_checked_ids:
-                if sid in log_data.get("sessions", {}):
-                    log_data["sessions"][sid]["last_llm_response_at"] = now_str
-                    log_data["sessions"][sid]["updated_at"] = now_str
-            save_log_data(log_data)
+            with session_store.batch():
+                for sid in visible_checked_ids:
+                    session_store.touch_last_response(sid, now_str)
             st.rerun()
     with btn_r2_c2:
         st.markdown(get_marker_div_html("danger-btn-marker"), unsafe_allow_html=True)
         if st.button("🗑️ 削除する", key="batch_delete", type="primary", use_container_width=True, disabled=not has_visible_checked):
             logger.info("一括操作: 削除する (%d件)", len(visible_checked_ids))
-            log_data = load_log_data()
-            now_str = datetime.now().isoformat()
-            for sid in visible_checked_ids:
-                if sid in log_data.get("sessions", {}):
-                    s = log_data["sessions"][sid]
-                    if s.get("status") == "active":
-                        terminate_session(s)
-                    s["deleted"] = True
-                    s["deleted_at"] = now_str
-            save_log_data(log_data)
+            batch_sessions_by_id = dict(all_batch_sessions)
+            with session_store.batch():
+                for sid in visible_checked_ids:
+                    if batch_sessions_by_id[sid].get("status") == "active":
+                        terminate_session(sid)
+                    session_store.mark_deleted(sid)
             # 現在のセッションが削除対象に含まれる場合はリセット
             if st.session_state.get("current_session_id") in visible_checked_ids:
                 st.session_state.current_session_id = None
                 st.session_state.is_new_session = True
             st.rerun()
 
+    st.number_input(
+        "名前の一括生成: デプロイごとの同時実行数", min_value=1, max_value=32,
+        value=NAMING_MAX_IN_FLIGHT, key="batch_naming_max_in_flight", disabled=batch_naming_running,
+    )
+
+    @st.fragment(run_every=1.0)
+    def render_batch_naming_progress():
+        """名前の一括生成の進捗（1 秒ごとにこの部分だけ再描画し、終わったら画面全体を再実行する）"""
+        job = get_batch_job(st.session_state.get("batch_naming_job_id"))
+        if job is None:
+            return
+        p = job.progress()
+        done = p["named"] + p["failed"] + p["stopped"]
+        if p["status"] in ("running", "committing"):
+            label = "保存中..." if p["status"] == "committing" else (
+                f"名前を生成中: {done} / {p['total']} 件（実行中 {p['in_flight']}、"
+                f"{p['deployments']} デプロイ × 最大 {p['max_in_flight']} 並列、{p['elapsed_seconds']:.1f}秒）"
+            )
+            if p["cancelled"]:
+                label = f"取り消し中: 実行中の {p['in_flight']} 件を打ち切っています（{done} / {p['total']} 件）"
+            st.progress(done / p["total"] if p["total"] else 1.0, text=label)
+            if st.button("⏹ 取り消す", key="batch_naming_cancel", disabled=p["cancelled"]):
+                job.cancel()
+            st.session_state.batch_naming_seen_running = True
+        else:
+            if p["status"] == "failed":
+                st.error(f"名前の保存に失敗しました: {p['commit_error']}")
+            else:
+                skipped = f"、取り消しにより打ち切り {p['stopped']} 件・未実行 {p['remaining']} 件" if p["cancelled"] else ""
+                st.success(
+                    f"✨ {p['committed']} 件のセッション名を保存しました"
+                    f"（失敗 {p['failed']} 件{skipped}、{p['elapsed_seconds']:.1f}秒）"
+                )
+            if st.session_state.pop("batch_naming_seen_running", False):
+                # 新しい名前で一覧を描き直す
+                st.rerun(scope="app")
+
+    render_batch_naming_progress()
+
     st.markdown("---")
 
     # --- セッション一覧 ---
@@ -1040,7 +1303,7 @@ elif st.session_state.view_mode == "batch":
             display_name = model_info.get("display_name") or get_display_name_for_deployment(model_info.get("deployment_name", ""))
 
             last_updated = session_info.get("last_llm_response_at", session_info.get("created_at", ""))
-            total_turns = len(session_info.get("messages", []))
+            total_turns = session_info.get("turn_count", 0)
             status = session_info.get("status", "active")
             status_label = "🟢 アクティブ" if status == "active" else "⏹️ 終了済み"
 
@@ -1082,12 +1345,145 @@ elif st.session_state.view_mode == "analysis":
         st.session_state.is_new_session = True
         st.rerun()
 
+elif st.session_state.view_mode == "compare":
+    # ========================================
+    # モデル比較ビュー
+    # ========================================
+    st.title("モデル比較")
+    st.caption("同じプロンプトを選んだモデルへ同時に送り、応答を並べて比べます（比較の記録は会話ログとは別に保存します）")
+    st.markdown("---")
+
+    compare_models_by_label = {m["dropdown_label"]: m for m in all_models}
+    compare_labels = st.multiselect(
+        f"比較するモデル（最大 {COMPARE_MAX_MODELS} 件）", options=list(compare_models_by_label),
+        max_selections=COMPARE_MAX_MODELS, key="compare_models",
+    )
+    compare_base_ids = [sid for sid, _ in active_sessions + completed_sessions]
+    compare_base_sid = st.selectbox(
+        "共有する会話履歴", options=[None] + compare_base_ids, key="compare_base_session",
+        format_func=lambda sid: "（共有しない: 既定の system プロンプトのみ）" if sid is None
+        else session_summaries.get(sid, {}).get("session_name", sid),
+    )
+    compare_prompt = st.text_area("プロンプト", height=120, key="compare_prompt",
+                                  placeholder="比較するモデルに送るメッセージを入力してください...")
+
+    if st.button("⚖️ 比較して送信", key="compare_send", type="primary", use_container_width=True,
+                 disabled=len(compare_labels) < 2 or not compare_prompt.strip()):
+        compare_targets = [build_model_target(compare_models_by_label[label]) for label in compare_labels]
+        if compare_base_sid:
+            compare_history = copy.deepcopy(list(
+                (session_store.get_session(compare_base_sid) or {}).get("conversation_history", [])
+            ))
+        else:
+            compare_history = [{"role": "system", "content": DEFAULT_SYSTEM_PROMPT}]
+        compare_messages = compare_history + [{"role": "user", "content": compare_prompt.strip()}]
+        compare_estimate = estimate_tokens(compare_messages)
+        logger.info(
+            "モデル比較: models=%s, base_session=%s, history_len=%d",
+            [t["deployment_name"] for t in compare_targets], compare_base_sid, len(compare_messages),
+        )
+
+        # 各モデルの応答欄を先に並べ、届いた順に更新する
+        compare_cols = st.columns(len(compare_targets))
+        compare_placeholders = []
+        for col, target in zip(compare_cols, compare_targets):
+            with col:
+                st.markdown(f"**{target.get('provider_icon', '')} {target.get('display_name')}**  \n"
+                            f"{format_region_display(target.get('region', ''))}")
+                compare_placeholders.append(st.empty())
+        compare_parts = [[] for _ in compare_targets]
+        compare_last_render = [0.0] * len(compare_targets)
+
+        def render_compare_delta(index, delta):
+            compare_parts[index].append(delta)
+            now = time.time()
+            if now - compare_last_render[index] < STREAM_RENDER_INTERVAL:
+                return
+            compare_last_render[index] = now
+            compare_placeholders[index].markdown(get_ai_message_html(
+                ai_metrics_color=_current_theme["ai_metrics_color"],
+                metrics_str="生成中...",
+                content="".join(compare_parts[index]),
+            ), unsafe_allow_html=True)
+
+        def render_compare_done(index, result, error, elapsed):
+            compare_placeholders[index].markdown(get_ai_message_html(
+                ai_metrics_color=_current_theme["ai_metrics_color"],
+                metrics_str=f"❌ {type(error).__name__}" if error else f"{elapsed:.2f}秒",
+                content=str(error) if error else result["text"],
+            ), unsafe_allow_html=True)
+
+        def call_compare_model(target, on_text):
+            # チャットと同じく、クライアント側の TPM / RPM 制限を守って送る
+            reservation = acquire(
+                target["deployment_name"], target["region"],
+                get_limits_for_model(target["deployment_name"], target["region"]), compare_estimate,
+            )
+            try:
+                result = stream_llm(target, target["api_key"], compare_messages, on_text=on_text)
+            except Exception as e:
+                refund(reservation)
+                if not getattr(e, "local", False):
+                    record_failure(target["deployment_name"], target["region"])
+                raise
+            reconcile(reservation, result["total_tokens"])
+            record_success(target["deployment_name"], target["region"],
+                           ttft=result["ttft_seconds"], total=result["elapsed_seconds"])
+            result["rate_limit_wait_seconds"] = reservation["waited_seconds"]
+            return result
+
+        compare_outcome = run_parallel(
+            compare_targets, call_compare_model, on_delta=render_compare_delta, on_done=render_compare_done,
+        )
+        compare_run = {
+            "compare_id": uuid.uuid4().hex[:12],
+            "timestamp": datetime.now().isoformat(),
+            "user_input": compare_prompt.strip(),
+            "base_session_id": compare_base_sid,
+            "history_messages": len(compare_history),
+            "estimated_prompt_tokens": compare_estimate,
+            # 全体の所要時間（最も遅いモデル程度）と、各モデルの所要時間の合計（順番に送った場合の目安）
+            "wall_clock_seconds": compare_outcome["wall_clock_seconds"],
+            "branch_seconds_total": compare_outcome["branch_seconds_total"],
+            "branches": [build_compare_branch(t, o) for t, o in zip(compare_targets, compare_outcome["outcomes"])],
+        }
+        try:
+            append_compare_log(COMPARE_LOG_PATH, compare_run)
+        except OSError:
+            logger.exception("モデル比較: 記録の保存に失敗 path=%s", COMPARE_LOG_PATH)
+        st.session_state.compare_last = compare_run
+        st.rerun()
+
+    compare_last = st.session_state.get("compare_last")
+    if compare_last:
+        st.markdown("---")
+        st.caption(
+            f"⏱ 全体 {compare_last['wall_clock_seconds']:.2f}秒（各モデルの合計 {compare_last['branch_seconds_total']:.2f}秒） | "
+            f"合計 ¥{sum(b.get('cost', {}).get('total_cost_jpy', 0) for b in compare_last['branches']):.2f}"
+        )
+        st.markdown(get_user_message_html(
+            timestamp_str=f'<span style="color:{_current_theme["timestamp_color"]}; font-size:0.8em; float:right;">'
+                          f'{format_timestamp(compare_last["timestamp"])}</span>',
+            content=compare_last["user_input"],
+        ), unsafe_allow_html=True)
+        for col, branch in zip(st.columns(len(compare_last["branches"])), compare_last["branches"]):
+            with col:
+                st.markdown(f"**{get_provider_icon(get_provider_for_deployment(branch['deployment_name']))} "
+                            f"{branch['display_name']}**  \n{format_region_display(branch['region'])}")
+                if "error" in branch:
+                    st.error(f"{format_compare_metrics(branch)}: {branch['error']['error_message']}")
+                else:
+                    st.markdown(get_ai_message_html(
+                        ai_metrics_color=_current_theme["ai_metrics_color"],
+                        metrics_str=format_compare_metrics(branch),
+                        content=branch["response"]["ai_response"],
+                    ), unsafe_allow_html=True)
+
 else:
     # 現在のセッション情報取得
     current_session = None
     if st.session_state.current_session_id:
-        log_data = load_log_data()
-        current_session = log_data.get("sessions", {}).get(st.session_state.current_session_id)
+        current_session = session_store.get_session(st.session_state.current_session_id)
 
     # ========================================
     # テーマ切替トグル（右ペイン上部）
@@ -1111,10 +1507,15 @@ else:
         
         if all_models:
             model_options = [m["dropdown_label"] for m in all_models]
+            # 応答の無いエンドポイントのモデルには状態を付けて表示する（サーキットブレーカー）
+            breaker_labels = {
+                m["dropdown_label"]: BREAKER_STATE_LABELS.get(get_breaker_state(m)) for m in all_models
+            }
             selected_dropdown_label = st.selectbox(
                 "モデル選択",
                 model_options,
                 index=0,
+                format_func=lambda label: f"{label} {breaker_labels[label]}" if breaker_labels.get(label) else label,
                 label_visibility="collapsed"
             )
             
@@ -1135,6 +1536,19 @@ else:
 <tr><td style="{_td} white-space:nowrap;">用途タグ</td><td style="{_td}">{cap_tags}</td></tr>
 <tr><td style="{_td} white-space:nowrap;">利用推奨</td><td style="{_td}">{selected_model_info.get('recommended_usage', '')}</td></tr>
 </table>""", unsafe_allow_html=True)
+                if breaker_labels.get(selected_dropdown_label):
+                    st.warning(
+                        f"{breaker_labels[selected_dropdown_label]}: このリージョンのエンドポイントは直近の送信で"
+                        "接続エラー・タイムアウトが続いています。送信時は同じモデルの別リージョンへ切り替えます。"
+                    )
+                
+                # リージョンの振り分けモード（同じモデルが別リージョンにもある場合のみ選択可）
+                routing_auto = st.toggle(
+                    "🧭 リージョン自動選択（同じモデルを提供するリージョンのうち、実測で速いほうへ送信）",
+                    value=False,
+                    key="new_session_routing_auto",
+                    disabled=not get_equivalent_models(selected_model_info),
+                )
                 
                 # セッション開始ボタン
                 if st.button("🚀 チャットを開始", type="primary", use_container_width=True):
@@ -1157,6 +1571,7 @@ else:
                         "updated_at": session_start.isoformat(),
                         "last_llm_response_at": session_start.isoformat(),
                         "status": "active",
+                        "routing_mode": "auto" if routing_auto else "pinned",
                         "model": {
                             "deployment_name": selected_model_info["deployment_name"],
                             "display_name": selected_model_info.get("display_name", selected_model_info["deployment_name"]),
@@ -1177,7 +1592,7 @@ else:
                             "usd_to_jpy": USD_TO_JPY
                         },
                         "conversation_history": [
-                            {"role": "system", "content": "あなたは親切で知識豊富なアシスタントです。日本語で回答してください。会話の文脈を踏まえて応答してください。"}
+                            {"role": "system", "content": DEFAULT_SYSTEM_PROMPT}
                         ],
                         "messages": [],
                         "errors": [],
@@ -1185,9 +1600,7 @@ else:
                         "name_changes": []
                     }
                     
-                    log_data = load_log_data()
-                    log_data["sessions"][new_session_id] = new_session
-                    save_log_data(log_data)
+                    session_store.create_session(new_session)
                     
                     st.session_state.current_session_id = new_session_id
                     st.session_state.conversation_history = new_session["conversation_history"]
@@ -1202,6 +1615,7 @@ else:
         # 既存セッション - チャット画面
         session_name = current_session.get("session_name", st.session_state.current_session_id)
         model_info = current_session.get("model", {})
+        routing_mode = current_session.get("routing_mode", DEFAULT_ROUTING_MODE)
         session_status = current_session.get("status", "active")
         is_completed = session_status == "completed"
         
@@ -1231,60 +1645,49 @@ else:
                     new_name = st.text_input("📝 新しいセッション名", key=_widget_key)
                     if st.button("入力した名前を保存", key="rename_btn", use_container_width=True):
                         if new_name and new_name != session_name:
-                            log_data = load_log_data()
-                            old_name = log_data["sessions"][st.session_state.current_session_id]["session_name"]
-                            logger.info("メイン名前変更: session_id=%s, '%s' → '%s'", st.session_state.current_session_id, old_name, new_name)
-                            log_data["sessions"][st.session_state.current_session_id]["session_name"] = new_name
-                            log_data["sessions"][st.session_state.current_session_id]["updated_at"] = datetime.now().isoformat()
-                            log_data["sessions"][st.session_state.current_session_id]["name_changes"].append({
-                                "timestamp": datetime.now().isoformat(),
-                                "old_name": old_name,
-                                "new_name": new_name
-                            })
-                            save_log_data(log_data)
+                            logger.info("メイン名前変更: session_id=%s, '%s' → '%s'", st.session_state.current_session_id, session_name, new_name)
+                            session_store.rename_session(st.session_state.current_session_id, new_name)
                             # 次の rerun で widget 描画前に反映される pending キーに保存
                             st.session_state[f"_pending_rename_{st.session_state.current_session_id}"] = new_name
                             st.success("セッション名を変更しました")
                             st.session_state._close_popover = True
                             st.rerun()
                     
-                    # セッション名生成
-                    if st.button("✨ LLMで名前を生成", key="gen_name_btn", use_container_width=True):
-                        st.session_state.is_processing = True
-                        with st.spinner("生成中..."):
-                            generated = generate_session_name_with_llm(
-                                st.session_state.current_session_id,
-                                model_info,
-                                st.session_state.conversation_history
-                            )
-                            if generated:
-                                log_data = load_log_data()
-                                old_name = log_data["sessions"][st.session_state.current_session_id]["session_name"]
-                                log_data["sessions"][st.session_state.current_session_id]["session_name"] = generated
-                                log_data["sessions"][st.session_state.current_session_id]["updated_at"] = datetime.now().isoformat()
-                                log_data["sessions"][st.session_state.current_session_id]["name_changes"].append({
-                                    "timestamp": datetime.now().isoformat(),
-                                    "old_name": old_name,
-                                    "new_name": generated,
-                                    "generated_by_llm": True
-                                })
-                                save_log_data(log_data)
-                                # 次の rerun で widget 描画前に反映される pending キーに保存
-                                st.session_state[f"_pending_rename_{st.session_state.current_session_id}"] = generated
-                                st.session_state.is_processing = False
-                                st.success(f"生成完了: {generated}")
-                                st.session_state._close_popover = True
-                                st.rerun()
-                            else:
-                                st.session_state.is_processing = False
-                                st.warning("セッション名を生成できませんでした")
+                    # セッション名生成（バックグラウンド。できた名前は次の再実行で反映される）
+                    _naming = naming_status(st.session_state.current_session_id) == "pending"
+                    if _naming:
+                        if st.button("⏹ 名前の生成を停止", key="gen_name_stop_btn", use_container_width=True):
+                            cancel_naming(st.session_state.current_session_id)
+                            st.session_state._close_popover = True
+                            st.rerun()
+                    elif st.button("✨ LLMで名前を生成", key="gen_name_btn", use_container_width=True):
+                        request_session_name(
+                            st.session_state.current_session_id,
+                            model_info,
+                            st.session_state.conversation_history
+                        )
+                        st.session_state._close_popover = True
+                        st.rerun()
+                    
+                    # リージョンの振り分けモード（pinned / auto）
+                    _routing_auto = st.toggle(
+                        "🧭 リージョン自動選択",
+                        value=routing_mode == "auto",
+                        key=f"routing_auto_{st.session_state.current_session_id}",
+                        disabled=not get_equivalent_models(model_info),
+                        help="同じモデルを提供するリージョンのうち、直近の TTFT とエラー率から最も速いリージョンへ送信します",
+                    )
+                    if _routing_auto != (routing_mode == "auto"):
+                        routing_mode = "auto" if _routing_auto else "pinned"
+                        logger.info("振り分けモード変更: session_id=%s, mode=%s", st.session_state.current_session_id, routing_mode)
+                        session_store.update_session(
+                            st.session_state.current_session_id, {"routing_mode": routing_mode}, action="set_routing_mode",
+                        )
                     
                     # セッション終了
                     if st.button("✔ セッションを終了", key="end_session_btn", use_container_width=True):
                         logger.info("メイン: セッション終了 session_id=%s", st.session_state.current_session_id)
-                        log_data = load_log_data()
-                        terminate_session(log_data["sessions"][st.session_state.current_session_id])
-                        save_log_data(log_data)
+                        terminate_session(st.session_state.current_session_id)
                         st.success("セッションを終了しました")
                         st.session_state._close_popover = True
                         st.rerun()
@@ -1295,10 +1698,7 @@ else:
                     # セッション再開
                     if st.button("🔄 セッションを再開", key="resume_session_btn", use_container_width=True):
                         logger.info("メイン: セッション再開 session_id=%s", st.session_state.current_session_id)
-                        log_data = load_log_data()
-                        log_data["sessions"][st.session_state.current_session_id]["status"] = "active"
-                        log_data["sessions"][st.session_state.current_session_id]["updated_at"] = datetime.now().isoformat()
-                        save_log_data(log_data)
+                        session_store.set_status(st.session_state.current_session_id, "active")
                         st.success("セッションを再開しました")
                         st.session_state._close_popover = True
                         st.rerun()
@@ -1306,11 +1706,7 @@ else:
                     # セッション削除（ゴミ箱へ移動・確認なし）
                     if st.button("🗑️ セッションを削除", key="delete_session_btn", use_container_width=True):
                         logger.info("メイン: セッション削除 session_id=%s", st.session_state.current_session_id)
-                        log_data = load_log_data()
-                        log_data["sessions"][st.session_state.current_session_id]["deleted"] = True
-                        log_data["sessions"][st.session_state.current_session_id]["deleted_at"] = datetime.now().isoformat()
-                        log_data["sessions"][st.session_state.current_session_id]["updated_at"] = datetime.now().isoformat()
-                        save_log_data(log_data)
+                        session_store.mark_deleted(st.session_state.current_session_id)
                         st.session_state.current_session_id = None
                         st.session_state.conversation_history = []
                         st.session_state.selected_model = None
@@ -1325,7 +1721,7 @@ else:
         st.markdown(get_model_badge_html(
             provider_icon=provider_icon,
             model_display_name=model_display_name,
-            region_display=format_region_display(model_info.get("region", "")),
+            region_display=format_region_display(model_info.get("region", "")) + (" / 🧭 自動" if routing_mode == "auto" else ""),
             provider=provider,
         ), unsafe_allow_html=True)
         # 追加メタデータ表示
@@ -1363,9 +1759,10 @@ else:
             sum(m.get("response", {}).get("response_time_seconds", 0) for m in messages) / len(messages)
             if messages else 0
         )
+        cache_usage = summarize_cache_usage(messages)
         
         # メトリクス行
-        metric_cols = st.columns([1, 1, 1, 1])
+        metric_cols = st.columns([1, 1, 1, 1, 1])
         with metric_cols[0]:
             st.metric("ターン数", total_turns)
         with metric_cols[1]:
@@ -1374,6 +1771,13 @@ else:
             st.metric("コスト (JPY)", f"¥{total_cost * USD_TO_JPY:.2f}")
         with metric_cols[3]:
             st.metric("平均応答時間", f"{avg_response_time:.2f}秒")
+        with metric_cols[4]:
+            st.metric(
+                "キャッシュヒット率",
+                f"{cache_usage['cache_hit_ratio']:.0%}" if cache_usage["cache_read_tokens"] or cache_usage["cache_creation_tokens"] else "-",
+                help=f"プロンプトのうちキャッシュから読んだ割合（読み出し {cache_usage['cache_read_tokens']:,} / "
+                     f"書き込み {cache_usage['cache_creation_tokens']:,} トークン）",
+            )
         
         st.markdown("---")
         
@@ -1421,6 +1825,44 @@ else:
                     tokens = msg_log.get("metrics", {}).get("total_tokens", 0)
                     cost_jpy = msg_log.get("cost", {}).get("total_cost_jpy", 0)
                     metrics_str = f"{response_time:.2f}秒 | {tokens:,}トークン | ¥{cost_jpy:.2f}"
+                    ttft = msg_log.get("metrics", {}).get("ttft_seconds")
+                    if ttft is not None:
+                        decode_tps = msg_log.get("metrics", {}).get("decode_tokens_per_second", 0)
+                        metrics_str += f" | TTFT {ttft:.2f}秒 | {decode_tps:.1f} tok/s"
+                    cache_read = msg_log.get("metrics", {}).get("cache_read_tokens")
+                    if cache_read:
+                        prompt_total = msg_log.get("metrics", {}).get("prompt_tokens") or cache_read
+                        metrics_str += f" | ⚡ キャッシュ {cache_read / prompt_total:.0%}"
+                    summarized = (msg_log.get("context") or {}).get("summarized_messages")
+                    if summarized:
+                        metrics_str += f" | 📝 古い履歴 {summarized} 件は要約で送信"
+                    dropped = (msg_log.get("context") or {}).get("dropped_messages")
+                    if dropped:
+                        metrics_str += f" | ✂️ 古い履歴 {dropped} 件は要約できず省略"
+                    rate_limit_wait = msg_log.get("metrics", {}).get("rate_limit_wait_seconds")
+                    if rate_limit_wait:
+                        metrics_str += f" | ⏳ 送信待ち {rate_limit_wait:.1f}秒"
+                    if msg_log.get("response", {}).get("cached"):
+                        metrics_str += " | 💾 キャッシュ済みの応答"
+                    if msg_log.get("response", {}).get("finish_reason") == "cancelled":
+                        estimated = "（トークン数は概算）" if msg_log.get("metrics", {}).get("usage_estimated") else ""
+                        metrics_str += f" | ⏹ 停止{estimated}"
+                    resilience = msg_log.get("resilience") or {}
+                    if (msg_log.get("routing") or {}).get("mode") == "auto" and not resilience.get("retries") \
+                            and not msg_log.get("response", {}).get("cached"):
+                        metrics_str += f" | 🧭 {format_region_display(msg_log.get('response', {}).get('region'))}"
+                    hedge = msg_log.get("hedge") or {}
+                    if hedge.get("hedged"):
+                        metrics_str += (
+                            f" | 🪁 ヘッジ（{hedge.get('hedge_after_seconds', 0):.2f}秒後）→ "
+                            f"{format_region_display(hedge.get('served_region'))} が応答"
+                            f"（追加 ¥{hedge.get('extra_cost_jpy', 0):.2f}）"
+                        )
+                    if resilience.get("retries"):
+                        metrics_str += (
+                            f" | ↻ {format_region_display(resilience.get('served_region'))}"
+                            f"（再試行 {resilience['retries']} 回, +{resilience.get('added_latency_seconds', 0):.2f}秒）"
+                        )
                 else:
                     metrics_str = ""
                 
@@ -1461,10 +1903,7 @@ else:
             st.info("✅ このセッションは終了済みです。メッセージを送信するには、セッションを再開してください。")
             
             if st.button("🔄 セッションを再開してチャットを続ける", type="primary", use_container_width=True):
-                log_data = load_log_data()
-                log_data["sessions"][st.session_state.current_session_id]["status"] = "active"
-                log_data["sessions"][st.session_state.current_session_id]["updated_at"] = datetime.now().isoformat()
-                save_log_data(log_data)
+                session_store.set_status(st.session_state.current_session_id, "active")
                 st.success("セッションを再開しました")
                 st.rerun()
         else:
@@ -1498,13 +1937,21 @@ else:
                 api_key = get_api_key_for_region(model_info.get("region", ""))
                 # セッションに API Key を保存
                 if api_key:
-                    log_data = load_log_data()
-                    log_data["sessions"][st.session_state.current_session_id]["model"]["api_key"] = api_key
-                    save_log_data(log_data)
+                    session_store.update_session(
+                        st.session_state.current_session_id,
+                        {"model": {**model_info, "api_key": api_key}},
+                        action="save_api_key",
+                    )
             
             # モデル別料金を取得
             model_pricing = get_pricing_for_model(deployment_name, model_type)
             
+            # 生成の停止（⏹ 生成を停止・画面の操作による再実行）
+            stop_token = CancelToken()
+            stop_event = threading.Event()
+            stop_token.on_cancel(stop_event.set)
+            interrupted = []  # 受け止めた RerunException / StopException（保存後に送出し直す）
+            
             with st.spinner(f"🔄 {spinner_icon} AIが応答を生成中..."):
                 try:
                     # 会話履歴更新
@@ -1514,111 +1961,386 @@ else:
                     })
                     
                     request_time = datetime.now()
-                    start_time = time.time()
+                    
+                    # ストリーミング表示: 送信内容と AI メッセージ枠を先に描画し、差分を受け取るたびに更新する
+                    st.markdown(get_user_message_html(
+                        timestamp_str="",
+                        content=user_input,
+                    ), unsafe_allow_html=True)
+                    ai_placeholder = st.empty()
+                    # 生成の停止: 押すと Streamlit が次の st.* 呼び出しで RerunException を送出するので、
+                    # 画面の更新（show_ai）で受け止めてストリームを閉じ、途中までの応答を保存してから再実行する
+                    st.button("⏹ 生成を停止", key="stop_generation")
+                    streamed_parts = []
+                    last_render = [0.0]
+                    
+                    def show_ai(metrics_str, content):
+                        try:
+                            ai_placeholder.markdown(get_ai_message_html(
+                                ai_metrics_color=_current_theme["ai_metrics_color"],
+                                metrics_str=metrics_str,
+                                content=content,
+                            ), unsafe_allow_html=True)
+                        except (RerunException, StopException) as e:
+                            if not interrupted:
+                                logger.info("生成を停止: session_id=%s, reason=%s",
+                                            st.session_state.current_session_id, type(e).__name__)
+                                interrupted.append(e)
+                            stop_token.cancel()
+                    
+                    def render_stream(delta):
+                        streamed_parts.append(delta)
+                        now = time.time()
+                        if now - last_render[0] < STREAM_RENDER_INTERVAL:
+                            return
+                        last_render[0] = now
+                        show_ai(f"{spinner_icon} 生成中...", "".join(streamed_parts))
+                    
+                    def show_waiting(waited):
+                        # 最初のトークンを待つ間も定期的に画面を更新し、停止の操作に気付けるようにする
+                        if not streamed_parts:
+                            show_ai(f"{spinner_icon} 生成中...（{waited:.0f}秒）", "")
                     
                     # ========================================
-                    # モデルタイプに応じたAPI呼び出し
+                    # モデルタイプに応じたAPI呼び出し（再試行・別リージョンへのフェイルオーバー付き）
                     # ========================================
-                    if model_type == "anthropic":
-                        # Anthropic クライアント初期化
+                    def stream_model(target, on_text, cancel=None):
+                        target_key = api_key if target is model_info else get_api_key_for_region(target.get("region", ""))
                         logger.info(
-                            "API呼び出し開始 [Anthropic]: deployment=%s, endpoint=%s, region=%s, history_len=%d",
-                            deployment_name, model_info.get("endpoint"), model_info.get("region"),
-                            len(st.session_state.conversation_history),
+                            "API呼び出し開始 [%s]: deployment=%s, endpoint=%s, region=%s, api_version=%s, history_len=%d",
+                            provider_class(target.get("model_type", "openai")).label,
+                            target.get("deployment_name"), target.get("endpoint"), target.get("region"),
+                            target.get("api_version"), len(messages_to_send),
                         )
-                        client = anthropic.Anthropic(
-                            api_key=api_key,
-                            base_url=model_info.get("endpoint", ""),
+                        return stream_llm(target, target_key, messages_to_send, on_text=on_text, cancel=cancel)
+                    
+                    def show_queued(wait, limit):
+                        show_ai(f"{spinner_icon} ⏳ {limit.upper()} 上限のため送信待ち（約 {wait:.1f}秒）...", "")
+                    
+                    # LLM の呼び出しはワーカースレッドで行い、画面の更新は post() でスクリプトスレッドに渡す（run_in_worker）
+                    worker = {"post": None}
+                    
+                    def call_branch(target, on_text, cancel=None, *, show_queue=True):
+                        if cancel is not None and cancel.cancelled:
+                            # 送信前に停止した: 制限の枠を取らずに打ち切りの結果を返す
+                            return stream_model(target, on_text, cancel)
+                        # クライアント側の TPM / RPM 制限: 推定プロンプト分を先に差し引き、応答後に usage で精算する
+                        # （ヘッジの追加リクエストの待ちは画面に「送信待ち」を出さない）
+                        reservation = acquire(
+                            target.get("deployment_name", ""), target.get("region", ""),
+                            get_limits_for_model(target.get("deployment_name", ""), target.get("region", "")),
+                            prompt_estimate,
+                            on_wait=(lambda wait, limit: worker["post"](show_queued, wait, limit)) if show_queue else None,
                         )
-                        
-                        # system メッセージを分離
-                        system_message = ""
-                        anthropic_messages = []
-                        for msg in st.session_state.conversation_history:
-                            if msg["role"] == "system":
-                                system_message = msg["content"]
-                            else:
-                                anthropic_messages.append(msg)
-                        
-                        # Anthropic API呼び出し
-                        response = client.messages.create(
-                            model=model_info.get("deployment_name", ""),
-                            max_tokens=16384,
-                            system=system_message,
-                            messages=anthropic_messages
+                        try:
+                            result = stream_model(target, on_text, cancel)
+                        except Exception:
+                            refund(reservation)
+                            raise
+                        reconcile(reservation, result["total_tokens"])
+                        result["rate_limit_wait_seconds"] = reservation["waited_seconds"]
+                        return result
+                    
+                    # ヘッジの追加コストの予算: このセッションでこれまでに使った分
+                    session_hedge_spent = sum((m.get("hedge") or {}).get("extra_cost_usd", 0.0) for m in messages)
+                    
+                    def post_stream(delta):
+                        worker["post"](render_stream, delta)
+                    
+                    def call_model(target):
+                        # 再試行時は途中まで表示した応答を捨てて最初から受信し直す
+                        # （表示側のスレッドで消し、すでに渡した差分と順序が入れ替わらないようにする）
+                        worker["post"](streamed_parts.clear)
+                        if not HEDGE_ENABLED:
+                            return call_branch(target, post_stream, stop_token)
+                        # 最初のトークンが遅ければ、同じモデルの別リージョンへ同じリクエストを重ねて送る
+                        alternate = next(
+                            (t for t in hedge_candidates
+                             if t.get("region") != target.get("region") and get_breaker_state(t) != "open"),
+                            None,
                         )
+                        hedge_estimate = calculate_cost(
+                            prompt_estimate, 0,
+                            get_pricing_for_model(alternate.get("deployment_name", ""), model_type) if alternate else None,
+                        )["total_cost_usd"]
+                        # ヘッジではどちらの枝も llm-hedge スレッドで動くので、送信待ちの表示は元の送信先の枝で判断する
+                        return call_hedged(
+                            target, alternate,
+                            lambda branch, on_text, cancel: call_branch(branch, on_text, cancel, show_queue=branch is target),
+                            on_text=post_stream,
+                            allow=lambda: budget_allows(session_hedge_spent, hedge_estimate),
+                            prompt_tokens_estimate=prompt_estimate, cancel=stop_token,
+                        )
+                    
+                    def show_retry(record, next_target, wait):
+                        if record["status_code"] == 429:
+                            # サーバー側で上限に達している間は、同じプロセスの他のセッションからも送らない
+                            block(record["deployment_name"], record["region"], wait)
+                        if next_target.get("region") != record["region"]:
+                            notice = f"⚠️ {record['region']} で {record['error_type']} → {next_target.get('region')} に切り替えて再送信中..."
+                        else:
+                            notice = f"⚠️ {record['error_type']} → {wait:.1f}秒後に再試行します（{record['attempt']} 回目失敗）"
+                        show_ai(f"{spinner_icon} {notice}", "")
+                    
+                    def show_summarizing(waited):
+                        show_ai(f"{spinner_icon} 古い会話を要約中...（{waited:.0f}秒）", "")
+                    
+                    def summarize_branch(target, request_messages, request_estimate):
+                        # 本文の送信と同じく、クライアント側の TPM / RPM 制限とサーキットブレーカーを通す
+                        target_key = api_key if target is model_info else get_api_key_for_region(target.get("region", ""))
+                        if stop_token.cancelled:
+                            return summarize_history_with_llm(target, target_key, request_messages, stop_token)
+                        reservation = acquire(
+                            target.get("deployment_name", ""), target.get("region", ""),
+                            get_limits_for_model(target.get("deployment_name", ""), target.get("region", "")),
+                            request_estimate,
+                        )
+                        try:
+                            result = summarize_history_with_llm(target, target_key, request_messages, stop_token)
+                        except Exception:
+                            refund(reservation)
+                            raise
+                        reconcile(reservation, result["total_tokens"])
+                        return result
+                    
+                    def summarize_in_worker(request_messages):
+                        request_estimate = estimate_tokens(request_messages)
                         
-                        elapsed = time.time() - start_time
-                        response_time_dt = datetime.now()
-                        
-                        # Anthropic レスポンス解析
-                        ai_response = response.content[0].text if response.content else ""
-                        prompt_tokens = response.usage.input_tokens
-                        completion_tokens = response.usage.output_tokens
-                        total_tokens_turn = prompt_tokens + completion_tokens
-                        finish_reason = response.stop_reason
-                        response_model = response.model
-                        response_id = response.id
+                        def on_retry(record, next_target, wait):
+                            if record["status_code"] == 429:
+                                block(record["deployment_name"], record["region"], wait)
                         
-                        logger.info(
-                            "API応答完了 [Anthropic]: response_id=%s, model=%s, elapsed=%.3fs, "
-                            "prompt_tokens=%d, completion_tokens=%d, total_tokens=%d, finish_reason=%s",
-                            response_id, response_model, elapsed,
-                            prompt_tokens, completion_tokens, total_tokens_turn, finish_reason,
+                        try:
+                            return call_with_failover(
+                                targets, lambda target: summarize_branch(target, request_messages, request_estimate),
+                                on_retry=on_retry, sleep=stop_event.wait,
+                            )
+                        except RetryExhaustedError as e:
+                            record_attempts(e.attempts)
+                            raise
+                    
+                    def summarize_context(request_messages):
+                        # lib/context_budget.py の summarize コールバック。本文と同じくワーカースレッドで送り、
+                        # 「⏹ 生成を停止」で打ち切れるようにする（例外は build_context が受けて切り詰めに切り替える）
+                        result, summary_resilience = run_in_worker(
+                            lambda post: summarize_in_worker(request_messages), on_idle=show_summarizing, cancel=stop_token,
                         )
-                        logger.debug(
-                            "API応答詳細 [Anthropic]: response_chars=%d, stop_reason=%s",
-                            len(ai_response), finish_reason,
+                        record_attempts(summary_resilience["attempts"])
+                        if result["finish_reason"] == "cancelled":
+                            raise RuntimeError("要約の生成を停止しました")
+                        return result["text"] or "", {
+                            "prompt_tokens": result["prompt_tokens"], "completion_tokens": result["completion_tokens"],
+                        }
+                    
+                    def call_in_worker(post):
+                        worker["post"] = post
+                        return call_with_failover(
+                            targets, call_model,
+                            on_retry=lambda record, next_target, wait: post(show_retry, record, next_target, wait),
+                            # 再試行の待ち時間中に停止したらすぐ次の試行に進む（送信前に打ち切られる）
+                            sleep=stop_event.wait,
                         )
-                        
-                    else:
-                        # OpenAI クライアント初期化
+                    
+                    # 応答キャッシュ: 同じデプロイに同じ内容を送る場合は LLM を呼ばずに保存済みの応答を返す
+                    response_cache_key = None
+                    cached_entry = None
+                    hedge_record = None
+                    if response_cache is not None:
+                        if is_response_cache_enabled_for_model(deployment_name):
+                            # キーは要約で圧縮する前の会話履歴（要約の有無・内容に左右されず、ヒット時は要約も作らない）
+                            response_cache_key = cache_key(
+                                deployment_name, st.session_state.conversation_history, MAX_OUTPUT_TOKENS,
+                                CHAT_TEMPERATURE if provider_class(model_type).uses_temperature else None,
+                            )
+                            lookup_started = time.perf_counter()
+                            try:
+                                cached_entry = response_cache.get(response_cache_key)
+                            except OSError:
+                                # キャッシュが読めなくても応答は LLM から取得する
+                                logger.exception("応答キャッシュの参照に失敗 key=%s", response_cache_key[:16])
+                            lookup_seconds = time.perf_counter() - lookup_started
+                        else:
+                            response_cache.record_bypass()
+                    
+                    if cached_entry is not None:
                         logger.info(
-                            "API呼び出し開始 [OpenAI]: deployment=%s, endpoint=%s, region=%s, "
-                            "api_version=%s, history_len=%d",
-                            deployment_name, model_info.get("endpoint"), model_info.get("region"),
-                            model_info.get("api_version"), len(st.session_state.conversation_history),
+                            "応答キャッシュにヒット: session_id=%s, deployment=%s, key=%s, cached_response_id=%s",
+                            st.session_state.current_session_id, deployment_name, response_cache_key[:16],
+                            cached_entry.get("response_id"),
                         )
-                        client = AzureOpenAI(
-                            api_key=api_key,
-                            api_version=model_info.get("api_version", "2024-12-01-preview"),
-                            azure_endpoint=model_info.get("endpoint", ""),
-                            timeout=httpx.Timeout(120.0, connect=10.0)
-                        )
-                        
-                        # OpenAI API呼び出し
-                        response = client.chat.completions.create(
-                            model=model_info.get("deployment_name", ""),
-                            messages=st.session_state.conversation_history,
-                            max_completion_tokens=16384,
-                            temperature=0.7
+                        # トークンを消費していないので usage・コストは 0 として記録する
+                        result = {
+                            "text": cached_entry["text"],
+                            "prompt_tokens": 0,
+                            "completion_tokens": 0,
+                            "total_tokens": 0,
+                            "cache_read_tokens": 0,
+                            "cache_creation_tokens": 0,
+                            "finish_reason": cached_entry.get("finish_reason"),
+                            "model": cached_entry.get("model"),
+                            "response_id": cached_entry.get("response_id"),
+                            "elapsed_seconds": lookup_seconds,
+                            "ttft_seconds": lookup_seconds,
+                            "decode_tokens_per_second": 0.0,
+                            "rate_limit_wait_seconds": 0.0,
+                        }
+                        resilience = {
+                            "attempts": [],
+                            "served_region": model_info.get("region", ""),
+                            "served_deployment": deployment_name,
+                            "failover": False,
+                            "retries": 0,
+                            "added_latency_seconds": 0.0,
+                        }
+                        routing = {"mode": routing_mode, "reason": "response_cache",
+                                   "chosen_region": model_info.get("region", ""),
+                                   "chosen_deployment": deployment_name, "candidates": []}
+                        # 送信していないので、コンテキストの組み立て（要約の生成）もしない
+                        context_record = None
+                        prompt_estimate = 0
+                    else:
+                        # 振り分け（auto なら実測で速いリージョンを先頭に）→ 残りはフェイルオーバー先
+                        targets, routing = route([model_info, *get_equivalent_models(model_info)], routing_mode)
+                        # ヘッジ先はフェイルオーバーを無効にしていても同じ候補から選ぶ
+                        hedge_candidates = targets
+                        if not LLM_FAILOVER_ENABLED:
+                            targets = targets[:1]
+                        # コンテキスト予算: 超える場合は古いやり取りを要約に置き換える（要約はセッションに保存して使い回す）。
+                        # 要約の生成に失敗・停止した場合、build_context は古いやり取りを送らない（切り詰め）ことで予算に収める
+                        messages_to_send, new_context_summary, context_record = build_context(
+                            st.session_state.conversation_history,
+                            get_context_budget_for_model(deployment_name),
+                            current_session.get("context_summary"),
+                            summarize_context,
                         )
-                        
-                        elapsed = time.time() - start_time
-                        response_time_dt = datetime.now()
-                        
-                        # OpenAI レスポンス解析
-                        choice = response.choices[0]
-                        ai_response = choice.message.content or ""
-                        prompt_tokens = response.usage.prompt_tokens
-                        completion_tokens = response.usage.completion_tokens
-                        total_tokens_turn = response.usage.total_tokens
-                        finish_reason = choice.finish_reason
-                        response_model = response.model
-                        response_id = response.id
-                        
-                        logger.info(
-                            "API応答完了 [OpenAI]: response_id=%s, model=%s, elapsed=%.3fs, "
-                            "prompt_tokens=%d, completion_tokens=%d, total_tokens=%d, finish_reason=%s",
-                            response_id, response_model, elapsed,
-                            prompt_tokens, completion_tokens, total_tokens_turn, finish_reason,
+                        if new_context_summary is not None:
+                            session_store.update_session(
+                                st.session_state.current_session_id,
+                                {"context_summary": new_context_summary},
+                                action="update_context_summary",
+                            )
+                        prompt_estimate = estimate_tokens(messages_to_send)
+                        try:
+                            result, resilience = run_in_worker(call_in_worker, on_idle=show_waiting, cancel=stop_token)
+                        except RetryExhaustedError as e:
+                            record_attempts(e.attempts)
+                            raise
+                        except BaseException:
+                            # 画面側で想定外に中断した場合も、ワーカーの受信は打ち切る
+                            stop_token.cancel()
+                            raise
+                        record_attempts(resilience["attempts"])
+                        hedge_record = result.get("hedge")
+                        if hedge_record and hedge_record["winner"] == "hedge":
+                            # ヘッジ側が先に応答した
+                            resilience["served_region"] = hedge_record["served_region"]
+                            resilience["served_deployment"] = hedge_record["served_deployment"]
+                            resilience["failover"] = resilience["served_region"] != model_info.get("region", "")
+                        if result["finish_reason"] != "cancelled":
+                            # 停止した応答の所要時間は実測の統計に入れない
+                            record_success(
+                                resilience["served_deployment"], resilience["served_region"],
+                                ttft=result["ttft_seconds"], total=result["elapsed_seconds"],
+                            )
+                        # 途中で打ち切られていない応答だけを保存する
+                        if response_cache_key is not None and result["finish_reason"] in ("stop", "end_turn"):
+                            try:
+                                response_cache.put(response_cache_key, {
+                                    "deployment_name": resilience["served_deployment"],
+                                    "region": resilience["served_region"],
+                                    "text": result["text"],
+                                    "model": result["model"],
+                                    "response_id": result["response_id"],
+                                    "finish_reason": result["finish_reason"],
+                                    "prompt_tokens": result["prompt_tokens"],
+                                    "completion_tokens": result["completion_tokens"],
+                                })
+                            except OSError:
+                                logger.exception("応答キャッシュへの保存に失敗 key=%s", response_cache_key[:16])
+                    response_time_dt = datetime.now()
+                    
+                    # 別のデプロイで応答した場合はそのデプロイの料金で計算する
+                    if resilience["served_deployment"] != deployment_name:
+                        model_pricing = get_pricing_for_model(resilience["served_deployment"], model_type)
+                    
+                    # レスポンス解析
+                    ai_response = result["text"]
+                    prompt_tokens = result["prompt_tokens"]
+                    completion_tokens = result["completion_tokens"]
+                    total_tokens_turn = result["total_tokens"]
+                    finish_reason = result["finish_reason"]
+                    response_model = result["model"]
+                    response_id = result["response_id"]
+                    
+                    logger.info(
+                        "API応答完了 [%s]: response_id=%s, model=%s, region=%s, elapsed=%.3fs, ttft=%.3fs, "
+                        "prompt_tokens=%d (cache_read=%d, cache_creation=%d), completion_tokens=%d, total_tokens=%d, "
+                        "finish_reason=%s, retries=%d, added_latency=%.3fs",
+                        provider_class(model_type).label,
+                        response_id, response_model, resilience["served_region"], result["elapsed_seconds"],
+                        result["ttft_seconds"], prompt_tokens, result["cache_read_tokens"],
+                        result["cache_creation_tokens"], completion_tokens, total_tokens_turn, finish_reason,
+                        resilience["retries"], resilience["added_latency_seconds"],
+                    )
+                    logger.debug(
+                        "API応答詳細: response_chars=%d, finish_reason=%s",
+                        len(ai_response), finish_reason,
+                    )
+                    
+                    
+                    elapsed = result["elapsed_seconds"]
+                    cost_info = calculate_cost(
+                        prompt_tokens, completion_tokens, model_pricing,
+                        cache_read_tokens=result["cache_read_tokens"],
+                        cache_creation_tokens=result["cache_creation_tokens"],
+                    )
+                    if context_record and context_record["summary_usage"]:
+                        # 要約の生成コストもこのターンのコストに含める
+                        summary_cost = calculate_cost(
+                            context_record["summary_usage"]["prompt_tokens"],
+                            context_record["summary_usage"]["completion_tokens"],
+                            get_pricing_for_model(deployment_name, model_type),
                         )
-                        logger.debug(
-                            "API応答詳細 [OpenAI]: response_chars=%d, finish_reason=%s",
-                            len(ai_response), finish_reason,
+                        cost_info["summary_cost_usd"] = summary_cost["total_cost_usd"]
+                        cost_info["total_cost_usd"] = round(cost_info["total_cost_usd"] + summary_cost["total_cost_usd"], 6)
+                        cost_info["total_cost_jpy"] = round(cost_info["total_cost_jpy"] + summary_cost["total_cost_jpy"], 2)
+                    if hedge_record and hedge_record["loser"]:
+                        # ヘッジで打ち切った側が消費したトークンもこのターンのコストに含め、予算に計上する
+                        loser = hedge_record["loser"]
+                        hedge_cost = calculate_cost(
+                            loser["prompt_tokens"], loser["completion_tokens"],
+                            get_pricing_for_model(loser["deployment_name"], model_type),
                         )
+                        hedge_record["extra_tokens"] = loser["prompt_tokens"] + loser["completion_tokens"]
+                        hedge_record["extra_cost_usd"] = hedge_cost["total_cost_usd"]
+                        hedge_record["extra_cost_jpy"] = hedge_cost["total_cost_jpy"]
+                        charge_hedge(hedge_record["extra_tokens"], hedge_cost["total_cost_usd"])
+                        cost_info["hedge_cost_usd"] = hedge_cost["total_cost_usd"]
+                        cost_info["total_cost_usd"] = round(cost_info["total_cost_usd"] + hedge_cost["total_cost_usd"], 6)
+                        cost_info["total_cost_jpy"] = round(cost_info["total_cost_jpy"] + hedge_cost["total_cost_jpy"], 2)
                     
-                    cost_info = calculate_cost(prompt_tokens, completion_tokens, model_pricing)
+                    if finish_reason == "cancelled" and not ai_response:
+                        # 応答を受け取る前に停止した: 会話には残さず、送った分のコストとともにエラー履歴に記録する
+                        st.session_state.conversation_history.pop()
+                        session_store.append_error(st.session_state.current_session_id, {
+                            "turn": len(messages) + 1,
+                            "timestamp": response_time_dt.isoformat(),
+                            "error_type": "Cancelled",
+                            "error_message": f"応答を受け取る前に生成を停止しました（{elapsed:.2f}秒）",
+                            "user_input": user_input,
+                            "finish_reason": finish_reason,
+                            "metrics": {
+                                "prompt_tokens": prompt_tokens,
+                                "completion_tokens": completion_tokens,
+                                "usage_estimated": result.get("usage_estimated", False),
+                            },
+                            "cost": cost_info,
+                            "resilience": {"requested_region": model_info.get("region", ""), **resilience},
+                        })
+                        st.session_state.is_processing = False
+                        if interrupted:
+                            raise interrupted[0]
+                        st.rerun()
                     
                     # 会話履歴に追加
                     st.session_state.conversation_history.append({
@@ -1639,9 +2361,11 @@ else:
                             "response_time_seconds": round(elapsed, 3),
                             "model": response_model,
                             "model_type": model_type,
-                            "region": model_info.get("region", ""),
+                            "region": resilience["served_region"],
+                            "deployment_name": resilience["served_deployment"],
                             "response_id": response_id,
                             "finish_reason": finish_reason,
+                            "streamed": True,
                             "ai_response": ai_response,
                             "ai_response_chars": len(ai_response)
                         },
@@ -1649,19 +2373,66 @@ else:
                             "prompt_tokens": prompt_tokens,
                             "completion_tokens": completion_tokens,
                             "total_tokens": total_tokens_turn,
-                            "tokens_per_second": round(completion_tokens / elapsed, 2) if elapsed > 0 else 0
+                            # prompt_tokens のうちプロンプトキャッシュから読んだ分・キャッシュに書いた分
+                            "cache_read_tokens": result["cache_read_tokens"],
+                            "cache_creation_tokens": result["cache_creation_tokens"],
+                            # 応答全体（キュー待ち + prefill + 生成）での値。生成速度は decode_tokens_per_second
+                            "tokens_per_second": round(completion_tokens / elapsed, 2) if elapsed > 0 else 0,
+                            "ttft_seconds": round(result["ttft_seconds"], 3),
+                            "decode_tokens_per_second": round(result["decode_tokens_per_second"], 2),
+                            # クライアント側の TPM / RPM 制限で送信を待った秒数
+                            "rate_limit_wait_seconds": result["rate_limit_wait_seconds"],
+                            "estimated_prompt_tokens": prompt_estimate,
+                            # 停止して usage を受け取れなかった場合は、トークン数（とコスト）を概算した
+                            "usage_estimated": result.get("usage_estimated", False),
+                        },
+                        "cost": cost_info,
+                        # リージョン振り分けの判断（モード・理由・候補ごとの統計）
+                        "routing": routing,
+                        # 再試行・フェイルオーバーの記録（試行ごとのリージョン・エラー、増えた待ち時間）
+                        "resilience": {
+                            "requested_region": model_info.get("region", ""),
+                            **resilience,
                         },
-                        "cost": cost_info
                     }
+                    if context_record is not None:
+                        # コンテキスト予算: 保存している履歴と実際に送った内容（要約で置き換えた件数など）
+                        message_log["context"] = context_record
+                    if hedge_record:
+                        # ヘッジの記録（待ち時間・ヘッジしたか・勝った側・打ち切った側の usage と追加コスト）
+                        message_log["hedge"] = hedge_record
+                    if cached_entry is not None:
+                        # 応答キャッシュから返した（元の応答のトークン数は節約できた分として残す）
+                        message_log["response"]["cached"] = True
+                        message_log["response_cache"] = {
+                            "hit": True,
+                            "key": response_cache_key,
+                            "cached_at": cached_entry.get("stored_at_iso"),
+                            "cached_response_id": cached_entry.get("response_id"),
+                            "saved_prompt_tokens": cached_entry.get("prompt_tokens", 0),
+                            "saved_completion_tokens": cached_entry.get("completion_tokens", 0),
+                        }
                     
-                    log_data = load_log_data()
-                    log_data["sessions"][st.session_state.current_session_id]["messages"].append(message_log)
-                    log_data["sessions"][st.session_state.current_session_id]["conversation_history"] = st.session_state.conversation_history
-                    log_data["sessions"][st.session_state.current_session_id]["updated_at"] = response_time_dt.isoformat()
-                    log_data["sessions"][st.session_state.current_session_id]["last_llm_response_at"] = response_time_dt.isoformat()
-                    save_log_data(log_data)
+                    session_store.append_turn(
+                        st.session_state.current_session_id,
+                        st.session_state.conversation_history[-2:],
+                        message_log,
+                        at=response_time_dt.isoformat(),
+                    )
+                    # 指定の往復数に達したら、名前を変えていないセッションの名前をバックグラウンドで生成する
+                    if (
+                        SESSION_NAMING_AUTO_TURN
+                        and message_log["turn"] == SESSION_NAMING_AUTO_TURN
+                        and not current_session.get("name_changes")
+                    ):
+                        request_session_name(
+                            st.session_state.current_session_id, model_info, st.session_state.conversation_history,
+                        )
                     
                     st.session_state.is_processing = False
+                    if interrupted:
+                        # 停止ボタンなどの操作による再実行・停止をそのまま続ける
+                        raise interrupted[0]
                     st.rerun()
                     
                 except Exception as e:
@@ -1681,14 +2452,25 @@ else:
                         "error_message": str(e),
                         "user_input": user_input
                     }
+                    if isinstance(e, RetryExhaustedError):
+                        # 最後の例外の種別を記録し、試行ごとの内訳を添える
+                        error_log["error_type"] = type(e.last_error).__name__
+                        error_log["attempts"] = e.attempts
+                    elif isinstance(e, WorkerAbandonedError):
+                        # 応答ヘッダーを受け取る前に停止した（usage が分からないためコストは記録しない）
+                        error_log["error_type"] = "Cancelled"
+                        error_log["finish_reason"] = "cancelled"
                     
-                    log_data = load_log_data()
-                    log_data["sessions"][st.session_state.current_session_id]["errors"].append(error_log)
-                    log_data["sessions"][st.session_state.current_session_id]["updated_at"] = error_time.isoformat()
-                    save_log_data(log_data)
+                    session_store.append_error(st.session_state.current_session_id, error_log)
                     
                     st.session_state.is_processing = False
-                    st.error(f"❌ エラーが発生しました: {type(e).__name__}: {e}")
+                    if interrupted:
+                        raise interrupted[0]
+                    if isinstance(e, RetryExhaustedError) and isinstance(e.last_error, RateLimitQueuedError):
+                        # 送信前に止めた（エンドポイントには送っていない）ので、待ってから再送信してもらう
+                        st.warning(f"⏳ 送信待ち: {e.last_error}。しばらくしてから再送信してください。")
+                    else:
+                        st.error(f"❌ エラーが発生しました: {type(e).__name__}: {e}")
         
         # ========================================
         # エラー表示
@@ -1707,4 +2489,77 @@ else:
 # フッター
 # ========================================
 st.markdown("---")
-st.caption(f"📁 ログファイル: {LOG_FILE_PATH}")
+st.caption(f"📁 ログファイル: {session_store.path} ({session_store.backend})")
+_store_stats = session_store.stats()
+if "queue_depth" in _store_stats:
+    st.caption(
+        f"💾 書き込みキュー: {_store_stats['queue_depth']} 件待ち | "
+        f"書き込み {_store_stats['flushes']} 回（集約 {_store_stats['coalesced']} 件） | "
+        f"平均 {_store_stats['avg_flush_ms']:.1f} ms / 最大 {_store_stats['max_flush_ms']:.1f} ms"
+    )
+_client_stats = client_stats()
+if _client_stats["clients"]:
+    st.caption(
+        f"🔌 LLM クライアント: {_client_stats['clients']} 件（再利用 {_client_stats['hits']} 回 / 生成 {_client_stats['misses']} 回） | "
+        f"接続 {_client_stats['connections']}（使用中 {_client_stats['active']} / アイドル {_client_stats['idle']}）"
+        f"{' | HTTP/2' if _client_stats['http2'] else ''}"
+    )
+def _format_limiter_stats(s):
+    limits = []
+    if s["tpm"]:
+        limits.append(f"残り {s['tokens_available']:,}/{s['tpm']:,.0f} TPM")
+    if s["rpm"]:
+        limits.append(f"{s['requests_available']:.0f}/{s['rpm']:,.0f} RPM")
+    if s["blocked_seconds"]:
+        limits.append(f"429 により {s['blocked_seconds']:.0f}秒停止中")
+    return (
+        f"{s['deployment_name']}@{format_region_display(s['region'])} {'・'.join(limits) or '上限なし'}"
+        f"（待ち {s['waited']} 回・平均 {s['avg_wait_seconds']:.1f}秒・最大 {s['wait_seconds_max']:.1f}秒、"
+        f"待機中 {s['waiting']}、送信見送り {s['queued']}）"
+    )
+
+if response_cache is not None:
+    _cache_stats = response_cache.stats()
+    st.caption(
+        f"💾 応答キャッシュ: {_cache_stats['entries']} 件 {_cache_stats['bytes'] / 1024 / 1024:.1f}/"
+        f"{_cache_stats['max_bytes'] / 1024 / 1024:.0f} MB | ヒット {_cache_stats['hits']} / ミス {_cache_stats['misses']}"
+        f"（{_cache_stats['hit_rate']:.0%}） | 追い出し {_cache_stats['evictions']}・期限切れ {_cache_stats['expired']}・"
+        f"バイパス {_cache_stats['bypassed']}"
+    )
+if HEDGE_ENABLED:
+    _hedge_stats = hedge_stats()
+    st.caption(
+        f"🪁 ヘッジ: 送信 {_hedge_stats['calls']} 回中 {_hedge_stats['hedged']} 回（{_hedge_stats['hedge_rate']:.0%}） | "
+        f"ヘッジ側の勝ち {_hedge_stats['hedge_wins']} 回 | 追加 {_hedge_stats['extra_tokens']:,} トークン・"
+        f"${_hedge_stats['extra_cost_usd']:.4f}（本日 ${_hedge_stats['daily_spent_usd']:.4f} / ${_hedge_stats['daily_budget_usd']:.2f}） | "
+        f"予算で見送り {_hedge_stats['skipped_budget']} 回"
+    )
+_naming_stats = naming_stats()
+if _naming_stats["submitted"]:
+    st.caption(
+        f"✨ 名前の生成: 進行中 {_naming_stats['pending']} 件 | 完了 {_naming_stats['done']} / 失敗 {_naming_stats['failed']}"
+        f" / 停止 {_naming_stats['cancelled']}"
+        f"（ワーカー {_naming_stats['workers']}）"
+    )
+_limiter_stats = limiter_stats()
+if _limiter_stats:
+    st.caption("🚦 レート制限: " + " / ".join(_format_limiter_stats(s) for s in _limiter_stats))
+_breaker_stats = [s for s in breaker_stats() if s["state"] != "closed" or s["failures"]] if BREAKER_ENABLED else []
+if _breaker_stats:
+    _breaker_regions = {(m["endpoint"], m["deployment_name"]): m["region"] for m in all_models}
+    st.caption("⚡ サーキットブレーカー: " + " / ".join(
+        f"{s['deployment_name']}@{format_region_display(_breaker_regions.get((s['endpoint'], s['deployment_name']), s['endpoint']))} {s['state']}"
+        + (f"（あと {s['open_remaining_seconds']:.0f}秒）" if s["state"] == "open" else "")
+        + f" 失敗 {s['failures']} 回（連続 {s['consecutive_failures']}）・遮断 {s['opened']} 回・"
+        f"送信停止 {s['fast_failed']} 件・回復確認 {s['probes']} 回"
+        for s in _breaker_stats
+    ))
+_router_stats = router_stats()
+if _router_stats:
+    st.caption("🧭 リージョン実測: " + " / ".join(
+        f"{s['deployment_name']}@{format_region_display(s['region'])} "
+        + (f"TTFT p50 {s['p50_ttft']:.2f}秒・p95 {s['p95_ttft']:.2f}秒（EWMA {s['ewma_ttft']:.2f}秒）"
+           if s["ewma_ttft"] is not None else "未計測")
+        + f" エラー率 {s['error_rate']:.0%}"
+        for s in _router_stats
+    ))
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+サーキットブレーカー（lib/circuit_breaker.py）の状態遷移を、ローカルの偽エンドポイント
+（Azure OpenAI / Anthropic 互換のストリーミング応答を返す最小実装）に対して検証する。
+
+- 5xx・タイムアウトが続くと open になり、以降はエンドポイントへ送らずにすぐ失敗する
+- 429・400 はエンドポイントが応答しているので数えない
+- open の期間が過ぎると 1 件だけ回復確認（probe）を送り、その間の他の送信はすぐ失敗する
+- probe が成功すれば closed、失敗すれば再び open
+- 取り消した probe は成功にも失敗にも数えず、次の送信を改めて probe にする
+- call_with_failover() は CircuitOpenError を待たずに次のリージョンへ切り替える
+- 非同期版（acomplete()）も同期版と同じ結果を返し、応答ヘッダー前・受信中の取り消しですぐ打ち切る
+
+外部の API には接続しない。プロジェクトルートで実行すること: python verify_circuit_breaker.py
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# 検証用に短くする（lib/circuit_breaker.py の読み込み前に設定する）
+os.environ["CIRCUIT_BREAKER_ENABLED"] = "1"
+os.environ["CIRCUIT_BREAKER_FAILURES"] = "3"
+os.environ["CIRCUIT_BREAKER_OPEN_SECONDS"] = "0.5"
+
+from lib.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitOpenError,
+    breaker_state,
+    breaker_stats,
+    call_with_breaker,
+    reset,
+)
+from lib.llm_providers import get_provider
+from lib.llm_retry import call_with_failover
+from lib.llm_stream import CancelToken
+
+TIMEOUT = 0.3  # 偽エンドポイントの "hang" はこれより長く待たせる
+
+
+# ========================================
+# 偽エンドポイント
+# ========================================
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # status: 返す HTTP ステータス（200 ならストリーミング応答）/ delay: 応答ヘッダーまでの秒数 /
+    # chunk_delay: ストリーミング応答のイベント間の秒数
+    mode = {"status": 200, "delay": 0.0, "chunk_delay": 0.0}
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+        type(self).requests += 1
+        status, delay = self.mode["status"], self.mode["delay"]
+        if delay:
+            time.sleep(delay)
+        if status != 200:
+            data = json.dumps({"error": {"message": "fake", "type": "server_error"}}).encode("utf-8")
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            self.send_header("retry-after", "0")
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if "/v1/messages" in self.path:
+            events = [
+                ("message_start", {"type": "message_start", "message": {
+                    "id": "msg_fake", "type": "message", "role": "assistant", "model": body.get("model"),
+                    "content": [], "stop_reason": None, "stop_sequence": None,
+                    "usage": {"input_tokens": 5, "output_tokens": 1}}}),
+                ("content_block_start", {"type": "content_block_start", "index": 0,
+                                         "content_block": {"type": "text", "text": ""}}),
+                ("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                         "delta": {"type": "text_delta", "text": "ok"}}),
+                ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                   "usage": {"output_tokens": 1}}),
+                ("message_stop", {"type": "message_stop"}),
+            ]
+        else:
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": "fake"}
+            events = [
+                (None, {**chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": "ok"},
+                                              "finish_reason": None}]}),
+                (None, {**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}),
+                (None, {**chunk, "choices": [],
+                        "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}}),
+                (None, "[DONE]"),
+            ]
+        parts = [
+            ((f"event: {name}\n" if name else "")
+             + f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n").encode("utf-8")
+            for name, payload in events
+        ]
+        try:
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("content-length", str(sum(len(part) for part in parts)))
+            self.end_headers()
+            for part in parts:
+                self.wfile.write(part)
+                self.wfile.flush()
+                if self.mode["chunk_delay"]:
+                    time.sleep(self.mode["chunk_delay"])
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # タイムアウトでクライアントが先に切断した
+
+
+def start_fake_endpoint() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def set_mode(status: int = 200, delay: float = 0.0, chunk_delay: float = 0.0) -> None:
+    _FakeHandler.mode = {"status": status, "delay": delay, "chunk_delay": chunk_delay}
+
+
+# ========================================
+# 検証
+# ========================================
+def make_target(endpoint: str, model_type: str, region: str = "Fake") -> dict:
+    return {"deployment_name": f"fake-{model_type}", "region": region, "model_type": model_type,
+            "endpoint": endpoint, "api_version": "2024-12-01-preview"}
+
+
+def send(target: dict, cancel: CancelToken | None = None):
+    """breaker を通して 1 回送る。(結果 or 例外, 所要秒数)"""
+    started = time.perf_counter()
+    try:
+        outcome = call_with_breaker(
+            target["endpoint"], target["deployment_name"],
+            lambda: get_provider(target, "fake").complete(
+                [{"role": "user", "content": "hi"}], max_tokens=16, timeout=TIMEOUT, max_retries=0, cancel=cancel,
+            ),
+        )
+    except Exception as e:
+        outcome = e
+    return outcome, time.perf_counter() - started
+
+
+def state_of(target: dict) -> str:
+    return breaker_state(target["endpoint"], target["deployment_name"])
+
+
+def check_trip(target: dict, status: int, delay: float) -> list:
+    """連続失敗で open になり、open の間はエンドポイントへ送らずにすぐ失敗すること"""
+    problems = []
+    reset()
+    set_mode()
+    outcome, _ = send(target)
+    if isinstance(outcome, Exception) or state_of(target) != CLOSED:
+        problems.append(f"正常時の送信が失敗した / closed でない: {outcome!r}")
+    set_mode(status, delay)
+    for i in range(3):
+        outcome, _ = send(target)
+        if isinstance(outcome, CircuitOpenError):
+            problems.append(f"{i + 1} 回目の失敗で既に送信を止めている")
+    if state_of(target) != OPEN:
+        problems.append(f"3 回連続の失敗後に open でない: {state_of(target)}")
+    requests_before = _FakeHandler.requests
+    outcome, elapsed = send(target)
+    if not isinstance(outcome, CircuitOpenError):
+        problems.append(f"open 中の送信が CircuitOpenError にならない: {outcome!r}")
+    if _FakeHandler.requests != requests_before:
+        problems.append("open 中にエンドポイントへ送信した")
+    if elapsed > 0.05:
+        problems.append(f"open 中の失敗が遅い: {elapsed:.3f}s")
+    return problems
+
+
+def check_alive_errors(target: dict) -> list:
+    """429・400 は何回続いても open にしないこと"""
+    problems = []
+    reset()
+    for status in (429, 400):
+        set_mode(status)
+        for _ in range(5):
+            send(target)
+        if state_of(target) != CLOSED:
+            problems.append(f"{status} が続いて {state_of(target)} になった")
+    return problems
+
+
+def check_probe(target: dict, recover: bool) -> list:
+    """open の期間が過ぎたら probe を 1 件だけ通し、結果で closed / open に戻ること"""
+    problems = []
+    reset()
+    set_mode(503)
+    for _ in range(3):
+        send(target)
+    time.sleep(0.6)
+    if state_of(target) != HALF_OPEN:
+        problems.append(f"open の期間が過ぎても half_open にならない: {state_of(target)}")
+    # probe の応答を遅らせ、その間の送信がすぐ失敗することを確かめる
+    set_mode(200 if recover else 503, delay=0.15)
+    probe = {}
+    thread = threading.Thread(target=lambda: probe.update(outcome=send(target)[0]))
+    thread.start()
+    time.sleep(0.05)
+    requests_before = _FakeHandler.requests
+    outcome, elapsed = send(target)
+    if not isinstance(outcome, CircuitOpenError) or outcome.state != HALF_OPEN or elapsed > 0.05:
+        problems.append(f"回復確認中の他の送信がすぐ失敗しない: {outcome!r} ({elapsed:.3f}s)")
+    if _FakeHandler.requests != requests_before:
+        problems.append("回復確認中に probe 以外を送信した")
+    thread.join()
+    expected = CLOSED if recover else OPEN
+    if state_of(target) != expected:
+        problems.append(f"probe の{'成功' if recover else '失敗'}後に {expected} でない: {state_of(target)} ({probe})")
+    if recover:
+        outcome, _ = send(target)
+        if isinstance(outcome, Exception):
+            problems.append(f"回復後の送信が失敗した: {outcome!r}")
+    return problems
+
+
+def check_cancelled_probe(target: dict) -> list:
+    """取り消した probe では closed に戻さず、次の送信を改めて probe にすること"""
+    problems = []
+    reset()
+    set_mode(503)
+    for _ in range(3):
+        send(target)
+    time.sleep(0.6)
+    set_mode(200, delay=0.15)
+    cancel = CancelToken()
+    threading.Timer(0.05, cancel.cancel).start()
+    outcome, _ = send(target, cancel)
+    if isinstance(outcome, Exception) or outcome["finish_reason"] != "cancelled":
+        problems.append(f"probe が取り消しの結果にならない: {outcome!r}")
+    stats = breaker_stats()[0]
+    if state_of(target) != HALF_OPEN:
+        problems.append(f"取り消した probe の後に half_open でない: {state_of(target)}")
+    if stats["successes"] or stats["consecutive_failures"] != 3:
+        problems.append(f"取り消した probe を成功として数えた: {stats}")
+    # 次の送信は（回復確認中としてすぐ失敗させずに）改めて probe になり、成功すれば closed
+    set_mode()
+    outcome, _ = send(target)
+    if isinstance(outcome, Exception):
+        problems.append(f"取り消しの後の送信が probe にならない: {outcome!r}")
+    elif state_of(target) != CLOSED:
+        problems.append(f"取り消しの後の probe の成功で closed にならない: {state_of(target)}")
+    return problems
+
+
+def check_failover(endpoint: str) -> list:
+    """open のデプロイは待たずに次のリージョンへ切り替わること"""
+    problems = []
+    reset()
+    down = make_target(endpoint, "openai", region="Down")
+    down["endpoint"] = endpoint.rstrip("/") + "/down/"
+    healthy = make_target(endpoint, "openai", region="Healthy")
+    set_mode(503)
+    for _ in range(3):
+        send(down)
+    set_mode()
+
+    def call(target):
+        outcome, _ = send(target)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    started = time.perf_counter()
+    try:
+        _, record = call_with_failover([down, healthy], call, sleep=lambda s: None)
+    except Exception as e:
+        return [f"フェイルオーバーせずに失敗した: {e!r}"]
+    elapsed = time.perf_counter() - started
+    attempts = [(a["region"], a["error_type"], a["action"], a["local"]) for a in record["attempts"]]
+    if record["served_region"] != "Healthy" or attempts != [("Down", "CircuitOpenError", "failover", True)]:
+        problems.append(f"open のデプロイから切り替わらない: served={record['served_region']}, attempts={attempts}")
+    if elapsed > 1.0:
+        problems.append(f"フェイルオーバーが遅い: {elapsed:.3f}s")
+    return problems
+
+
+def check_async(target: dict) -> list:
+    """acomplete() が complete() と同じ形の結果を返すこと"""
+    problems = []
+    set_mode()
+    deltas = []
+    try:
+        result = asyncio.run(get_provider(target, "fake").acomplete(
+            [{"role": "user", "content": "hi"}], max_tokens=16, timeout=TIMEOUT, max_retries=0, on_text=deltas.append,
+        ))
+    except Exception as e:
+        return [f"acomplete() が失敗した: {e!r}"]
+    expected = get_provider(target, "fake").complete(
+        [{"role": "user", "content": "hi"}], max_tokens=16, timeout=TIMEOUT, max_retries=0,
+    )
+    fields = ("text", "finish_reason", "prompt_tokens", "completion_tokens", "total_tokens", "response_id")
+    if {k: result.get(k) for k in fields} != {k: expected.get(k) for k in fields}:
+        problems.append(f"同期版と結果が違う: {[(k, result.get(k), expected.get(k)) for k in fields]}")
+    if deltas != ["ok"]:
+        problems.append(f"on_text の差分が違う: {deltas}")
+    return problems
+
+
+def check_async_cancel(target: dict, before_headers: bool) -> list:
+    """acomplete() の取り消しで待たずに finish_reason="cancelled" の結果を返すこと"""
+    problems = []
+    cancel = CancelToken()
+    cancelled_at = []
+    cancel.on_cancel(lambda: cancelled_at.append(time.perf_counter()))
+    if before_headers:
+        set_mode(delay=1.0)
+        threading.Timer(0.1, cancel.cancel).start()  # 画面のスレッドから取り消す場合と同じく別スレッドから
+        on_text = None
+    else:
+        set_mode(chunk_delay=0.5)
+        on_text = lambda delta: cancel.cancel()  # 最初の差分を受け取ったら取り消す
+
+    async def run():
+        return await get_provider(target, "fake").acomplete(
+            [{"role": "user", "content": "hi"}], max_tokens=16, timeout=5.0, max_retries=0, on_text=on_text,
+            cancel=cancel,
+        )
+
+    try:
+        result = asyncio.run(run())
+    except BaseException as e:
+        return [f"取り消しが例外になった: {e!r}"]
+    finally:
+        set_mode()
+    elapsed = time.perf_counter() - cancelled_at[0] if cancelled_at else None
+    if result["finish_reason"] != "cancelled":
+        problems.append(f"finish_reason が cancelled でない: {result['finish_reason']}")
+    if result["text"] != ("" if before_headers else "ok"):
+        problems.append(f"取り消しまでのテキストが違う: {result['text']!r}")
+    if elapsed is None or elapsed > 0.3:
+        problems.append(f"取り消してから打ち切るまでが遅い: {elapsed}")
+    return problems
+
+
+def main():
+    endpoint = start_fake_endpoint()
+    checks = [
+        ("trip on 503 (openai)", lambda: check_trip(make_target(endpoint, "openai"), 503, 0.0)),
+        ("trip on 503 (anthropic)", lambda: check_trip(make_target(endpoint, "anthropic"), 503, 0.0)),
+        ("trip on timeout", lambda: check_trip(make_target(endpoint, "openai"), 200, TIMEOUT + 0.3)),
+        ("429 / 400 do not trip", lambda: check_alive_errors(make_target(endpoint, "openai"))),
+        ("probe recovers", lambda: check_probe(make_target(endpoint, "openai"), recover=True)),
+        ("probe fails -> reopen", lambda: check_probe(make_target(endpoint, "anthropic"), recover=False)),
+        ("cancelled probe is neutral (openai)", lambda: check_cancelled_probe(make_target(endpoint, "openai"))),
+        ("cancelled probe is neutral (anthropic)", lambda: check_cancelled_probe(make_target(endpoint, "anthropic"))),
+        ("failover skips open", lambda: check_failover(endpoint)),
+        ("async complete (openai)", lambda: check_async(make_target(endpoint, "openai"))),
+        ("async complete (anthropic)", lambda: check_async(make_target(endpoint, "anthropic"))),
+        ("async cancel before headers (openai)", lambda: check_async_cancel(make_target(endpoint, "openai"), True)),
+        ("async cancel before headers (anthropic)", lambda: check_async_cancel(make_target(endpoint, "anthropic"), True)),
+        ("async cancel mid-stream (openai)", lambda: check_async_cancel(make_target(endpoint, "openai"), False)),
+        ("async cancel mid-stream (anthropic)", lambda: check_async_cancel(make_target(endpoint, "anthropic"), False)),
+    ]
+    errors = []
+    for name, check in checks:
+        problems = check()
+        print(f"{'FAIL' if problems else 'ok  '} {name}")
+        errors += [(name, p) for p in problems]
+    if errors:
+        for name, err in errors:
+            print(f"FAIL {name}: {err}")
+        print(json.dumps(breaker_stats(), ensure_ascii=False, indent=2))
+        sys.exit(1)
+    print(f"OK: circuit breaker state machine and async provider path ({len(checks)} checks, {_FakeHandler.requests} requests to the fake endpoint).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+セッションストアの並行書き込みを検証する: 複数スレッド・複数プロセスから同じログへ
+同時にターンを追記し、1 件もメッセージが失われないことを確認する。
+一時ディレクトリを使うため data/ には触れない。
+プロジェクトルートで実行すること: python verify_session_store.py [--threads 8] [--turns 25]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from lib.session_journal import JournalSessionStore
+from lib.session_store import JsonSessionStore
+from lib.sharded_store import ShardedSessionStore
+from lib.sqlite_store import SqliteSessionStore
+
+# スレッド内で共有する 1 インスタンスの検証対象
+THREAD_BACKENDS = {
+    "json": lambda d: JsonSessionStore(d / "chat_log.json"),
+    "json-sync": lambda d: _sync(JsonSessionStore(d / "chat_log.json")),
+    "journal": lambda d: JournalSessionStore(d / "chat_log.json"),
+    "sharded": lambda d: ShardedSessionStore(d / "sessions"),
+    "sqlite": lambda d: SqliteSessionStore(d / "chat_log.sqlite3"),
+}
+# プロセスごとに別インスタンスを開く検証対象（journal は単一プロセス前提のため対象外）
+PROCESS_BACKENDS = ("json", "json-sync", "sharded", "sqlite")
+SESSIONS = 3  # ワーカーは session_id を共有する（同じセッションへの同時追記を含める）
+
+
+def _sync(store):
+    store.persister = None
+    return store
+
+
+def _close(store) -> None:
+    """一時ディレクトリを消す前に書き込みを終わらせる（journal は atexit でコンパクションするため）"""
+    store.flush()
+    if hasattr(store, "close"):
+        store.close()
+
+
+def _session(session_id: str) -> dict:
+    return {
+        "session_id": session_id, "session_name": session_id, "status": "active",
+        "created_at": "2026-01-01T00:00:00", "conversation_history": [], "messages": [], "errors": [],
+    }
+
+
+def _append_turns(store, worker: str, turns: int) -> None:
+    for i in range(turns):
+        text = f"{worker}-{i}"
+        store.append_turn(
+            f"s{i % SESSIONS}",
+            [{"role": "user", "content": text}, {"role": "assistant", "content": f"re: {text}"}],
+            {"request": {"user_input": text}, "response": {"ai_response": f"re: {text}"}},
+        )
+    store.flush()
+
+
+def _process_worker(backend: str, directory: str, worker: str, turns: int) -> None:
+    store = THREAD_BACKENDS[backend](Path(directory))
+    _append_turns(store, worker, turns)
+    _close(store)
+
+
+def _check(backend: str, directory: Path, workers: list[str], turns: int) -> list[str]:
+    """新しいインスタンスでディスクから読み直し、全ワーカーの全ターンがそろっているか調べる"""
+    store = THREAD_BACKENDS[backend](directory)
+    expected = {f"{w}-{i}" for w in workers for i in range(turns)}
+    found = []
+    for session_id in (f"s{n}" for n in range(SESSIONS)):
+        session = store.get_session(session_id) or {}
+        found += [m["request"]["user_input"] for m in session.get("messages", [])]
+        history = session.get("conversation_history", [])
+        if len(history) != 2 * len(session.get("messages", [])):
+            _close(store)
+            return [f"{session_id}: conversation_history と messages の件数が一致しません"]
+    _close(store)
+    problems = []
+    if len(found) != len(set(found)):
+        problems.append(f"重複 {len(found) - len(set(found))} 件")
+    lost = expected - set(found)
+    if lost:
+        problems.append(f"消失 {len(lost)}/{len(expected)} 件 (例: {sorted(lost)[:3]})")
+    return problems
+
+
+def _prepare(backend: str, directory: Path) -> None:
+    store = THREAD_BACKENDS[backend](directory)
+    with store.batch():
+        for n in range(SESSIONS):
+            store.create_session(_session(f"s{n}"))
+    _close(store)
+
+
+def run_threads(backend: str, workers: int, turns: int) -> list[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        _prepare(backend, directory)
+        store = THREAD_BACKENDS[backend](directory)
+        names = [f"t{n}" for n in range(workers)]
+        threads = [threading.Thread(target=_append_turns, args=(store, name, turns)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        _close(store)
+        stats = store.stats()
+        problems = _check(backend, directory, names, turns)
+        if stats.get("cas_conflicts"):
+            print(f"     ({backend}: CAS 競合 {stats['cas_conflicts']} 回を再試行)")
+        return problems
+
+
+def run_processes(backend: str, workers: int, turns: int) -> list[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        _prepare(backend, directory)
+        names = [f"p{n}" for n in range(workers)]
+        procs = [
+            multiprocessing.Process(target=_process_worker, args=(backend, tmp, name, turns))
+            for name in names
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        failed = [p.exitcode for p in procs if p.exitcode != 0]
+        if failed:
+            return [f"ワーカープロセス異常終了 exitcode={failed}"]
+        return _check(backend, directory, names, turns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="セッションストアの並行書き込み検証")
+    parser.add_argument("--threads", type=int, default=8, help="スレッド数 / プロセス数")
+    parser.add_argument("--turns", type=int, default=25, help="ワーカーごとの追記ターン数")
+    args = parser.parse_args()
+
+    errors = []
+    for backend in THREAD_BACKENDS:
+        problems = run_threads(backend, args.threads, args.turns)
+        print(f"{'FAIL' if problems else 'ok  '} threads   {backend}")
+        errors += [(f"threads/{backend}", p) for p in problems]
+    for backend in PROCESS_BACKENDS:
+        problems = run_processes(backend, args.threads, args.turns)
+        print(f"{'FAIL' if problems else 'ok  '} processes {backend}")
+        errors += [(f"processes/{backend}", p) for p in problems]
+    if errors:
+        for name, err in errors:
+            print(f"FAIL {name}: {err}")
+        sys.exit(1)
+    print(f"OK: no lost messages ({args.threads} workers x {args.turns} turns).")
+
+
+if __name__ == "__main__":
+    main()